@@ -5,17 +5,25 @@
 # Description: Flask app serving moviePulse
 
 import os
+import re
+import json
 import logging
+import functools
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from sqlalchemy.exc import IntegrityError
 
 from flask import Flask, render_template, Blueprint
-from flask import request
-from flask import send_from_directory
-from flask_restx import Api, Resource
+from flask import request, Response, stream_with_context, g
+from flask import send_from_directory, make_response
+from flask_restx import Api, Resource, abort
+from werkzeug.http import dump_cookie, generate_etag
 
-from tmdb_client import TMDB_REST_API_Client
+from tmdb_client import TMDB_REST_API_Client, TMDB_URL, TMDB_BREAKER, CARD_FIELDS, project
+from tmdb_client import TTL_CONFIG, TTL_LIST, TTL_DETAIL
+import models_redis
 import models_sql
+import response_codec
 
 #####################################
 
@@ -27,7 +35,71 @@ log = logging.getLogger(__name__)
 load_dotenv()
 
 app = Flask(__name__)
-tmdb = TMDB_REST_API_Client(url="https://api.themoviedb.org", api_ver="3")
+tmdb = TMDB_REST_API_Client(url=TMDB_URL, api_ver="3")
+
+#####################################
+
+def parse_fields(fields):
+    """
+        Parse the fields= projection of list endpoints:
+            (missing) or card  -> fields needed to render a card
+            all                -> complete TMDb objects
+            id,title,...       -> the listed fields
+    """
+
+    if fields is None or fields == "card":
+        return CARD_FIELDS
+
+    if fields == "all":
+        return None
+
+    return tuple(sorted({f.strip() for f in fields.split(",") if f.strip()}))
+
+
+def get_fields():
+    return parse_fields(request.args.get("fields"))
+
+
+MAX_PAGE_SIZE = 100
+
+def to_int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def paginate_list(items, args, path):
+    """
+        Slice a cached list by the page= (1-based) and limit= query args.
+        Without limit the whole list is returned. The body stays a plain
+        JSON array, paging metadata goes in X-Total-Count and Link headers.
+        Returns (items, headers).
+    """
+
+    headers = {"X-Total-Count": str(len(items))}
+
+    limit = to_int(args.get("limit"))
+    if not limit:
+        return items, headers
+
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    page = max(to_int(args.get("page"), 1), 1)
+
+    start = (page - 1) * limit
+    end = start + limit
+
+    if end < len(items):
+        next_args = dict(args)
+        next_args["page"] = page + 1
+        headers["Link"] = f'<{path}?{urlencode(next_args)}>; rel="next"'
+
+    return items[start:end], headers
+
+
+def paginate(items):
+    items, headers = paginate_list(items, request.args.to_dict(), request.path)
+    return items, 200, headers
 
 #####################################
 
@@ -53,14 +125,17 @@ def tv_detail_page(tv_id):
 
 @web_bp.route("/favorites")
 def show_favorites():
-    session = models_sql.Session()
-    favorites = session.query(models_sql.Favorite).filter_by(username="guest").all()
-    session.close()
+    favorites = [serialize_favorite(row) for row in get_favorites(get_user_id())]
     return render_template("favorites.html", favorites=favorites)
 
 # Register blueprint for web routes
 app.register_blueprint(web_bp)
 
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    # Roll back anything left open and return the connection to the pool
+    models_sql.Session.remove()
+
 # Web-page: http://artemis.home:5000/
 
 #####################################
@@ -73,6 +148,19 @@ api = Api(app,
           prefix="/api",
           doc="/api/docs")
 
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    """
+        Encode resource results with response_codec (orjson when installed)
+        instead of the stdlib encoder of Flask-RESTX.
+    """
+
+    response = make_response(response_codec.dumps(data), code)
+    response.headers.extend(headers or {})
+    response.mimetype = "application/json"
+
+    return response
+
 # Define API Namespace
 ns = api.namespace("v1", description="")
 
@@ -81,28 +169,179 @@ ns = api.namespace("v1", description="")
 
 #####################################
 
+def cache_control(ttl, stale_ttl=None):
+    """
+        Cache-Control of a response built from TMDb data cached for ttl
+        seconds and served stale for stale_ttl more (default: ttl), the
+        same policy as models_redis.cached.
+    """
+
+    if stale_ttl is None:
+        stale_ttl = ttl
+
+    return f"public, max-age={ttl}, stale-while-revalidate={stale_ttl}"
+
+
+def http_cache(ttl, stale_ttl=None):
+    """
+        Let browsers keep the successful responses of a GET handler.
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            g.cache_control = cache_control(ttl, stale_ttl)
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@app.after_request
+def add_validators(response):
+    """
+        Successful API GETs get a strong ETag (hash of the body), and a
+        request whose If-None-Match matches it gets 304 without a body.
+        Handlers marked with @http_cache also send Cache-Control, the
+        others are revalidated by the browser on every use.
+
+        Bodies are compressed with the best encoding the client accepts.
+        Each encoding is its own representation with its own ETag, and
+        compressed bodies are reused by ETag instead of compressed again.
+    """
+
+    if request.method != "GET" or response.status_code != 200 or response.is_streamed:
+        return response
+
+    if not request.path.startswith(api.prefix):
+        return response
+
+    if "cache_control" in g:
+        response.headers["Cache-Control"] = g.cache_control
+
+    body = response.get_data()
+    etag = generate_etag(body)
+
+    if len(body) >= response_codec.RESPONSE_COMPRESS_MIN_BYTES:
+        response.vary.add("Accept-Encoding")
+
+    encoding = response_codec.negotiate(request.headers.get("Accept-Encoding"), len(body))
+
+    response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    response = response.make_conditional(request)
+
+    if encoding and response.status_code == 200:
+        response.set_data(response_codec.compress(body, encoding, etag))
+        response.headers["Content-Encoding"] = encoding
+
+    return response
+
+#####################################
+
 @ns.route("/health")
 class HealthCheck(Resource):
     def get(self):
         return {"status": "ok"}, 200
 
+@ns.route("/cache/stats")
+class CacheStats(Resource):
+    def get(self):
+        """Cache counters: single-flight, rate limits and breakers are cluster-wide, L1 is per worker"""
+        return {
+            "singleflight": models_redis.get_singleflight_stats(),
+            "ratelimit": models_redis.get_rate_limit_stats(),
+            "breaker": {
+                "tmdb": TMDB_BREAKER.get_state(),
+                **models_redis.get_breaker_stats()
+            },
+            "l1": {
+                "worker": models_redis.worker_id(),
+                **models_redis.l1.stats()
+            }
+        }
+
+@ns.route("/db/stats")
+class DatabaseStats(Resource):
+    def get(self):
+        """Connection pool usage of this worker"""
+        return {
+            "worker": models_redis.worker_id(),
+            **models_sql.get_pool_stats()
+        }
+
 #####################################
 
+SEARCH_SESSION_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def parse_search_session(args):
+    """
+        ?session=<id>&seq=<n> sent by the type-ahead, seq grows with every
+        keystroke pause. Returns (status, (session, seq)), session is None
+        when the client sent none.
+    """
+
+    session = args.get("session")
+    if session is None:
+        return True, (None, None)
+
+    if not SEARCH_SESSION_PATTERN.match(session):
+        return False, "Invalid session, expected 1-64 letters, digits, '_' or '-'"
+
+    try:
+        seq = int(args.get("seq", ""))
+    except ValueError:
+        return False, "Invalid seq, expected an integer"
+
+    return True, (session, seq)
+
+
+def parse_search(args):
+    """
+        query= and the type-ahead session of a search request, as
+        (status, (query, session, seq)).
+    """
+
+    query = args.get("query")
+    if not query:
+        return False, "Missing search query"
+
+    status, output = parse_search_session(args)
+    if not status:
+        return False, output
+
+    return True, (query, *output)
+
+
 @ns.route("/search")
 class Search(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
-        query = request.args.get("query")
-        if not query:
-            return {"error": "Missing search query"}, 400
-        status, result = tmdb.search(query)
+        """Search movies, TV shows and people. Superseded type-ahead requests get 204"""
+        status, output = parse_search(request.args)
+        if not status:
+            return {"error": output}, 400
+        query, session, seq = output
+
+        superseded = None
+        if session is not None:
+            if not models_redis.claim_search(session, seq):
+                return None, 204
+            superseded = lambda: models_redis.search_superseded(session, seq)
+
+        status, result = tmdb.search(query, fields=get_fields(), superseded=superseded)
         if not status:
             return {"error": result}, 500
-        return result
+        if result is None:
+            return None, 204
+        return paginate(result)
 
 #####################################
 
 @ns.route("/genres")
 class Genres(Resource):
+    @http_cache(TTL_CONFIG)
     def get(self):
         status, result = tmdb.get_movie_genres()
         if not status:
@@ -111,6 +350,7 @@ class Genres(Resource):
 
 @ns.route("/languages")
 class Languages(Resource):
+    @http_cache(TTL_CONFIG)
     def get(self):
         status, result = tmdb.get_languages()
         if not status:
@@ -119,6 +359,7 @@ class Languages(Resource):
 
 @ns.route("/regions")
 class Regions(Resource):
+    @http_cache(TTL_CONFIG)
     def get(self):
         status, result = tmdb.get_countries()
         if not status:
@@ -129,14 +370,16 @@ class Regions(Resource):
 
 @ns.route("/trending/movies")
 class TrendingMovies(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
-        status, result = tmdb.get_trending_movies()
+        status, result = tmdb.get_trending_movies(fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
 
 @ns.route("/movie/<int:movie_id>")
 class MovieDetail(Resource):
+    @http_cache(TTL_DETAIL)
     def get(self, movie_id):
         status, result = tmdb.get_movie_detail(movie_id)
         if not status:
@@ -145,6 +388,7 @@ class MovieDetail(Resource):
 
 @ns.route("/movie/<int:movie_id>/credits")
 class MovieCredits(Resource):
+    @http_cache(TTL_DETAIL)
     def get(self, movie_id):
         status, result = tmdb.get_movie_credit(movie_id)
         if not status:
@@ -153,6 +397,7 @@ class MovieCredits(Resource):
 
 @ns.route("/movie/<int:movie_id>/videos")
 class MovieVideos(Resource):
+    @http_cache(TTL_DETAIL)
     def get(self, movie_id):
         status, result = tmdb.get_movie_video(movie_id)
         if not status:
@@ -163,14 +408,16 @@ class MovieVideos(Resource):
 
 @ns.route("/trending/tv")
 class TrendingTV(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
-        status, result = tmdb.get_trending_tvs()
+        status, result = tmdb.get_trending_tvs(fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
 
 @ns.route("/tv/<int:tv_id>")
 class TvDetail(Resource):
+    @http_cache(TTL_DETAIL)
     def get(self, tv_id):
         status, result = tmdb.get_tv_detail(tv_id)
         if not status:
@@ -179,6 +426,7 @@ class TvDetail(Resource):
 
 @ns.route("/tv/<int:tv_id>/credits")
 class TvCredits(Resource):
+    @http_cache(TTL_DETAIL)
     def get(self, tv_id):
         status, result = tmdb.get_tv_credit(tv_id)
         if not status:
@@ -189,14 +437,16 @@ class TvCredits(Resource):
 
 @ns.route("/discover/upcoming")
 class DiscoverUpcoming(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
-        status, result = tmdb.get_movies_upcoming()
+        status, result = tmdb.get_movies_upcoming(fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
 
 @ns.route("/discover/popular")
 class DiscoverPopular(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
 
         genres = request.args.get("with_genres")
@@ -207,13 +457,15 @@ class DiscoverPopular(Resource):
         status, result = tmdb.get_movies_popular(with_genres=genres,
                                                  with_original_language=languages,
                                                  region=regions,
-                                                 primary_release_year=year)
+                                                 primary_release_year=year,
+                                                 fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
 
 @ns.route("/discover/top_rated")
 class DiscoverTopRated(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
 
         genres = request.args.get("with_genres")
@@ -224,85 +476,747 @@ class DiscoverTopRated(Resource):
         status, result = tmdb.get_movies_top_rated(with_genres=genres,
                                                    with_original_language=languages,
                                                    region=regions,
-                                                   primary_release_year=year)
+                                                   primary_release_year=year,
+                                                   fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
 
 @ns.route("/discover/family_animation")
 class DiscoverFamilyAnimation(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
-        status, result = tmdb.get_movies_family_animation()
+        status, result = tmdb.get_movies_family_animation(fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
 
 @ns.route("/discover/horror")
 class DiscoverFamilyAnimation(Resource):
+    @http_cache(TTL_LIST)
     def get(self):
-        status, result = tmdb.get_movies_horror()
+        status, result = tmdb.get_movies_horror(fields=get_fields())
         if not status:
             return {"error": result}, 500
-        return result
+        return paginate(result)
+
+#####################################
+
+# Detail calls of the batch endpoint, per media type
+DETAIL_METHODS = {
+    "movie": "get_movie_detail",
+    "tv": "get_tv_detail",
+}
+
+MAX_BATCH_IDS = 100
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+
+def parse_batch_ids(value):
+    """
+        Parse ids=movie:1,tv:2 into ([("movie", 1), ("tv", 2)], invalid).
+        Duplicates are dropped, order is kept.
+    """
+
+    items = []
+    invalid = []
+
+    for token in (value or "").split(","):
+        token = token.strip()
+        if not token:
+            continue
+        media_type, _, media_id = token.partition(":")
+        media_id = to_int(media_id)
+        if media_type not in DETAIL_METHODS or media_id is None:
+            invalid.append(token)
+            continue
+        items.append((media_type, media_id))
+
+    return list(dict.fromkeys(items)), invalid
+
+
+def check_batch_ids(value):
+    """
+        ids= of a batch request as (items, error), error is None when it is valid.
+    """
+
+    items, invalid = parse_batch_ids(value)
+
+    if invalid:
+        return items, f"Invalid ids: {', '.join(invalid)}"
+    if not items:
+        return items, "Missing ids"
+    if len(items) > MAX_BATCH_IDS:
+        return items, f"At most {MAX_BATCH_IDS} ids per request"
+
+    return items, None
+
+
+def get_detail(client, media_type, media_id):
+    """
+        The cached detail call of the sync or the async TMDb client.
+    """
+
+    return getattr(client, DETAIL_METHODS[media_type])(media_id)
+
+
+def batch_output(results, errors, fields):
+
+    return {
+        "results": {name: project([detail], fields)[0] for name, detail in results.items()},
+        "errors": errors
+    }
+
+
+def fetch_details(items):
+    """
+        TMDb details of [(media_type, media_id), ...], as ({"type:id": detail}, {"type:id": error}).
+        Cached details are read with one pipelined Redis round-trip,
+        misses are fetched from TMDb concurrently.
+    """
+
+    keys = []
+    for media_type, media_id in items:
+        keys.extend(models_redis.collect_keys(lambda: get_detail(tmdb, media_type, media_id)))
+    models_redis.prefetch(keys)
+
+    results = {}
+    errors = {}
+
+    if not items:
+        return results, errors
+
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(items))) as executor:
+        futures = {
+            executor.submit(get_detail, tmdb, media_type, media_id): f"{media_type}:{media_id}"
+            for media_type, media_id in items
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                status, result = future.result()
+            except Exception as E:
+                log.exception("Batch detail %s failed", name)
+                status, result = False, str(E)
+            if status:
+                results[name] = result
+            else:
+                errors[name] = result
+
+    return results, errors
+
+
+@ns.route("/batch/details")
+class BatchDetails(Resource):
+
+    @http_cache(TTL_DETAIL)
+    def get(self):
+        """
+            Details of many movies and TV shows in one call: ids=movie:1,tv:2,...
+            Each item is projected with fields= (card by default) and keyed
+            by its "type:id".
+        """
+
+        items, error = check_batch_ids(request.args.get("ids"))
+        if error:
+            return {"error": error}, 400
+
+        results, errors = fetch_details(items)
+
+        return batch_output(results, errors, get_fields())
 
 #####################################
 
+# Current user: set by the X-MoviePulse-User header (API clients) or the
+# moviepulse_user cookie (browsers, see /api/v1/user), "guest" otherwise
+USER_HEADER = "X-MoviePulse-User"
+USER_COOKIE = "moviepulse_user"
+DEFAULT_USER = "guest"
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+def parse_username(headers, cookies):
+    """
+        Name of the current user, or None when the name is not valid.
+    """
+
+    username = (headers.get(USER_HEADER) or cookies.get(USER_COOKIE) or DEFAULT_USER).strip()
+
+    if not USERNAME_PATTERN.match(username):
+        return None
+
+    return username
+
+
+def resolve_user_id(username, create=False):
+    """
+        Id of username, None when the user does not exist yet and create is not set.
+    """
+
+    session = models_sql.Session()
+    if create:
+        return models_sql.get_user_id(session, username)
+
+    return models_sql.find_user_id(session, username)
+
+
+def get_user_id():
+    """
+        Id of the current user, looked up once per request. Reads never
+        create the user, a user who has not written anything yet gets None
+        and therefore empty lists. The first write creates it.
+    """
+
+    if "user_id" not in g:
+        username = parse_username(request.headers, request.cookies)
+        if username is None:
+            abort(400, "Invalid user name")
+        g.user_id = resolve_user_id(username, create=request.method not in ("GET", "HEAD"))
+
+    return g.user_id
+
+
+@ns.route("/user")
+class CurrentUser(Resource):
+
+    def get(self):
+        """Current user"""
+        return {"id": get_user_id(), "username": parse_username(request.headers, request.cookies)}
+
+    def put(self):
+        """Switch the current user of this browser: {"username": "..."}"""
+        username = ((request.json or {}).get("username") or "").strip()
+        if not USERNAME_PATTERN.match(username):
+            return {"error": "Expected a username of 1-64 letters, digits, '.', '_' or '-'"}, 400
+
+        user_id = resolve_user_id(username, create=True)
+        cookie = dump_cookie(USER_COOKIE, username, max_age=365 * 24 * 3600, samesite="Lax")
+
+        return {"id": user_id, "username": username}, 200, {"Set-Cookie": cookie}
+
+#####################################
+
+def parse_media_type():
+    """
+        Optional media_type= filter of per-user lists, 400 when unknown.
+    """
+
+    media_type = request.args.get("media_type")
+    if media_type and media_type not in DETAIL_METHODS:
+        abort(400, "media_type must be movie or tv")
+
+    return media_type
+
+
+def keyset_page(rows, serialize):
+    """
+        Serialize a page of rows read newest first. Like paginate(), the body
+        stays a JSON array. When the page is full, a Link header points to
+        the next one with before=<id of the last row>.
+        Returns (items, 200, headers).
+    """
+
+    headers = {}
+
+    limit = to_int(request.args.get("limit"))
+    if limit and len(rows) == limit:
+        next_args = request.args.to_dict()
+        next_args["before"] = rows[-1].id
+        headers["Link"] = f'<{request.path}?{urlencode(next_args)}>; rel="next"'
+
+    return [serialize(row) for row in rows], 200, headers
+
+
+def page_args():
+    """
+        (before, limit) of a keyset page, limit capped at MAX_PAGE_SIZE.
+    """
+
+    limit = to_int(request.args.get("limit"))
+    if limit:
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+
+    return to_int(request.args.get("before")), limit
+
+#####################################
+
+def get_favorites(user_id, media_type=None, before=None, limit=None):
+    """
+        Favorites of a user, newest first, with their card fields read with
+        one join on media_metadata. Items without metadata yet have title None.
+        Returns the rows, see serialize_favorite().
+    """
+
+    session = models_sql.Session()
+    rows = models_sql.list_favorites(session, user_id, media_type, before, limit)
+
+    # Read-only, hand the connection back before the response is built
+    session.close()
+
+    return rows
+
+
+def serialize_favorite(row):
+    return {
+        "tmdb_id": row.tmdb_id,
+        "media_type": row.media_type,
+        "added_at": row.created_at.isoformat() if row.created_at else None,
+        "title": row.title,
+        "poster_path": row.poster_path,
+        "vote_average": row.vote_average,
+        "release_date": row.release_date
+    }
+
+
+def parse_favorite_items(data):
+    """
+        Parse [{"tmdb_id": 1, "media_type": "movie"}, ...] into
+        ([(1, "movie"), ...], invalid). Duplicates are dropped, order is kept.
+    """
+
+    if not isinstance(data, list):
+        return [], [data]
+
+    items = []
+    invalid = []
+
+    for entry in data:
+        if not isinstance(entry, dict):
+            invalid.append(entry)
+            continue
+        tmdb_id = to_int(entry.get("tmdb_id"))
+        media_type = entry.get("media_type")
+        if tmdb_id is None or media_type not in DETAIL_METHODS:
+            invalid.append(entry)
+            continue
+        items.append((tmdb_id, media_type))
+
+    return list(dict.fromkeys(items)), invalid
+
+
+def add_favorites(user_id, items):
+    """
+        Add favorites of a user in one transaction, then store the card
+        fields of the new ones. The insert commits before TMDb is asked,
+        so no connection is held while it answers and items already in
+        favorites are not fetched. A failed lookup is left to
+        metadata_refresher.py, which fills missing metadata rows.
+        Returns the items that were added.
+    """
+
+    session = models_sql.Session()
+
+    added = models_sql.add_favorites(session, user_id, items)
+    session.commit()
+
+    if not added:
+        return added
+
+    models_redis.publish_event("favorites", {"user_id": user_id, "added": as_favorites(added)})
+
+    details, errors = fetch_details([(media_type, tmdb_id) for tmdb_id, media_type in added])
+    for name, error in errors.items():
+        log.error(f"Cannot fetch metadata of {name}: {error}")
+
+    rows = [models_sql.metadata_from_detail(media_type, details[f"{media_type}:{tmdb_id}"])
+            for tmdb_id, media_type in added if f"{media_type}:{tmdb_id}" in details]
+    models_sql.save_metadata(session, rows)
+    session.commit()
+
+    return added
+
+
+def remove_favorites(user_id, items):
+    """
+        Remove favorites of a user in one statement.
+        Returns the items that were removed.
+    """
+
+    session = models_sql.Session()
+    removed = models_sql.remove_favorites(session, user_id, items)
+    session.commit()
+
+    if removed:
+        models_redis.publish_event("favorites", {"user_id": user_id, "removed": as_favorites(removed)})
+
+    return removed
+
+
+def as_favorites(items):
+    return [{"tmdb_id": tmdb_id, "media_type": media_type} for tmdb_id, media_type in items]
+
+
 @ns.route("/favorites")
 class FavoriteList(Resource):
 
     def get(self):
-        """Get list of favorite items for the guest user"""
-        session = models_sql.Session()
-        favs = session.query(models_sql.Favorite).filter_by(username="guest").all()
-        session.close()
-        return [ {"tmdb_id": f.tmdb_id, "media_type": f.media_type} for f in favs ]
+        """
+            Favorites of the current user, newest first.
+            Optional media_type= filter, keyset paging with limit= and before=.
+        """
+        before, limit = page_args()
+        rows = get_favorites(get_user_id(), parse_media_type(), before, limit)
+        return keyset_page(rows, serialize_favorite)
 
     def post(self):
         """Add an item to favorites"""
         data = request.json
-        session = models_sql.Session()
-        fav = models_sql.Favorite(
-            username="guest",
-            tmdb_id=data["tmdb_id"],
-            media_type=data["media_type"]
-        )
-        session.add(fav)
-
-        try:
-            session.commit()
-            return {
-                "success": True,
-                "favorite": {
-                    "tmdb_id": fav.tmdb_id,
-                    "media_type": fav.media_type
-                }
-            }, 201
-        except IntegrityError:
-            session.rollback()
+        items, invalid = parse_favorite_items([data])
+        if invalid:
+            return {"error": "Expected tmdb_id and media_type (movie or tv)"}, 400
+
+        if not add_favorites(get_user_id(), items):
             return {"message": "Item already in favorites."}, 200
-        finally:
-            session.close()
+
+        return {"success": True, "favorite": as_favorites(items)[0]}, 201
 
     def delete(self):
         """Remove an item from favorites"""
         data = request.json
-        session = models_sql.Session()
-        fav = session.query(models_sql.Favorite).filter_by(
-            username="guest",
-            tmdb_id=data["tmdb_id"],
-            media_type=data["media_type"]
-        ).first()
-
-        if fav:
-            session.delete(fav)
-            session.commit()
+        items, invalid = parse_favorite_items([data])
+        if invalid:
+            return {"error": "Expected tmdb_id and media_type (movie or tv)"}, 400
+
+        if remove_favorites(get_user_id(), items):
             result = {"success": True, "message": "Item removed from favorites."}
         else:
             result = {"success": False, "message": "Item not found in favorites."}
 
-        session.close()
         return result, 200
 
+@ns.route("/favorites/bulk")
+class FavoriteBulk(Resource):
+
+    def post(self):
+        """Add many items to favorites in one transaction: {"items": [{"tmdb_id", "media_type"}, ...]}"""
+        items, invalid = parse_favorite_items((request.json or {}).get("items"))
+        if invalid:
+            return {"error": "Expected items: [{tmdb_id, media_type (movie or tv)}, ...]"}, 400
+        if len(items) > MAX_BATCH_IDS:
+            return {"error": f"At most {MAX_BATCH_IDS} items per request"}, 400
+
+        added = add_favorites(get_user_id(), items)
+
+        return {"success": True, "added": as_favorites(added), "skipped": len(items) - len(added)}, 200
+
+    def delete(self):
+        """Remove many items from favorites in one statement: {"items": [{"tmdb_id", "media_type"}, ...]}"""
+        items, invalid = parse_favorite_items((request.json or {}).get("items"))
+        if invalid:
+            return {"error": "Expected items: [{tmdb_id, media_type (movie or tv)}, ...]"}, 400
+        if len(items) > MAX_BATCH_IDS:
+            return {"error": f"At most {MAX_BATCH_IDS} items per request"}, 400
+
+        removed = remove_favorites(get_user_id(), items)
+
+        return {"success": True, "removed": as_favorites(removed), "skipped": len(items) - len(removed)}, 200
+
+@ns.route("/favorites/counts")
+class FavoriteCounts(Resource):
+    def get(self):
+        """Number of favorites of the current user, in total and per media type"""
+        session = models_sql.Session()
+        return models_sql.count_by_media_type(session, models_sql.Favorite, get_user_id())
+
+#####################################
+
+def serialize_history(row):
+    return {
+        "tmdb_id": row.tmdb_id,
+        "media_type": row.media_type,
+        "watched_at": row.watched_at.isoformat() if row.watched_at else None
+    }
+
+
+@ns.route("/history")
+class History(Resource):
+
+    def get(self):
+        """
+            Watch history of the current user, newest first.
+            Optional media_type= filter, keyset paging with limit= and before=.
+        """
+        before, limit = page_args()
+        session = models_sql.Session()
+        rows = models_sql.list_history(session, get_user_id(), parse_media_type(), before, limit)
+        return keyset_page(rows, serialize_history)
+
+    def post(self):
+        """Record that the current user watched an item"""
+        items, invalid = parse_favorite_items([request.json])
+        if invalid:
+            return {"error": "Expected tmdb_id and media_type (movie or tv)"}, 400
+
+        tmdb_id, media_type = items[0]
+
+        session = models_sql.Session()
+        models_sql.add_history(session, get_user_id(), tmdb_id, media_type)
+        session.commit()
+
+        return {"success": True}, 201
+
+@ns.route("/history/counts")
+class HistoryCounts(Resource):
+    def get(self):
+        """Number of watch-history entries of the current user, in total and per media type"""
+        session = models_sql.Session()
+        return models_sql.count_by_media_type(session, models_sql.WatchHistory, get_user_id())
+
+#####################################
+
+# Movie nights are named by the client, e.g. the date "2025-06-13"
+NIGHT_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def check_night(night):
+    if not NIGHT_PATTERN.match(night):
+        abort(400, "Invalid night, expected 1-64 letters, digits, '_' or '-'")
+
+
+def format_leaderboard(night, result):
+
+    leaderboard = []
+    for member, votes in result["leaderboard"]:
+        media_type, _, tmdb_id = member.partition(":")
+        leaderboard.append({"tmdb_id": int(tmdb_id), "media_type": media_type, "votes": votes})
+
+    return {
+        "night": night,
+        "leaderboard": leaderboard,
+        "my_vote": result["my_vote"],
+        "voters": result["voters"]
+    }
+
+
+def load_night(night):
+    """
+        Votes of a night from Postgres, to rebuild it in Redis.
+    """
+
+    session = models_sql.Session()
+    return models_sql.load_vote_members(session, night)
+
+
+def publish_vote(night, user_id):
+    """
+        Push the new leaderboard of a night to the open event streams.
+    """
+
+    status, result = models_redis.get_leaderboard(night, user_id, restore=load_night)
+    if not status:
+        return
+
+    models_redis.publish_event("votes", {"user_id": user_id, **format_leaderboard(night, result)})
+
+
+@ns.route("/votes/<string:night>")
+class Votes(Resource):
+
+    def get(self, night):
+        """
+            Leaderboard of a movie night, the vote of the current user and the
+            number of voters. Read from the Redis tallies, limit= entries (default 10).
+            A night Redis no longer holds is rebuilt from Postgres first.
+        """
+        check_night(night)
+        limit = min(max(request.args.get("limit", 10, type=int), 1), MAX_PAGE_SIZE)
+
+        status, result = models_redis.get_leaderboard(night, get_user_id(), limit, load_night)
+        if not status:
+            return {"error": result}, 500
+
+        return format_leaderboard(night, result)
+
+    def post(self, night):
+        """Vote for an item, replacing the current user's previous vote of that night"""
+        check_night(night)
+        items, invalid = parse_favorite_items([request.json])
+        if invalid:
+            return {"error": "Expected tmdb_id and media_type (movie or tv)"}, 400
+
+        tmdb_id, media_type = items[0]
+
+        status, changed = models_redis.cast_vote(night, get_user_id(), f"{media_type}:{tmdb_id}", load_night)
+        if not status:
+            return {"error": changed}, 500
+
+        if changed:
+            publish_vote(night, get_user_id())
+
+        return {"success": True, "changed": changed}, 200
+
+    def delete(self, night):
+        """Withdraw the current user's vote of that night"""
+        check_night(night)
+
+        status, removed = models_redis.retract_vote(night, get_user_id(), load_night)
+        if not status:
+            return {"error": removed}, 500
+
+        if removed:
+            publish_vote(night, get_user_id())
+
+        return {"success": removed}, 200
+
+#####################################
+
+# Favorite and vote changes are published to models_redis.EVENTS_CHANNEL by
+# the handlers above and streamed to browsers by asgi.py (/api/v1/events).
+# A stream stays open as long as the page, which would hold a synchronous
+# worker, so the Flask app only shapes the events.
+
+# Comment line sent when nothing happened, keeps proxies from closing the stream
+EVENTS_KEEPALIVE_SECONDS = 15
+
+def event_for(message, user_id):
+    """
+        Shape a channel message for one user's stream, None to skip it.
+    """
+
+    data = dict(message.get("data", {}))
+
+    if message.get("event") == "favorites":
+        # Favorites are private
+        if data.pop("user_id", None) != user_id:
+            return None
+
+    elif message.get("event") == "votes":
+        # my_vote belongs to the voter
+        if data.pop("user_id", None) != user_id:
+            data.pop("my_vote", None)
+
+    return message["event"], data
+
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+#####################################
+
+# Sections of the home page, each a method of the TMDb client that goes through the cache
+HOME_SECTIONS = {
+    "trending_movies": "get_trending_movies",
+    "trending_tv": "get_trending_tvs",
+    "upcoming": "get_movies_upcoming",
+    "popular": "get_movies_popular",
+    "top_rated": "get_movies_top_rated",
+    "horror": "get_movies_horror",
+    "family_animation": "get_movies_family_animation",
+    "genres": "get_movie_genres",
+    "languages": "get_languages",
+    "regions": "get_countries",
+}
+
+# Sections returned as the first page of a list, the rest via the list endpoint
+HOME_LIST_SECTIONS = {"trending_movies", "trending_tv", "upcoming", "popular",
+                      "top_rated", "horror", "family_animation"}
+
+HOME_WORKERS = int(os.getenv("HOME_WORKERS", "4"))
+
+
+def home_calls(client):
+    """
+        {section: call} of the sync or the async TMDb client.
+    """
+
+    return {name: getattr(client, method) for name, method in HOME_SECTIONS.items()}
+
+
+def parse_home_args(args):
+    """
+        (limit, stream) of a home request.
+    """
+
+    limit = min(max(to_int(args.get("limit"), 20), 1), MAX_PAGE_SIZE)
+    stream = args.get("stream") in ("1", "true")
+
+    return limit, stream
+
+
+def shape_section(name, result, limit):
+
+    if name in HOME_LIST_SECTIONS:
+        return {"results": result[:limit], "total": len(result)}
+
+    return result
+
+
+def home_line(name, status, result, limit):
+    """
+        One NDJSON line of a streamed home response.
+    """
+
+    if status:
+        line = {"section": name, "data": shape_section(name, result, limit)}
+    else:
+        line = {"section": name, "error": result}
+
+    return json.dumps(line) + "\n"
+
+
+def home_output(favorites, results, limit):
+    """
+        The home response from {section: (status, result)}.
+    """
+
+    output = {"sections": {"favorites": favorites}, "errors": {}}
+
+    # In HOME_SECTIONS order whichever finished first, so the ETag is stable
+    for name in HOME_SECTIONS:
+        status, result = results[name]
+        if status:
+            output["sections"][name] = shape_section(name, result, limit)
+        else:
+            output["errors"][name] = result
+
+    return output
+
+
+@ns.route("/home")
+class Home(Resource):
+
+    def get(self):
+        """
+            All home-page sections in one response.
+            Cached sections are read with one pipelined Redis round-trip,
+            misses are fetched from TMDb concurrently. List sections hold the
+            first limit= items (default 20) and their total size.
+            With stream=1 each section is sent as an NDJSON line when ready.
+        """
+
+        limit, stream = parse_home_args(request.args)
+
+        calls = home_calls(tmdb)
+
+        keys = []
+        for call in calls.values():
+            keys.extend(models_redis.collect_keys(call))
+        models_redis.prefetch(keys)
+
+        favorites = [serialize_favorite(row) for row in get_favorites(get_user_id())]
+
+        def sections():
+            """Yield (name, status, result) as sections complete"""
+            with ThreadPoolExecutor(max_workers=HOME_WORKERS) as executor:
+                futures = {executor.submit(call): name for name, call in calls.items()}
+                for future in as_completed(futures):
+                    try:
+                        status, result = future.result()
+                    except Exception as E:
+                        log.exception("Home section %s failed", futures[future])
+                        status, result = False, str(E)
+                    yield futures[future], status, result
+
+        if stream:
+
+            def generate():
+                yield json.dumps({"section": "favorites", "data": favorites}) + "\n"
+                for name, status, result in sections():
+                    yield home_line(name, status, result, limit)
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        results = {name: (status, result) for name, status, result in sections()}
+
+        return home_output(favorites, results, limit)
+
 #####################################
 
 if __name__ == "__main__":
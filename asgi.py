@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: ASGI entry point serving the TMDb proxy endpoints asynchronously
+
+# The TMDb proxy endpoints (search, genres, trending, details, batch, discover, home)
+# are served by coroutines, so a worker waiting on TMDb keeps accepting
+# requests. So is the /api/v1/events stream, which holds one connection
+# per browser. Everything else (web pages, favorites, Swagger docs) is the
+# unchanged Flask app, mounted underneath as WSGI.
+#
+#   uvicorn asgi:app --workers 4 --host 127.0.0.1 --port 8000
+
+import json
+import asyncio
+import logging
+import functools
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route, Mount
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import generate_etag, quote_etag, parse_etags
+
+from tmdb_client import TMDB_URL, TTL_CONFIG, TTL_LIST, TTL_DETAIL
+from tmdb_client_async import Async_TMDB_REST_API_Client
+import models_redis_async
+import models_sql
+import response_codec
+import app as flask_app
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+tmdb = Async_TMDB_REST_API_Client(url=TMDB_URL, api_ver="3")
+
+#####################################
+
+class JSON_Response(JSONResponse):
+    """
+        Encoded with response_codec, like the Flask-RESTX resources.
+    """
+
+    def render(self, content):
+        return response_codec.dumps(content)
+
+def reply(status, result):
+
+    if not status:
+        return JSON_Response({"error": result}, status_code=500)
+
+    return JSON_Response(result)
+
+
+def reply_list(request, status, result):
+
+    if not status:
+        return JSON_Response({"error": result}, status_code=500)
+
+    items, headers = flask_app.paginate_list(result, dict(request.query_params), request.url.path)
+
+    return JSON_Response(items, headers=headers)
+
+
+def get_fields(request):
+    return flask_app.parse_fields(request.query_params.get("fields"))
+
+
+def conditional(request, response, cache_control=None):
+    """
+        Same as the Flask add_validators hook: strong ETag on a successful
+        response, 304 when it matches If-None-Match, body compressed with
+        the best encoding the client accepts.
+    """
+
+    if response.status_code != 200:
+        return response
+
+    body = response.body
+    etag = generate_etag(body)
+    encoding = response_codec.negotiate(request.headers.get("accept-encoding"), len(body))
+    variant = f"{etag}-{encoding}" if encoding else etag
+
+    headers = {"ETag": quote_etag(variant)}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if len(body) >= response_codec.RESPONSE_COMPRESS_MIN_BYTES:
+        headers["Vary"] = "Accept-Encoding"
+
+    if parse_etags(request.headers.get("if-none-match")).contains_weak(variant):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        response.body = response_codec.compress(body, encoding, etag)
+        headers["Content-Encoding"] = encoding
+        headers["Content-Length"] = str(len(response.body))
+
+    response.headers.update(headers)
+
+    return response
+
+
+def http_cache(ttl, stale_ttl=None):
+    """
+        See flask_app.http_cache.
+    """
+
+    cache_control = flask_app.cache_control(ttl, stale_ttl)
+
+    def decorator(handler):
+
+        @functools.wraps(handler)
+        async def wrapper(request):
+            return conditional(request, await handler(request), cache_control)
+
+        return wrapper
+
+    return decorator
+
+#####################################
+
+@http_cache(TTL_LIST)
+async def search(request):
+    status, output = flask_app.parse_search(request.query_params)
+    if not status:
+        return JSON_Response({"error": output}, status_code=400)
+    query, session, seq = output
+
+    if session is not None and not await models_redis_async.claim_search(session, seq):
+        return Response(status_code=204)
+
+    async def superseded():
+        # The browser aborted the request, or sent a newer one
+        if await request.is_disconnected():
+            return True
+        return session is not None and await models_redis_async.search_superseded(session, seq)
+
+    status, result = await tmdb.search(query, fields=get_fields(request), superseded=superseded)
+    if status and result is None:
+        return Response(status_code=204)
+    return reply_list(request, status, result)
+
+@http_cache(TTL_CONFIG)
+async def genres(request):
+    return reply(*await tmdb.get_movie_genres())
+
+@http_cache(TTL_CONFIG)
+async def languages(request):
+    return reply(*await tmdb.get_languages())
+
+@http_cache(TTL_CONFIG)
+async def regions(request):
+    return reply(*await tmdb.get_countries())
+
+#####################################
+
+@http_cache(TTL_LIST)
+async def trending_movies(request):
+    status, result = await tmdb.get_trending_movies(fields=get_fields(request))
+    return reply_list(request, status, result)
+
+@http_cache(TTL_DETAIL)
+async def movie_detail(request):
+    return reply(*await tmdb.get_movie_detail(request.path_params["movie_id"]))
+
+@http_cache(TTL_DETAIL)
+async def movie_credits(request):
+    return reply(*await tmdb.get_movie_credit(request.path_params["movie_id"]))
+
+@http_cache(TTL_DETAIL)
+async def movie_videos(request):
+    return reply(*await tmdb.get_movie_video(request.path_params["movie_id"]))
+
+#####################################
+
+@http_cache(TTL_LIST)
+async def trending_tv(request):
+    status, result = await tmdb.get_trending_tvs(fields=get_fields(request))
+    return reply_list(request, status, result)
+
+@http_cache(TTL_DETAIL)
+async def tv_detail(request):
+    return reply(*await tmdb.get_tv_detail(request.path_params["tv_id"]))
+
+@http_cache(TTL_DETAIL)
+async def tv_credits(request):
+    return reply(*await tmdb.get_tv_credit(request.path_params["tv_id"]))
+
+#####################################
+
+def discover_filters(request):
+    return {
+        "with_genres": request.query_params.get("with_genres"),
+        "with_original_language": request.query_params.get("language"),
+        "region": request.query_params.get("region"),
+        "primary_release_year": request.query_params.get("year"),
+    }
+
+@http_cache(TTL_LIST)
+async def discover_upcoming(request):
+    status, result = await tmdb.get_movies_upcoming(fields=get_fields(request))
+    return reply_list(request, status, result)
+
+@http_cache(TTL_LIST)
+async def discover_popular(request):
+    status, result = await tmdb.get_movies_popular(**discover_filters(request), fields=get_fields(request))
+    return reply_list(request, status, result)
+
+@http_cache(TTL_LIST)
+async def discover_top_rated(request):
+    status, result = await tmdb.get_movies_top_rated(**discover_filters(request), fields=get_fields(request))
+    return reply_list(request, status, result)
+
+@http_cache(TTL_LIST)
+async def discover_family_animation(request):
+    status, result = await tmdb.get_movies_family_animation(fields=get_fields(request))
+    return reply_list(request, status, result)
+
+@http_cache(TTL_LIST)
+async def discover_horror(request):
+    status, result = await tmdb.get_movies_horror(fields=get_fields(request))
+    return reply_list(request, status, result)
+
+#####################################
+
+@http_cache(TTL_DETAIL)
+async def batch_details(request):
+    """
+        Same response as the Flask /api/v1/batch/details, misses gathered as coroutines.
+    """
+
+    items, error = flask_app.check_batch_ids(request.query_params.get("ids"))
+    if error:
+        return JSON_Response({"error": error}, status_code=400)
+
+    keys = []
+    for media_type, media_id in items:
+        keys.extend(await models_redis_async.collect_keys(lambda: flask_app.get_detail(tmdb, media_type, media_id)))
+    await models_redis_async.prefetch(keys)
+
+    async def run(media_type, media_id):
+        name = f"{media_type}:{media_id}"
+        try:
+            status, result = await flask_app.get_detail(tmdb, media_type, media_id)
+        except Exception as E:
+            log.exception("Batch detail %s failed", name)
+            status, result = False, str(E)
+        return name, status, result
+
+    results = {}
+    errors = {}
+
+    for name, status, result in await asyncio.gather(*[run(*item) for item in items]):
+        if status:
+            results[name] = result
+        else:
+            errors[name] = result
+
+    return JSON_Response(flask_app.batch_output(results, errors, get_fields(request)))
+
+#####################################
+
+def load_favorites(username):
+    # Runs in a threadpool thread, outside any Flask request teardown
+    try:
+        rows = flask_app.get_favorites(flask_app.resolve_user_id(username))
+        return [flask_app.serialize_favorite(row) for row in rows]
+    finally:
+        models_sql.Session.remove()
+
+
+async def home(request):
+    """
+        Same response as the Flask /api/v1/home, sections gathered as coroutines.
+    """
+
+    limit, stream = flask_app.parse_home_args(request.query_params)
+
+    username = flask_app.parse_username(request.headers, request.cookies)
+    if username is None:
+        return JSON_Response({"message": "Invalid user name"}, status_code=400)
+
+    calls = flask_app.home_calls(tmdb)
+
+    keys = []
+    for call in calls.values():
+        keys.extend(await models_redis_async.collect_keys(call))
+    await models_redis_async.prefetch(keys)
+
+    # SQLAlchemy is synchronous, keep it off the event loop
+    favorites = await run_in_threadpool(load_favorites, username)
+
+    async def run(name, call):
+        try:
+            status, result = await call()
+        except Exception as E:
+            log.exception("Home section %s failed", name)
+            status, result = False, str(E)
+        return name, status, result
+
+    tasks = [run(name, call) for name, call in calls.items()]
+
+    if stream:
+
+        async def generate():
+            yield json.dumps({"section": "favorites", "data": favorites}) + "\n"
+            for task in asyncio.as_completed(tasks):
+                yield flask_app.home_line(*await task, limit)
+
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+    results = {name: (status, result) for name, status, result in await asyncio.gather(*tasks)}
+
+    return conditional(request, JSON_Response(flask_app.home_output(favorites, results, limit)))
+
+#####################################
+
+hub = models_redis_async.Event_Hub()
+
+def resolve_user(username):
+    try:
+        return flask_app.resolve_user_id(username)
+    finally:
+        models_sql.Session.remove()
+
+
+async def events(request):
+    """
+        Server-Sent Events: favorite changes of the current user and vote
+        changes of every night. One long-lived connection per browser
+        replaces refetching the favorites list.
+    """
+
+    username = flask_app.parse_username(request.headers, request.cookies)
+    if username is None:
+        return JSON_Response({"message": "Invalid user name"}, status_code=400)
+
+    user_id = await run_in_threadpool(resolve_user, username)
+
+    queue = hub.subscribe()
+
+    async def generate():
+        nonlocal user_id
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=flask_app.EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                if message is None:
+                    return
+
+                # Opening the stream does not create the user, its first write does
+                if user_id is None and message.get("event") in ("favorites", "votes"):
+                    user_id = await run_in_threadpool(resolve_user, username)
+
+                event = flask_app.event_for(message, user_id)
+                if event is None:
+                    continue
+
+                yield flask_app.format_event(*event)
+        finally:
+            hub.unsubscribe(queue)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=headers)
+
+#####################################
+
+@asynccontextmanager
+async def lifespan(application):
+    yield
+    await hub.close()
+    await tmdb.close()
+
+
+routes = [
+    Route("/api/v1/search", search),
+    Route("/api/v1/genres", genres),
+    Route("/api/v1/languages", languages),
+    Route("/api/v1/regions", regions),
+    Route("/api/v1/trending/movies", trending_movies),
+    Route("/api/v1/movie/{movie_id:int}", movie_detail),
+    Route("/api/v1/movie/{movie_id:int}/credits", movie_credits),
+    Route("/api/v1/movie/{movie_id:int}/videos", movie_videos),
+    Route("/api/v1/trending/tv", trending_tv),
+    Route("/api/v1/tv/{tv_id:int}", tv_detail),
+    Route("/api/v1/tv/{tv_id:int}/credits", tv_credits),
+    Route("/api/v1/discover/upcoming", discover_upcoming),
+    Route("/api/v1/discover/popular", discover_popular),
+    Route("/api/v1/discover/top_rated", discover_top_rated),
+    Route("/api/v1/discover/family_animation", discover_family_animation),
+    Route("/api/v1/discover/horror", discover_horror),
+    Route("/api/v1/batch/details", batch_details),
+    Route("/api/v1/home", home),
+    Route("/api/v1/events", events),
+
+    # Web pages, favorites, Swagger docs and everything else
+    Mount("/", app=WSGIMiddleware(flask_app.app)),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
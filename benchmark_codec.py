@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: compare cache codecs on a trending/discover sized payload
+
+# Usage:
+#
+#   python benchmark_codec.py                      # synthetic 100-item list
+#   python benchmark_codec.py --file trending.json # a saved TMDb response
+#   python benchmark_codec.py --redis              # also report Redis MEMORY USAGE
+
+import sys
+import time
+import json
+import random
+import argparse
+
+import cache_codec
+
+
+def synthetic_payload(count=100):
+    """
+        A list shaped like a TMDb discover/trending result.
+    """
+
+    random.seed(42)
+    words = ["the", "night", "return", "of", "lost", "city", "dark", "summer",
+             "love", "war", "last", "dream", "family", "house", "secret", "light"]
+
+    items = []
+    for i in range(count):
+        items.append({
+            "adult": False,
+            "backdrop_path": f"/{random.getrandbits(64):x}backdrop.jpg",
+            "genre_ids": random.sample([28, 12, 16, 35, 80, 18, 10751, 14, 27, 878], 3),
+            "id": 100000 + i,
+            "original_language": "en",
+            "original_title": " ".join(random.choices(words, k=3)).title(),
+            "overview": " ".join(random.choices(words, k=60)).capitalize() + ".",
+            "popularity": round(random.uniform(10, 900), 3),
+            "poster_path": f"/{random.getrandbits(64):x}poster.jpg",
+            "release_date": f"2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+            "title": " ".join(random.choices(words, k=3)).title(),
+            "video": False,
+            "vote_average": round(random.uniform(4, 9), 3),
+            "vote_count": random.randint(0, 20000),
+        })
+
+    return {"data": items, "fresh_until": time.time() + 600}
+
+
+def bench(codec, data, iterations):
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encoded = codec.encode(data)
+    encode_ms = (time.perf_counter() - start) * 1000 / iterations
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        cache_codec.decode(encoded)
+    decode_ms = (time.perf_counter() - start) * 1000 / iterations
+
+    return encoded, encode_ms, decode_ms
+
+
+def redis_memory(encoded):
+
+    import models_redis
+
+    key = f"{models_redis.KEY_PREFIX}:benchmark"
+    models_redis.r.set(key, encoded, ex=60)
+    usage = models_redis.r.memory_usage(key)
+    models_redis.r.delete(key)
+
+    return usage
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark cache codecs")
+    parser.add_argument("--file", help="JSON file with a cached payload")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--redis", action="store_true", help="measure Redis MEMORY USAGE")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file) as f:
+            data = {"data": json.load(f), "fresh_until": time.time() + 600}
+    else:
+        data = synthetic_payload()
+
+    legacy = json.dumps(data).encode("utf-8")
+
+    rows = []
+
+    # Baseline: the plain json.dumps format used before the codec layer
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        legacy = json.dumps(data).encode("utf-8")
+    encode_ms = (time.perf_counter() - start) * 1000 / args.iterations
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        json.loads(legacy)
+    decode_ms = (time.perf_counter() - start) * 1000 / args.iterations
+    rows.append(("legacy json", legacy, encode_ms, decode_ms))
+
+    for serializer, (_, _, _, s_available) in cache_codec.SERIALIZERS.items():
+        for compressor, (_, _, _, c_available) in cache_codec.COMPRESSORS.items():
+            if not (s_available and c_available):
+                continue
+            codec = cache_codec.Codec(serializer, compressor)
+            encoded, encode_ms, decode_ms = bench(codec, data, args.iterations)
+            rows.append((f"{serializer}+{compressor}", encoded, encode_ms, decode_ms))
+
+    header = f"{'codec':<16} {'bytes':>8} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}"
+    if args.redis:
+        header += f" {'redis bytes':>12}"
+    print(header)
+    print("-" * len(header))
+
+    for name, encoded, encode_ms, decode_ms in rows:
+        line = f"{name:<16} {len(encoded):>8} {len(encoded) / len(legacy):>6.2f} {encode_ms:>10.3f} {decode_ms:>10.3f}"
+        if args.redis:
+            line += f" {redis_memory(encoded):>12}"
+        print(line)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
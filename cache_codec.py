@@ -0,0 +1,150 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: pluggable serialization and compression for Redis payloads
+
+# Encoded layout:
+#
+#   | byte 0         | byte 1        | byte 2          | rest    |
+#   |----------------|---------------|-----------------|---------|
+#   | format version | serializer id | compressor id   | payload |
+#
+# Values written before this layer existed are plain JSON text. They start
+# with '{' or '[' and are still decoded, so switching codecs never
+# invalidates what is already in Redis.
+
+import os
+import json
+import zlib
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+logging.basicConfig(level=logging.INFO)
+
+FORMAT_VERSION = 1
+
+# Payloads smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = int(os.getenv('CACHE_COMPRESS_MIN_BYTES', '1024'))
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(payload):
+    return json.loads(payload)
+
+
+def _msgpack_dumps(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _msgpack_loads(payload):
+    return msgpack.unpackb(payload, raw=False)
+
+
+# name -> (id, dumps, loads, available)
+SERIALIZERS = {
+    "json": (1, _json_dumps, _json_loads, True),
+    "msgpack": (2, _msgpack_dumps, _msgpack_loads, msgpack is not None),
+}
+
+# name -> (id, compress, decompress, available)
+COMPRESSORS = {
+    "none": (0, None, None, True),
+    "zlib": (1, lambda b: zlib.compress(b, 6), zlib.decompress, True),
+    "zstd": (2,
+             lambda b: zstandard.ZstdCompressor(level=3).compress(b),
+             lambda b: zstandard.ZstdDecompressor().decompress(b),
+             zstandard is not None),
+    "lz4": (3,
+            lambda b: lz4.frame.compress(b),
+            lambda b: lz4.frame.decompress(b),
+            lz4 is not None),
+}
+
+_serializers_by_id = {v[0]: v for v in SERIALIZERS.values()}
+_compressors_by_id = {v[0]: v for v in COMPRESSORS.values()}
+
+
+class Codec():
+
+    def __init__(self, serializer="json", compressor="none", compress_min_bytes=COMPRESS_MIN_BYTES):
+
+        if serializer not in SERIALIZERS or not SERIALIZERS[serializer][3]:
+            logging.error(f"Cache serializer '{serializer}' is not available, using json")
+            serializer = "json"
+
+        if compressor not in COMPRESSORS or not COMPRESSORS[compressor][3]:
+            logging.error(f"Cache compressor '{compressor}' is not available, using none")
+            compressor = "none"
+
+        self.serializer = serializer
+        self.compressor = compressor
+        self.compress_min_bytes = compress_min_bytes
+
+
+    def __repr__(self):
+        return f"<Codec serializer={self.serializer} compressor={self.compressor}>"
+
+
+    def encode(self, data):
+
+        serializer_id, dumps, _, _ = SERIALIZERS[self.serializer]
+        compressor_id, compress, _, _ = COMPRESSORS[self.compressor]
+
+        payload = dumps(data)
+
+        if compress is None or len(payload) < self.compress_min_bytes:
+            compressor_id = 0
+        else:
+            payload = compress(payload)
+
+        return bytes((FORMAT_VERSION, serializer_id, compressor_id)) + payload
+
+
+def decode(value):
+    """
+        Decode a value written by any Codec, or a legacy plain-JSON value.
+    """
+
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+
+    if not value or value[0] != FORMAT_VERSION:
+        return json.loads(value)
+
+    serializer_id, compressor_id = value[1], value[2]
+    payload = value[3:]
+
+    if compressor_id not in _compressors_by_id or serializer_id not in _serializers_by_id:
+        raise ValueError(f"Unknown cache encoding: serializer={serializer_id} compressor={compressor_id}")
+
+    _, _, decompress, available = _compressors_by_id[compressor_id]
+    if decompress:
+        if not available:
+            raise ValueError(f"Compressor id {compressor_id} is not installed")
+        payload = decompress(payload)
+
+    _, _, loads, available = _serializers_by_id[serializer_id]
+    if not available:
+        raise ValueError(f"Serializer id {serializer_id} is not installed")
+
+    return loads(payload)
+
+
+default_codec = Codec(serializer=os.getenv('CACHE_SERIALIZER', 'json'),
+                      compressor=os.getenv('CACHE_COMPRESSOR', 'none'))
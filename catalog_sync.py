@@ -0,0 +1,312 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: bulk load and incremental sync of the local TMDb catalog mirror
+
+# Detail, credits and videos lookups are served from the catalog_titles table
+# (see models_sql.CatalogTitle). This script fills it and keeps it current:
+#
+#   python catalog_sync.py --bulk                    # mirror every favorited, watched or voted title
+#   python catalog_sync.py --ids movie:603,tv:1399   # mirror the given titles
+#   python catalog_sync.py                           # re-fetch the mirrored titles TMDb changed
+#
+# Run the sync daily from cron, TMDb's changes feeds cover at most 14 days:
+#
+#   30 3 * * * cd /opt/rp_cluster/moviepulse && venv/bin/python catalog_sync.py
+
+import os
+import sys
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from tmdb_client import TMDB_REST_API_Client, TMDB_URL
+from rest_client import PRIORITY_LOW
+import models_redis
+import models_sql
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("CATALOG_SYNC_WORKERS", "4"))
+BATCH_SIZE = int(os.getenv("CATALOG_BATCH_SIZE", "100"))
+
+# Longest window accepted by /movie/changes and /tv/changes
+CHANGES_MAX_DAYS = 14
+
+MEDIA_TYPES = ("movie", "tv")
+
+
+def parse_items(text):
+    """
+        "movie:603,tv:1399" -> [("movie", 603), ("tv", 1399)]
+    """
+
+    items = []
+    for token in text.split(","):
+        media_type, _, tmdb_id = token.strip().partition(":")
+        if media_type not in MEDIA_TYPES or not tmdb_id.isdigit():
+            raise ValueError(f"Invalid id '{token}', expected movie:<id> or tv:<id>")
+        items.append((media_type, int(tmdb_id)))
+
+    return items
+
+
+class Catalog_Sync():
+
+    def __init__(self, workers=WORKERS, batch_size=BATCH_SIZE):
+
+        self.tmdb = TMDB_REST_API_Client(url=TMDB_URL, api_ver="3", priority=PRIORITY_LOW)
+
+        self.workers = workers
+        self.batch_size = batch_size
+
+        # Cached client methods whose Redis entries a reload makes outdated
+        self.cached_methods = {
+            "movie": (TMDB_REST_API_Client.get_movie_detail,
+                      TMDB_REST_API_Client.get_movie_credit,
+                      TMDB_REST_API_Client.get_movie_video),
+            "tv": (TMDB_REST_API_Client.get_tv_detail,
+                   TMDB_REST_API_Client.get_tv_credit),
+        }
+
+
+    def fetch(self, item):
+
+        media_type, tmdb_id = item
+        status, output = self.tmdb.get_title_bundle(media_type, tmdb_id)
+
+        return item, status, output
+
+
+    def get_cache_keys(self, items):
+
+        return [method.cache_key(self.tmdb, tmdb_id, models_sql.CATALOG_LANGUAGE)
+                for media_type, tmdb_id in items
+                for method in self.cached_methods[media_type]]
+
+
+    def save(self, rows, items, deleted):
+        """
+            Write the fetched titles, drop the ones TMDb deleted, and make
+            the cache read them again. Deleted titles also lose their
+            last-known-good copies.
+        """
+
+        session = models_sql.Session()
+        try:
+            models_sql.save_catalog(session, rows)
+            for media_type in MEDIA_TYPES:
+                models_sql.delete_catalog(session, media_type,
+                                          [tmdb_id for item_type, tmdb_id in deleted if item_type == media_type])
+            session.commit()
+        finally:
+            models_sql.Session.remove()
+
+        keys = self.get_cache_keys(items)
+        for key in self.get_cache_keys(deleted):
+            keys.extend((key, models_redis.lkg_key(key)))
+        models_redis.invalidate(keys)
+
+
+    def load(self, items):
+        """
+            Fetch the detail, credits and videos of each (media_type, tmdb_id)
+            with one request per title, and write them in batches. Titles
+            TMDb deleted (404) or marked adult are removed from the mirror.
+            Returns (status, {"loaded": n, "deleted": n, "failed": [items]}),
+            status is False only when the database write failed.
+        """
+
+        result = {"loaded": 0, "deleted": 0, "failed": []}
+
+        for start in range(0, len(items), self.batch_size):
+
+            batch = items[start:start + self.batch_size]
+            rows = []
+            saved = []
+            deleted = []
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for item, status, output in executor.map(self.fetch, batch):
+                    media_type, tmdb_id = item
+                    if not status:
+                        log.error(f"Cannot fetch {media_type}:{tmdb_id}: {output}")
+                        result["failed"].append(item)
+                        continue
+                    if output is None:
+                        log.info(f"{media_type}:{tmdb_id} is gone from TMDb, removing it.")
+                        deleted.append(item)
+                        continue
+                    rows.append({"tmdb_id": tmdb_id, "media_type": media_type, **output})
+                    saved.append(item)
+
+            try:
+                self.save(rows, saved, deleted)
+            except Exception as E:
+                return False, str(E)
+
+            result["loaded"] += len(rows)
+            result["deleted"] += len(deleted)
+            log.info(f"Loaded {result['loaded']}/{len(items)} titles.")
+
+        return True, result
+
+
+    def get_referenced(self, session):
+        """
+            Every title a user favorited, watched or voted for.
+        """
+
+        items = set()
+
+        for model in (models_sql.Favorite, models_sql.WatchHistory, models_sql.Vote, models_sql.MediaMetadata):
+            rows = session.query(model.media_type, model.tmdb_id) \
+                          .filter(model.media_type.in_(MEDIA_TYPES)) \
+                          .distinct() \
+                          .all()
+            items.update((row.media_type, row.tmdb_id) for row in rows)
+
+        return items
+
+
+    def bulk(self, reload=False):
+        """
+            Initial load: mirror the referenced titles, skipping the ones
+            already mirrored unless reload is set.
+        """
+
+        session = models_sql.Session()
+        try:
+            items = self.get_referenced(session)
+            if not reload:
+                for media_type in MEDIA_TYPES:
+                    mirrored = models_sql.list_catalog_ids(session, media_type)
+                    items -= {(media_type, tmdb_id) for tmdb_id in mirrored}
+        finally:
+            models_sql.Session.remove()
+
+        return self.load(sorted(items))
+
+
+    def sync_media_type(self, media_type, now):
+        """
+            Re-fetch the mirrored titles listed in the changes feed since the
+            last sync, and the ones whose re-fetch failed last time. When the
+            last sync is older than the feed reaches back, titles not
+            refreshed since then are re-fetched too.
+
+            Titles that fail again are marked for the next run, and the
+            window still moves forward, so one failing title cannot hold
+            the sync back.
+        """
+
+        session = models_sql.Session()
+        try:
+            synced_until = models_sql.get_synced_until(session, media_type)
+            mirrored = models_sql.list_catalog_ids(session, media_type)
+            retry = models_sql.list_catalog_retry(session, media_type)
+
+            oldest = now - timedelta(days=CHANGES_MAX_DAYS)
+            start = synced_until or now - timedelta(days=1)
+
+            outdated = set()
+            if start < oldest:
+                start = oldest
+                rows = session.query(models_sql.CatalogTitle.tmdb_id) \
+                              .filter(models_sql.CatalogTitle.media_type == media_type) \
+                              .filter(models_sql.CatalogTitle.synced_at < oldest) \
+                              .all()
+                outdated = {row.tmdb_id for row in rows}
+        finally:
+            models_sql.Session.remove()
+
+        status, changed = self.tmdb.get_changes(media_type, start.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d"))
+        if not status:
+            return False, changed
+
+        items = [(media_type, tmdb_id) for tmdb_id in sorted((changed & mirrored) | outdated | retry)]
+
+        status, output = self.load(items)
+        if not status:
+            # The next run covers the same window again
+            return False, output
+
+        session = models_sql.Session()
+        try:
+            models_sql.mark_catalog_retry(session, media_type, [tmdb_id for _, tmdb_id in output["failed"]])
+            models_sql.set_synced_until(session, media_type, now)
+            session.commit()
+        finally:
+            models_sql.Session.remove()
+
+        return True, output
+
+
+    def sync(self):
+        """
+            Sync each media type on its own, a failing one does not hold
+            back the others.
+        """
+
+        now = datetime.now(timezone.utc)
+
+        result = {"loaded": 0, "deleted": 0, "failed": []}
+        errors = []
+
+        for media_type in MEDIA_TYPES:
+
+            status, output = self.sync_media_type(media_type, now)
+            if not status:
+                errors.append(f"Cannot sync {media_type}: {output}")
+                continue
+
+            result["loaded"] += output["loaded"]
+            result["deleted"] += output["deleted"]
+            result["failed"].extend(output["failed"])
+
+        if errors:
+            return False, "; ".join(errors)
+
+        return True, result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fill and sync the local TMDb catalog mirror")
+    parser.add_argument("--bulk", action="store_true", help="mirror every favorited, watched or voted title")
+    parser.add_argument("--reload", action="store_true", help="with --bulk, re-fetch titles already mirrored")
+    parser.add_argument("--ids", help="mirror the given titles, e.g. movie:603,tv:1399")
+    args = parser.parse_args()
+
+    syncer = Catalog_Sync()
+
+    if args.ids:
+        try:
+            items = parse_items(args.ids)
+        except ValueError as E:
+            log.error(E)
+            return 2
+        status, output = syncer.load(items)
+    elif args.bulk:
+        status, output = syncer.bulk(reload=args.reload)
+    else:
+        status, output = syncer.sync()
+
+    if not status:
+        log.error(output)
+        return 2
+
+    log.info(f"Mirrored {output['loaded']} titles, removed {output['deleted']} deleted ones.")
+
+    if output["failed"]:
+        failed = ", ".join(f"{media_type}:{tmdb_id}" for media_type, tmdb_id in output["failed"])
+        log.error(f"Cannot fetch {len(output['failed'])} titles: {failed}")
+        return 2
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -16,10 +16,14 @@ import getpass
 import logging
 
 from rest_client import REST_API_Client
+import models_redis
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 log = logging.getLogger(__name__)
 
+# Discord posts are few, so a handful of failures is enough to stop trying for a while
+DISCORD_BREAKER = models_redis.Circuit_Breaker("discord", min_calls=5, open_for=60, slow_call=10)
+
 
 class Discord_Webhook(REST_API_Client):
 
@@ -27,9 +31,11 @@ class Discord_Webhook(REST_API_Client):
                  url,
                  api_ver=None,
                  base=None,
-                 user=getpass.getuser()):
+                 user=getpass.getuser(),
+                 breaker=DISCORD_BREAKER,
+                 **kwargs):
 
-        super().__init__(url, api_ver, base, user)
+        super().__init__(url, api_ver, base, user, breaker=breaker, **kwargs)
 
         self.webhook_id = os.getenv('WEBHOOK_ID', None)
         self.webhook_token = os.getenv('WEBHOOK_TOKEN', None)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: load test comparing the WSGI (app:app) and ASGI (asgi:app) entry points
+
+# A fake TMDb with a fixed latency makes the comparison independent of the
+# real API and of the cache. Every request uses a new id ({n}), so each one
+# is a cache miss that waits on the upstream:
+#
+#   python loadtest.py mock --port 9000 --delay 0.5
+#
+#   TMDB_URL=http://127.0.0.1:9000 gunicorn --workers 1 --bind 127.0.0.1:8000 app:app
+#   TMDB_URL=http://127.0.0.1:9000 uvicorn asgi:app --workers 1 --port 8001
+#
+#   python loadtest.py run --url "http://127.0.0.1:8000/api/v1/movie/{n}" --upstream-delay 0.5
+#   python loadtest.py run --url "http://127.0.0.1:8001/api/v1/movie/{n}" --upstream-delay 0.5
+
+import sys
+import time
+import asyncio
+import argparse
+import itertools
+import statistics
+
+import httpx
+
+
+def mock(port, delay):
+    """
+        Answer every path like a single-page TMDb response, after delay seconds.
+    """
+
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    async def endpoint(request):
+        await asyncio.sleep(delay)
+        return JSONResponse({
+            "id": 1,
+            "title": "Mock",
+            "results": [{"id": i, "title": f"Mock {i}"} for i in range(20)],
+            "total_pages": 1
+        })
+
+    app = Starlette(routes=[Route("/{path:path}", endpoint)])
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def run(url, concurrency, requests, timeout):
+
+    counter = itertools.count(1)
+    latencies = []
+    errors = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+
+        async def worker():
+            nonlocal errors
+            while True:
+                n = next(counter)
+                if n > requests:
+                    return
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url.replace("{n}", str(n)))
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        wall = time.perf_counter() - start
+
+    return latencies, errors, wall
+
+
+def report(latencies, errors, wall, upstream_delay):
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    rps = len(latencies) / wall
+
+    print(f"requests     {len(latencies)} ({errors} errors) in {wall:.2f}s")
+    print(f"throughput   {rps:.1f} req/s")
+    print(f"latency ms   p50={percentile(0.50):.0f} p95={percentile(0.95):.0f} "
+          f"p99={percentile(0.99):.0f} mean={statistics.mean(latencies) * 1000:.0f}")
+
+    if upstream_delay:
+        # Little's law: requests in flight = arrival rate x time each one spends upstream
+        print(f"concurrency  {rps * upstream_delay:.1f} upstream requests in flight on average")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="MoviePulse load test")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_mock = sub.add_parser("mock", help="run a fake TMDb with fixed latency")
+    p_mock.add_argument("--port", type=int, default=9000)
+    p_mock.add_argument("--delay", type=float, default=0.5)
+
+    p_run = sub.add_parser("run", help="send requests and report throughput")
+    p_run.add_argument("--url", required=True, help="{n} is replaced by a unique number per request")
+    p_run.add_argument("--concurrency", type=int, default=50)
+    p_run.add_argument("--requests", type=int, default=500)
+    p_run.add_argument("--timeout", type=float, default=60)
+    p_run.add_argument("--upstream-delay", type=float, default=None,
+                       help="mock delay, used to estimate concurrent requests per worker")
+
+    args = parser.parse_args()
+
+    if args.command == "mock":
+        mock(args.port, args.delay)
+        return 0
+
+    latencies, errors, wall = asyncio.run(run(args.url, args.concurrency, args.requests, args.timeout))
+    report(latencies, errors, wall, args.upstream_delay)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
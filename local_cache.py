@@ -0,0 +1,102 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: in-process LRU cache, used as L1 in front of Redis
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRU_Cache():
+    """
+        Thread-safe LRU cache bounded by entry count and total payload bytes.
+        Each entry carries its own expiry, so the L1 copy never outlives the
+        TTL of the Redis entry it was read from.
+
+        Values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.entries = OrderedDict()    # key -> (value, size, expires_at)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key):
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, _, expires_at = entry
+            if expires_at <= time.monotonic():
+                self.__remove(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def set(self, key, value, size, ttl):
+
+        if ttl <= 0 or size > self.max_bytes:
+            self.delete(key)
+            return
+
+        with self.lock:
+
+            if key in self.entries:
+                self.__remove(key)
+
+            self.entries[key] = (value, size, time.monotonic() + ttl)
+            self.total_bytes += size
+
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.__remove(oldest)
+                self.evictions += 1
+
+
+    def delete(self, key):
+
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+    def stats(self):
+
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+    def __remove(self, key):
+
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
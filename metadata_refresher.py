@@ -0,0 +1,121 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: refresh the local metadata of favorited movies and TV shows
+
+# Run on a schedule, for example hourly from cron:
+#
+#   0 * * * * cd /opt/rp_cluster/moviepulse && venv/bin/python metadata_refresher.py
+
+import os
+import sys
+import logging
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from tmdb_client import TMDB_REST_API_Client, TMDB_URL
+from rest_client import PRIORITY_LOW
+import models_sql
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+MAX_AGE_HOURS = float(os.getenv("METADATA_MAX_AGE_HOURS", "24"))
+BATCH_SIZE = int(os.getenv("METADATA_BATCH_SIZE", "500"))
+WORKERS = int(os.getenv("METADATA_REFRESH_WORKERS", "4"))
+
+
+class Metadata_Refresher():
+
+    def __init__(self, max_age_hours=MAX_AGE_HOURS, batch_size=BATCH_SIZE, workers=WORKERS):
+
+        self.tmdb = TMDB_REST_API_Client(url=TMDB_URL, api_ver="3", priority=PRIORITY_LOW)
+
+        self.max_age = timedelta(hours=max_age_hours)
+        self.batch_size = batch_size
+        self.workers = workers
+
+        self.detail_methods = {
+            "movie": self.tmdb.get_movie_detail,
+            "tv": self.tmdb.get_tv_detail,
+        }
+
+
+    def get_outdated(self, session):
+        """
+            Favorited items with no metadata or metadata older than max_age,
+            missing ones first, then the oldest.
+        """
+
+        Favorite = models_sql.Favorite
+        Metadata = models_sql.MediaMetadata
+
+        cutoff = datetime.now(timezone.utc) - self.max_age
+
+        rows = session.query(Favorite.media_type, Favorite.tmdb_id) \
+                      .outerjoin(Metadata, (Metadata.tmdb_id == Favorite.tmdb_id) &
+                                           (Metadata.media_type == Favorite.media_type)) \
+                      .filter(Favorite.media_type.in_(self.detail_methods)) \
+                      .filter((Metadata.updated_at == None) | (Metadata.updated_at < cutoff)) \
+                      .group_by(Favorite.media_type, Favorite.tmdb_id, Metadata.updated_at) \
+                      .order_by(Metadata.updated_at.asc().nulls_first()) \
+                      .limit(self.batch_size) \
+                      .all()
+
+        return [(row.media_type, row.tmdb_id) for row in rows]
+
+
+    def fetch(self, item):
+
+        media_type, tmdb_id = item
+        status, output = self.detail_methods[media_type](tmdb_id)
+
+        return item, status, output
+
+
+    def refresh(self):
+
+        session = models_sql.Session()
+
+        try:
+            items = self.get_outdated(session)
+            if not items:
+                log.info("Metadata is up to date.")
+                return True, 0
+
+            # End the read transaction, no connection is held while TMDb answers
+            session.commit()
+
+            rows = []
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for (media_type, tmdb_id), status, output in executor.map(self.fetch, items):
+                    if not status:
+                        log.error(f"Cannot refresh {media_type}:{tmdb_id}: {output}")
+                        continue
+                    rows.append(models_sql.metadata_from_detail(media_type, output))
+
+            models_sql.save_metadata(session, rows)
+            session.commit()
+
+            refreshed = len(rows)
+
+        except Exception as E:
+            session.rollback()
+            return False, str(E)
+
+        finally:
+            models_sql.Session.remove()
+
+        log.info(f"Refreshed metadata of {refreshed}/{len(items)} items.")
+
+        return True, refreshed
+
+
+if __name__ == "__main__":
+
+    refresher = Metadata_Refresher()
+
+    status, output = refresher.refresh()
+    if not status:
+        log.error(output)
+        sys.exit(2)
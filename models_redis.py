@@ -1,68 +1,1323 @@
-
 # Author: Mani Amoozadeh
 # Email: mani.amoozadeh2@gmail.com
 # Description: model for interacting with Redis
 
+import os
 import redis
 import json
-import re
+import time
+import uuid
+import random
+import socket
+import hashlib
 import inspect
+import functools
+import threading
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from local_cache import LRU_Cache
+import cache_codec
+import rest_client
 
 logging.basicConfig(level=logging.INFO)
 
 r = redis.Redis(host='localhost', port=6379, db=0)
 
-def sanitize_key(key_str):
+# Bump when the key or value layout changes, so old entries are never misread
+KEY_PREFIX = "moviepulse:v2"
 
-    key_str = key_str.replace(" ", "_")  # Replace spaces
-    key_str = re.sub(r"[^\w:\-\.]", "_", key_str)  # Keep alphanumerics, :, -, _
-    return key_str
+DEFAULT_TTL = 600
 
+# In-process L1 cache, one per gunicorn worker
+L1_MAX_ENTRIES = int(os.getenv('L1_MAX_ENTRIES', '256'))
+L1_MAX_BYTES = int(os.getenv('L1_MAX_BYTES', str(32 * 1024 * 1024)))
+L1_MAX_TTL = int(os.getenv('L1_MAX_TTL', '60'))
 
-def get_key(frame):
+INVALIDATION_CHANNEL = f"{KEY_PREFIX}:invalidate"
 
-    method_name = frame.f_code.co_name
+# Favorite and vote changes, streamed to browsers by asgi.py (/api/v1/events)
+EVENTS_CHANNEL = f"{KEY_PREFIX}:events"
 
-    args_info = inspect.getargvalues(frame)
+l1 = LRU_Cache(max_entries=L1_MAX_ENTRIES, max_bytes=L1_MAX_BYTES)
 
-    params = {arg: args_info.locals[arg] for arg in args_info.args if arg != 'self'}
+_subscriber_pid = None
+_subscriber_lock = threading.Lock()
 
-    # Include *args and **kwargs if they exist
-    if args_info.varargs and args_info.locals.get(args_info.varargs):
-        params[f"*{args_info.varargs}"] = args_info.locals[args_info.varargs]
-    if args_info.keywords and args_info.locals.get(args_info.keywords):
-        params[f"**{args_info.keywords}"] = args_info.locals[args_info.keywords]
+# Single-flight: one worker fetches a missing key, the others wait for it
+LOCK_LEASE_MS = int(os.getenv('CACHE_LOCK_LEASE_MS', '15000'))
+LOCK_WAIT = float(os.getenv('CACHE_LOCK_WAIT', '10'))
+LOCK_POLL = 0.05
 
-    # Convert params to a readable string
-    param_str = ",".join(f"{k}={v}" for k, v in params.items())
+STATS_KEY = f"{KEY_PREFIX}:stats:singleflight"
 
-    key_str = f"{method_name}:{param_str}"
+# Stale-while-revalidate: entries are fresh for ttl, then served stale for
+# stale_ttl more while a background worker refreshes them
+REFRESH_WORKERS = int(os.getenv('CACHE_REFRESH_WORKERS', '2'))
+REFRESH_AHEAD = float(os.getenv('CACHE_REFRESH_AHEAD', '0.2'))
+REFRESH_AHEAD_MIN_HITS = int(os.getenv('CACHE_REFRESH_AHEAD_MIN_HITS', '5'))
 
-    return sanitize_key(key_str)
+# Last known good: a copy of each @cached entry kept this long in a shadow
+# key, served when the upstream fails (e.g. while its circuit breaker is open)
+LKG_TTL = int(os.getenv('CACHE_LKG_TTL', str(7 * 24 * 3600)))
 
+_refresh_executor = None
+_refresh_pid = None
+_refresh_lock = threading.Lock()
+_refreshing = set()
+_hit_counts = {}
 
-def get_from_cache(frame):
+# Set by collect_keys() while recording which keys a call would read
+_recording = threading.local()
 
-    key = get_key(frame)
-    val = r.get(key)
-    if val:
-        return json.loads(val)
-    return None
+# Delete the lock only if we still own it, the lease may have expired
+RELEASE_LOCK_SCRIPT = r.register_script("""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+""")
+
+
+def make_key(namespace, params):
+    """
+        Build a stable cache key from a namespace and a dict of call arguments.
+        Arguments are serialized with sorted keys and hashed, so the key length
+        does not depend on the arguments and needs no sanitizing.
+    """
+
+    payload = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    return f"{KEY_PREFIX}:{namespace}:{digest}"
+
+
+def get_entry(key):
+    """
+        Look the key up in the in-process L1 first, then in Redis.
+        Returns the stored envelope {"data": ..., "fresh_until": ...} or None.
+        An L1 copy expires no later than the Redis entry it was read from,
+        and at most L1_MAX_TTL seconds after it was read.
+    """
+
+    start_invalidation_listener()
+
+    entry = l1.get(key)
+    if entry is not None:
+        return entry
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        raw, pttl = pipe.execute()
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None
+
+    if raw is None:
+        return None
+
+    try:
+        entry = cache_codec.decode(raw)
+    except Exception as e:
+        logging.error(f"Cannot decode cache entry {key}: {e}")
+        return None
+
+    if pttl and pttl > 0:
+        l1.set(key, entry, len(raw), min(pttl / 1000, L1_MAX_TTL))
+
+    return entry
+
+
+def get_from_cache(key):
+    """
+        Return the cached data for key, fresh or stale, or None.
+    """
+
+    entry = get_entry(key)
+    if entry is None:
+        return None
 
+    return entry["data"]
 
-def set_to_cache(frame, data, ttl=600):
+
+def lkg_key(key):
+    return f"{key}:lkg"
+
+
+def set_to_cache(key, data, ttl=DEFAULT_TTL, stale_ttl=0, lkg_ttl=0, validators=None):
     """
-        Default ttl is 600 seconds = 10 minutes
+        Default ttl is 600 seconds = 10 minutes.
+        The entry is fresh for ttl seconds and kept stale_ttl seconds more.
+        With lkg_ttl, a shadow copy is kept that long as last known good.
     """
 
+    start_invalidation_listener()
+
+    entry = {
+        "data": data,
+        "fresh_until": time.time() + ttl
+    }
+
+    if validators:
+        entry["validators"] = validators
+
+    hard_ttl = ttl + stale_ttl
+
     try:
-        key = get_key(frame)
-        value = json.dumps(data)
-        r.set(key, value, ex=ttl)
+        value = cache_codec.default_codec.encode(entry)
+        pipe = r.pipeline(transaction=False)
+        pipe.set(key, value, ex=hard_ttl)
+        if lkg_ttl:
+            pipe.set(lkg_key(key), value, ex=lkg_ttl)
+        pipe.execute()
     except redis.RedisError as e:
         logging.error(f"Redis error: {e}")
+        return
     except (TypeError, ValueError) as e:
         logging.error(f"Serialization error: {e}")
+        return
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
+        return
+
+    l1.set(key, entry, len(value), min(hard_ttl, L1_MAX_TTL))
+
+    # Other workers may hold an older copy of this key
+    publish_invalidation([key])
+
+
+def get_last_known_good(key):
+    """
+        Return the shadow copy of key, however old, or None.
+    """
+
+    try:
+        raw = r.get(lkg_key(key))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None
+
+    if raw is None:
+        return None
+
+    try:
+        return cache_codec.decode(raw)["data"]
+    except Exception as e:
+        logging.error(f"Cannot decode cache entry {key}: {e}")
+        return None
+
+
+def with_last_known_good(key, status, output):
+    """
+        Replace a failed (status, output) by the last known good data of key.
+    """
+
+    if status:
+        return status, output
+
+    data = get_last_known_good(key)
+    if data is None:
+        return status, output
+
+    logging.warning(f"Serving last known good {key}: {output}")
+    count_breaker("cache", "lkg")
+
+    return True, data
+
+
+def prefetch(keys):
+    """
+        Warm the L1 cache for many keys with a single pipelined round-trip.
+        Keys already in L1 are skipped, missing keys are left to the caller.
+    """
+
+    start_invalidation_listener()
+
+    keys = [key for key in dict.fromkeys(keys) if l1.get(key) is None]
+    if not keys:
+        return
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        replies = pipe.execute()
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return
+
+    for key, raw, pttl in zip(keys, replies[0::2], replies[1::2]):
+
+        if raw is None or not pttl or pttl <= 0:
+            continue
+
+        try:
+            entry = cache_codec.decode(raw)
+        except Exception as e:
+            logging.error(f"Cannot decode cache entry {key}: {e}")
+            continue
+
+        l1.set(key, entry, len(raw), min(pttl / 1000, L1_MAX_TTL))
+
+
+def collect_keys(fn):
+    """
+        Return the cache keys fn() would read, without fetching anything.
+        While recording, @cached methods note their key and return an empty
+        list instead of reading the cache or calling the upstream API.
+    """
+
+    _recording.keys = []
+
+    try:
+        fn()
+        return _recording.keys
+    finally:
+        _recording.keys = None
+
+
+def invalidate(keys):
+    """
+        Drop keys from Redis and from the L1 cache of every worker.
+    """
+
+    for key in keys:
+        l1.delete(key)
+
+    try:
+        r.delete(*keys)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+    publish_invalidation(keys)
+
+
+##########################################
+####### L1 invalidation via pub/sub ######
+##########################################
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def publish_invalidation(keys):
+
+    message = json.dumps({"origin": worker_id(), "keys": list(keys)})
+
+    try:
+        r.publish(INVALIDATION_CHANNEL, message)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def publish_event(event, data):
+    """
+        Publish a change for the open event streams of all workers.
+    """
+
+    message = json.dumps({"event": event, "data": data})
+
+    try:
+        r.publish(EVENTS_CHANNEL, message)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def start_invalidation_listener():
+    """
+        Start the pub/sub listener thread of this process, once.
+        Gunicorn forks workers after import, so this runs lazily on first
+        use and again if the pid has changed.
+    """
+
+    global _subscriber_pid
+
+    if _subscriber_pid == os.getpid():
+        return
+
+    with _subscriber_lock:
+
+        if _subscriber_pid == os.getpid():
+            return
+
+        _subscriber_pid = os.getpid()
+
+        # Anything inherited from the parent process may already be stale
+        l1.clear()
+
+        thread = threading.Thread(target=_invalidation_loop, name="l1-invalidation", daemon=True)
+        thread.start()
+
+
+def _invalidation_loop():
+
+    origin = worker_id()
+
+    while True:
+
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+
+            # Entries written while we were not subscribed may have been missed
+            l1.clear()
+
+            for message in pubsub.listen():
+                try:
+                    payload = json.loads(message["data"])
+                except (TypeError, ValueError):
+                    continue
+                if payload.get("origin") == origin:
+                    continue
+                for key in payload.get("keys", []):
+                    l1.delete(key)
+
+        except redis.RedisError as e:
+            logging.error(f"Redis invalidation listener error: {e}")
+            l1.clear()
+            time.sleep(5)
+
+
+def make_key_builder(func, namespace=None):
+    """
+        Return a function mapping a call of func to its cache key.
+        The signature is inspected once, arguments are bound per call.
+    """
+
+    signature = inspect.signature(func)
+    name = namespace or func.__name__
+
+    def cache_key(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = {k: v for k, v in bound.arguments.items() if k != "self"}
+        return make_key(name, params)
+
+    return cache_key
+
+
+def cached(ttl=DEFAULT_TTL, namespace=None, stale_ttl=None, lkg_ttl=LKG_TTL):
+    """
+        Cache the (status, output) result of a client method in Redis.
+
+        The signature is inspected once, at decoration time. On each call the
+        arguments are bound with defaults applied, so get_movie_detail(5) and
+        get_movie_detail(5, "en-US") map to the same entry. Only successful
+        results are cached. The key builder is exposed as wrapper.cache_key.
+
+        Entries are fresh for ttl seconds, then served stale for stale_ttl
+        more (default: ttl) while they are refreshed in the background.
+        Frequently read entries are refreshed ahead of expiry.
+
+        A shadow copy is kept lkg_ttl seconds (0 disables it). A miss whose
+        call fails is answered from it rather than with the error.
+    """
+
+    if stale_ttl is None:
+        stale_ttl = ttl
+
+    def decorator(func):
+
+        cache_key = make_key_builder(func, namespace)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            key = cache_key(*args, **kwargs)
+
+            recorded = getattr(_recording, "keys", None)
+            if recorded is not None:
+                recorded.append(key)
+                return True, []
+
+            loader = lambda: func(*args, **kwargs)
+
+            entry = get_entry(key)
+            if entry is not None:
+                fresh_for = entry["fresh_until"] - time.time()
+                if fresh_for <= 0 or (fresh_for < ttl * REFRESH_AHEAD and is_hot(key)):
+                    schedule_refresh(key, loader, ttl, stale_ttl, lkg_ttl)
+                return True, entry["data"]
+
+            status, output = load_coalesced(key, loader, ttl, stale_ttl, lkg_ttl)
+            if lkg_ttl:
+                return with_last_known_good(key, status, output)
+
+            return status, output
+
+        wrapper.cache_key = cache_key
+        wrapper.ttl = ttl
+        wrapper.stale_ttl = stale_ttl
+        wrapper.lkg_ttl = lkg_ttl
+
+        return wrapper
+
+    return decorator
+
+
+##########################################
+####### Single-flight cache loading ######
+##########################################
+
+def acquire_lease(key):
+    """
+        Try to take the refresh lease on key.
+        Returns the lease token, or None if another worker holds it.
+    """
+
+    token = uuid.uuid4().hex
+
+    if r.set(f"{key}:lock", token, nx=True, px=LOCK_LEASE_MS):
+        return token
+
+    return None
+
+
+def release_lease(key, token):
+
+    try:
+        RELEASE_LOCK_SCRIPT(keys=[f"{key}:lock"], args=[token])
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def load(loader, validators=None):
+    """
+        Run loader() and return (status, output, validators), the ETag and
+        Last-Modified of its response when it made a single request. With
+        validators, that request is revalidated and a 304 returns
+        (False, rest_client.NOT_MODIFIED, None).
+    """
+
+    with rest_client.conditional(validators) as seen:
+        status, output = loader()
+
+    return status, output, rest_client.single_validators(seen) if status else None
+
+
+def load_coalesced(key, loader, ttl=DEFAULT_TTL, stale_ttl=0, lkg_ttl=0):
+    """
+        Run loader() for a missing key in at most one worker at a time.
+
+        The worker that takes the Redis lease on the key becomes the leader,
+        runs the loader and stores the result. The others poll the cache
+        until the leader has stored it, and only run the loader themselves
+        if the leader failed or did not finish within LOCK_WAIT seconds.
+    """
+
+    try:
+        token = acquire_lease(key)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return loader()
+
+    if token:
+        count_singleflight("leader")
+        try:
+            status, output, validators = load(loader)
+            if status:
+                set_to_cache(key, output, ttl, stale_ttl, lkg_ttl, validators)
+            return status, output
+        finally:
+            release_lease(key, token)
+
+    deadline = time.monotonic() + LOCK_WAIT
+
+    while time.monotonic() < deadline:
+
+        time.sleep(LOCK_POLL)
+
+        cached_value = get_from_cache(key)
+        if cached_value is not None:
+            count_singleflight("coalesced")
+            return True, cached_value
+
+        try:
+            if not r.exists(f"{key}:lock"):
+                break   # leader gave up without storing a value
+        except redis.RedisError:
+            break
+
+    count_singleflight("fallthrough")
+
+    status, output, validators = load(loader)
+    if status:
+        set_to_cache(key, output, ttl, stale_ttl, lkg_ttl, validators)
+
+    return status, output
+
+
+def count_singleflight(field):
+
+    try:
+        r.hincrby(STATS_KEY, field, 1)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def get_singleflight_stats():
+    """
+        Coalescing and refresh counters, aggregated over all workers:
+            leader      - misses fetched by the lease holder
+            coalesced   - misses answered by waiting for the leader
+            fallthrough - misses fetched after the leader failed or timed out
+            refreshed   - stale or hot entries refreshed in the background
+            revalidated - stale or hot entries TMDb answered 304 Not Modified for
+    """
+
+    try:
+        stats = r.hgetall(STATS_KEY)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return {}
+
+    return {k.decode(): int(v) for k, v in stats.items()}
+
+
+##########################################
+####### Background refresh ###############
+##########################################
+
+def is_hot(key):
+    """
+        Count a read of key that landed in its refresh-ahead window, in
+        this worker. Reads while the entry is still well within its TTL
+        are not counted, so key is hot once it gets REFRESH_AHEAD_MIN_HITS
+        reads close to expiry. The count restarts after each background
+        refresh, and every count is dropped once more than 10000 keys are tracked.
+    """
+
+    if len(_hit_counts) > 10000:
+        _hit_counts.clear()
+
+    hits = _hit_counts.get(key, 0) + 1
+    _hit_counts[key] = hits
+
+    return hits >= REFRESH_AHEAD_MIN_HITS
+
+
+def schedule_refresh(key, loader, ttl, stale_ttl, lkg_ttl=0):
+    """
+        Refresh key on the background executor of this worker.
+        At most one refresh per key is queued per worker, and the Redis
+        lease makes sure only one worker in the cluster actually runs it.
+    """
+
+    global _refresh_executor, _refresh_pid
+
+    with _refresh_lock:
+
+        if _refresh_pid != os.getpid():
+            _refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS,
+                                                   thread_name_prefix="cache-refresh")
+            _refresh_pid = os.getpid()
+            _refreshing.clear()
+
+        if key in _refreshing:
+            return
+
+        _refreshing.add(key)
+
+    _refresh_executor.submit(_refresh, key, loader, ttl, stale_ttl, lkg_ttl)
+
+
+def _refresh(key, loader, ttl, stale_ttl, lkg_ttl=0):
+
+    try:
+        token = acquire_lease(key)
+        if not token:
+            return
+
+        try:
+            entry = get_entry(key)
+            validators = entry.get("validators") if entry else None
+
+            # Users are waiting on other requests, not on this one
+            with rest_client.low_priority():
+                status, output, new_validators = load(loader, validators)
+            if status:
+                set_to_cache(key, output, ttl, stale_ttl, lkg_ttl, new_validators)
+                count_singleflight("refreshed")
+            elif output == rest_client.NOT_MODIFIED and entry is not None:
+                # Unchanged upstream, the cached data is fresh again
+                set_to_cache(key, entry["data"], ttl, stale_ttl, lkg_ttl, validators)
+                count_singleflight("revalidated")
+            else:
+                logging.error(f"Background refresh of {key} failed: {output}")
+        finally:
+            release_lease(key, token)
+
+    except Exception as e:
+        logging.error(f"Background refresh of {key} failed: {e}")
+
+    finally:
+        _hit_counts.pop(key, None)
+        with _refresh_lock:
+            _refreshing.discard(key)
+
+
+##########################################
+####### Rate limiting ####################
+##########################################
+
+# Token bucket shared by every process, refilled at ARGV[1] tokens per second
+# up to ARGV[2]. A request of priority ARGV[3] > 0 leaves ARGV[4] tokens in
+# the bucket for high priority ones. Returns 0 when a token was taken,
+# otherwise the milliseconds to wait (also while a 429 cooldown is active).
+RATE_LIMIT_SCRIPT = r.register_script("""
+local cooldown = redis.call("PTTL", KEYS[2])
+if cooldown > 0 then
+    return cooldown
+end
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local reserve = 0
+if tonumber(ARGV[3]) > 0 then
+    reserve = tonumber(ARGV[4])
+end
+
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+
+local wait = 0
+if tokens >= 1 + reserve then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 + reserve - tokens) * 1000 / rate)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+
+return wait
+""")
+
+COOLDOWN_SCRIPT = r.register_script("""
+if redis.call("PTTL", KEYS[1]) < tonumber(ARGV[1]) then
+    redis.call("SET", KEYS[1], "1", "PX", ARGV[1])
+end
+return 1
+""")
+
+
+
+class Token_Bucket():
+    """
+        Request budget for one upstream, shared by all workers through Redis.
+        acquire() blocks until a token is free, at most max_wait seconds.
+        Low priority requests cannot take the last `reserve` tokens, so
+        user-facing requests go ahead of background work. cooldown()
+        pauses every caller, e.g. for the Retry-After of a 429.
+        Redis errors fail open.
+    """
+
+    def __init__(self, name, rate, burst, reserve=None, max_wait=10):
+
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.reserve = burst // 4 if reserve is None else reserve
+        self.max_wait = max_wait
+
+        self.bucket_key = f"{KEY_PREFIX}:ratelimit:{name}"
+        self.cooldown_key = f"{KEY_PREFIX}:ratelimit:{name}:cooldown"
+
+
+    def try_acquire(self, priority):
+        """
+            Take a token. Returns 0, or the milliseconds to wait before trying again.
+        """
+
+        try:
+            return RATE_LIMIT_SCRIPT(keys=[self.bucket_key, self.cooldown_key],
+                                     args=[self.rate, self.burst, priority, self.reserve])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return 0
+
+
+    def acquire(self, priority=0):
+
+        deadline = time.monotonic() + self.max_wait
+
+        wait = self.try_acquire(priority) / 1000
+        if wait <= 0:
+            return True
+
+        count_rate_limit(self.name, "delayed")
+
+        while True:
+
+            if time.monotonic() + wait > deadline:
+                count_rate_limit(self.name, "rejected")
+                return False
+
+            # Jitter, so waiting workers do not all retry at the same instant
+            time.sleep(wait * random.uniform(1, 1.2))
+
+            wait = self.try_acquire(priority) / 1000
+            if wait <= 0:
+                return True
+
+
+    def cooldown(self, seconds):
+        """
+            Pause the bucket for every process, never shortening a longer pause.
+        """
+
+        try:
+            COOLDOWN_SCRIPT(keys=[self.cooldown_key], args=[max(1, int(seconds * 1000))])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+
+        count_rate_limit(self.name, "throttled")
+
+
+RATE_LIMIT_STATS_KEY = f"{KEY_PREFIX}:stats:ratelimit"
+
+
+def count_rate_limit(name, field):
+
+    try:
+        r.hincrby(RATE_LIMIT_STATS_KEY, f"{name}:{field}", 1)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def get_rate_limit_stats():
+    """
+        Counters of all workers: requests delayed or rejected by a bucket,
+        and 429 responses that paused it.
+    """
+
+    try:
+        stats = r.hgetall(RATE_LIMIT_STATS_KEY)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return {}
+
+    return {k.decode(): int(v) for k, v in stats.items()}
+
+
+##########################################
+####### Circuit breaker ##################
+##########################################
+
+# Allow a request unless the breaker is open. Once the open period is over
+# (KEYS[1] expired while KEYS[2] is still set) one probe request at a time is
+# let through. Returns 0 to reject, 1 to allow, 2 to allow as the probe.
+BREAKER_ALLOW_SCRIPT = r.register_script("""
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+if redis.call("EXISTS", KEYS[2]) == 0 then
+    return 1
+end
+if redis.call("SET", KEYS[3], "1", "NX", "PX", ARGV[1]) then
+    return 2
+end
+return 0
+""")
+
+# Record the outcome of a request, ARGV[1] = 1 for a failed or slow one.
+# A probe closes the breaker or opens it again. Other requests are counted
+# in a window of ARGV[2] ms, which trips the breaker for ARGV[5] ms once it
+# holds at least ARGV[3] requests and a failure ratio of ARGV[4].
+# Returns 1 when the call opened the breaker, 2 when it closed it, else 0.
+BREAKER_RECORD_SCRIPT = r.register_script("""
+local failed = tonumber(ARGV[1]) == 1
+
+if tonumber(ARGV[6]) == 1 then
+    redis.call("DEL", KEYS[3])
+    if failed then
+        redis.call("SET", KEYS[1], "1", "PX", ARGV[5])
+        return 1
+    end
+    redis.call("DEL", KEYS[2], KEYS[4])
+    return 2
+end
+
+-- Late answers to requests sent before the breaker opened
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    return 0
+end
+
+local total = redis.call("HINCRBY", KEYS[4], "total", 1)
+if total == 1 then
+    redis.call("PEXPIRE", KEYS[4], ARGV[2])
+end
+
+local failures = tonumber(redis.call("HGET", KEYS[4], "failures") or 0)
+if failed then
+    failures = redis.call("HINCRBY", KEYS[4], "failures", 1)
+end
+
+if total >= tonumber(ARGV[3]) and failures >= total * tonumber(ARGV[4]) then
+    redis.call("SET", KEYS[1], "1", "PX", ARGV[5])
+    redis.call("SET", KEYS[2], "1")
+    redis.call("DEL", KEYS[4])
+    return 1
+end
+
+return 0
+""")
+
+BREAKER_STATS_KEY = f"{KEY_PREFIX}:stats:breaker"
+
+
+class Circuit_Breaker():
+    """
+        Health of one upstream, shared by all workers through Redis.
+        Requests that fail (connection error, timeout, 5xx) or take longer
+        than slow_call seconds count as failures. When at least failure_ratio
+        of the last min_calls or more requests in a window of `window`
+        seconds failed, the breaker opens: requests are rejected at once
+        for open_for seconds, then a single probe request decides whether
+        it closes again. Redis errors fail open.
+    """
+
+    def __init__(self, name, failure_ratio=0.5, min_calls=20, window=30, open_for=30, slow_call=5):
+
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.open_for = open_for
+        self.slow_call = slow_call
+
+        self.keys = [f"{KEY_PREFIX}:breaker:{name}:open",
+                     f"{KEY_PREFIX}:breaker:{name}:tripped",
+                     f"{KEY_PREFIX}:breaker:{name}:probe",
+                     f"{KEY_PREFIX}:breaker:{name}:window"]
+
+
+    def allow(self):
+        """
+            Returns 0 when the request must not be sent, 1 to send it,
+            2 to send it as the probe of a half-open breaker.
+        """
+
+        try:
+            allowed = BREAKER_ALLOW_SCRIPT(keys=self.keys, args=[int(self.open_for * 1000)])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return 1
+
+        if not allowed:
+            count_breaker(self.name, "rejected")
+
+        return allowed
+
+
+    def record(self, failed, elapsed, probe=False):
+
+        failed = failed or elapsed > self.slow_call
+
+        try:
+            change = BREAKER_RECORD_SCRIPT(keys=self.keys,
+                                           args=[int(failed), int(self.window * 1000), self.min_calls,
+                                                 self.failure_ratio, int(self.open_for * 1000), int(probe)])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return
+
+        self.log_change(change)
+
+
+    def log_change(self, change):
+
+        if change == 1:
+            logging.error(f"Circuit breaker {self.name} opened, failing fast for {self.open_for}s")
+            count_breaker(self.name, "opened")
+        elif change == 2:
+            logging.info(f"Circuit breaker {self.name} closed")
+            count_breaker(self.name, "closed")
+
+
+    def get_state(self):
+
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.exists(self.keys[0])
+            pipe.exists(self.keys[1])
+            is_open, tripped = pipe.execute()
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return "unknown"
+
+        if is_open:
+            return "open"
+
+        return "half_open" if tripped else "closed"
+
+
+def count_breaker(name, field):
+
+    try:
+        r.hincrby(BREAKER_STATS_KEY, f"{name}:{field}", 1)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def get_breaker_stats():
+    """
+        Counters of all workers: breaker trips, requests rejected while
+        open, breakers closed by a probe, and last-known-good entries served.
+    """
+
+    try:
+        stats = r.hgetall(BREAKER_STATS_KEY)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return {}
+
+    return {k.decode(): int(v) for k, v in stats.items()}
+
+
+##########################################
+####### Search ###########################
+##########################################
+
+# Latest type-ahead request of each search session (?session=...&seq=...)
+SEARCH_SESSION_TTL = int(os.getenv('SEARCH_SESSION_TTL', '600'))
+
+# Keep the highest seq seen, 1 if ARGV[1] is the newest request of the session
+CLAIM_SEARCH_SCRIPT = r.register_script("""
+local current = tonumber(redis.call("GET", KEYS[1]) or "-1")
+if tonumber(ARGV[1]) < current then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+return 1
+""")
+
+
+def search_session_key(session):
+    return f"{KEY_PREFIX}:search:session:{session}"
+
+
+def get_first(keys):
+    """
+        Return (key, data) for the first of keys that is cached, or (None, None).
+        All keys are read with one MGET, L1 is not consulted.
+    """
+
+    if not keys:
+        return None, None
+
+    try:
+        values = r.mget(keys)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None, None
+
+    for key, raw in zip(keys, values):
+
+        if raw is None:
+            continue
+
+        try:
+            return key, cache_codec.decode(raw)["data"]
+        except Exception as e:
+            logging.error(f"Cannot decode cache entry {key}: {e}")
+
+    return None, None
+
+
+def claim_search(session, seq):
+    """
+        Record seq as the newest request of a search session.
+        False when a newer request already arrived. Fails open.
+    """
+
+    try:
+        return bool(CLAIM_SEARCH_SCRIPT(keys=[search_session_key(session)], args=[seq, SEARCH_SESSION_TTL]))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return True
+
+
+def search_superseded(session, seq):
+    """
+        True when a newer request of the search session arrived after seq.
+    """
+
+    try:
+        current = r.get(search_session_key(session))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return False
+
+    return current is not None and int(current) > seq
+
+
+##########################################
+####### Votes ############################
+##########################################
+
+# Live tallies of a movie night, one vote per user:
+#   <prefix>:votes:<night>:tally      sorted set, "movie:603" -> number of votes
+#   <prefix>:votes:<night>:voters     hash, user id -> "movie:603"
+#   <prefix>:votes:<night>:retracted  set, users whose vote was withdrawn since the last flush
+#   <prefix>:votes:<night>:loaded     set while the keys above hold the whole night
+# Nights with changes not yet written to Postgres are kept in VOTES_DIRTY_KEY
+# (see vote_flusher.py). A night Redis no longer holds is rebuilt from
+# Postgres before it is voted in or read.
+VOTES_TTL = int(os.getenv('VOTES_TTL', str(30 * 24 * 3600)))
+VOTES_DIRTY_KEY = f"{KEY_PREFIX}:votes:dirty"
+
+# Returned by the scripts below for a night that is not in Redis
+NIGHT_NOT_LOADED = -1
+
+# Move the vote of a user to ARGV[2], atomically for all voters
+CAST_VOTE_SCRIPT = r.register_script("""
+if redis.call("EXISTS", KEYS[2]) == 0 and redis.call("EXISTS", KEYS[4]) == 0 then
+    return -1
+end
+local previous = redis.call("HGET", KEYS[2], ARGV[1])
+if previous == ARGV[2] then
+    return 0
+end
+if previous then
+    if tonumber(redis.call("ZINCRBY", KEYS[1], -1, previous)) <= 0 then
+        redis.call("ZREM", KEYS[1], previous)
+    end
+end
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+redis.call("ZINCRBY", KEYS[1], 1, ARGV[2])
+redis.call("SREM", KEYS[3], ARGV[1])
+redis.call("SET", KEYS[4], 1, "EX", ARGV[4])
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+redis.call("EXPIRE", KEYS[3], ARGV[4])
+redis.call("SADD", KEYS[5], ARGV[3])
+return 1
+""")
+
+RETRACT_VOTE_SCRIPT = r.register_script("""
+if redis.call("EXISTS", KEYS[2]) == 0 and redis.call("EXISTS", KEYS[4]) == 0 then
+    return -1
+end
+local previous = redis.call("HGET", KEYS[2], ARGV[1])
+if not previous then
+    return 0
+end
+redis.call("HDEL", KEYS[2], ARGV[1])
+if tonumber(redis.call("ZINCRBY", KEYS[1], -1, previous)) <= 0 then
+    redis.call("ZREM", KEYS[1], previous)
+end
+redis.call("SADD", KEYS[3], ARGV[1])
+redis.call("SET", KEYS[4], 1, "EX", ARGV[3])
+redis.call("EXPIRE", KEYS[3], ARGV[3])
+redis.call("SADD", KEYS[5], ARGV[2])
+return 1
+""")
+
+# Replace a night with the votes in ARGV[3..] (user id, member pairs).
+# Unless ARGV[1] is "1", a night that is already in Redis is left alone, so
+# a vote cast while another worker read Postgres is not overwritten.
+RESTORE_VOTES_SCRIPT = r.register_script("""
+if ARGV[1] ~= "1" and (redis.call("EXISTS", KEYS[2]) == 1 or redis.call("EXISTS", KEYS[4]) == 1) then
+    return 0
+end
+redis.call("DEL", KEYS[1], KEYS[2], KEYS[3])
+for i = 3, #ARGV, 2 do
+    redis.call("HSET", KEYS[2], ARGV[i], ARGV[i + 1])
+    redis.call("ZINCRBY", KEYS[1], 1, ARGV[i + 1])
+end
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+redis.call("SET", KEYS[4], 1, "EX", ARGV[2])
+return 1
+""")
+
+
+def vote_keys(night):
+    """
+        tally, voters, retracted and loaded keys of a night.
+    """
+
+    prefix = f"{KEY_PREFIX}:votes:{night}"
+
+    return f"{prefix}:tally", f"{prefix}:voters", f"{prefix}:retracted", f"{prefix}:loaded"
+
+
+def run_vote_script(script, night, args, restore):
+    """
+        Run CAST_VOTE_SCRIPT or RETRACT_VOTE_SCRIPT. When Redis does not hold
+        the night, rebuild it with restore(night) -> {user_id: member} and run
+        the script again.
+    """
+
+    keys = [*vote_keys(night), VOTES_DIRTY_KEY]
+
+    result = script(keys=keys, args=args)
+    if result == NIGHT_NOT_LOADED and restore:
+        status, output = restore_votes(night, restore(night), force=False)
+        if not status:
+            raise redis.RedisError(output)
+        result = script(keys=keys, args=args)
+
+    return result
+
+
+def cast_vote(night, user_id, member, restore=None):
+    """
+        Vote for member ("movie:603") in a night, replacing the user's previous vote.
+        Returns (status, changed).
+    """
+
+    try:
+        changed = run_vote_script(CAST_VOTE_SCRIPT, night, [user_id, member, night, VOTES_TTL], restore)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return False, str(e)
+
+    if changed == NIGHT_NOT_LOADED:
+        return False, f"Votes of {night} are not loaded"
+
+    return True, bool(changed)
+
+
+def retract_vote(night, user_id, restore=None):
+    """
+        Remove the vote of a user in a night. Returns (status, removed).
+    """
+
+    try:
+        removed = run_vote_script(RETRACT_VOTE_SCRIPT, night, [user_id, night, VOTES_TTL], restore)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return False, str(e)
+
+    if removed == NIGHT_NOT_LOADED:
+        return False, f"Votes of {night} are not loaded"
+
+    return True, bool(removed)
+
+
+def get_leaderboard(night, user_id=None, limit=10, restore=None):
+    """
+        Top limit members of a night with their votes (ZREVRANGE, O(log n + limit)),
+        the vote of user_id and the number of voters, in one round-trip.
+        A night Redis does not hold is first rebuilt with restore(night).
+    """
+
+    tally, voters, _, loaded = vote_keys(night)
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.zrevrange(tally, 0, limit - 1, withscores=True)
+        pipe.hget(voters, user_id if user_id is not None else "")
+        pipe.hlen(voters)
+        pipe.exists(loaded)
+        top, my_vote, count, is_loaded = pipe.execute()
+
+        if not count and not is_loaded and restore:
+            status, output = restore_votes(night, restore(night), force=False)
+            if not status:
+                return False, output
+            return get_leaderboard(night, user_id, limit)
+
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return False, str(e)
+
+    return True, {
+        "leaderboard": [(member.decode(), int(score)) for member, score in top],
+        "my_vote": my_vote.decode() if my_vote else None,
+        "voters": count
+    }
+
+
+def pop_dirty_nights(count=100):
+    """
+        Take up to count nights with unsaved votes. A vote cast meanwhile marks its night again.
+    """
+
+    try:
+        nights = r.spop(VOTES_DIRTY_KEY, count)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return []
+
+    return [night.decode() for night in nights or []]
+
+
+def mark_dirty(nights):
+
+    if not nights:
+        return
+
+    try:
+        r.sadd(VOTES_DIRTY_KEY, *nights)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def get_votes(night):
+    """
+        Votes of a night as {user_id: member} and the users who withdrew their
+        vote since the last flush, or (None, None) on a Redis error.
+    """
+
+    _, voters, retracted, _ = vote_keys(night)
+
+    try:
+        pipe = r.pipeline(transaction=True)
+        pipe.hgetall(voters)
+        pipe.smembers(retracted)
+        votes, users = pipe.execute()
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None, None
+
+    votes = {int(user_id): member.decode() for user_id, member in votes.items()}
+
+    return votes, {int(user_id) for user_id in users}
+
+
+def clear_retracted(night, users):
+    """
+        Forget retractions once Postgres has them. A user who voted again
+        meanwhile was already removed by CAST_VOTE_SCRIPT.
+    """
+
+    if not users:
+        return
+
+    _, _, retracted, _ = vote_keys(night)
+
+    try:
+        r.srem(retracted, *users)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def restore_votes(night, votes, force=True):
+    """
+        Rebuild the tallies of a night from {user_id: member}, e.g. after Redis lost them.
+        Without force, a night that is already in Redis is kept.
+    """
+
+    args = [1 if force else 0, VOTES_TTL]
+    for user_id, member in votes.items():
+        args += [user_id, member]
+
+    try:
+        RESTORE_VOTES_SCRIPT(keys=list(vote_keys(night)), args=args)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return False, str(e)
+
+    return True, len(votes)
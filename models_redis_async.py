@@ -0,0 +1,658 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: asyncio model for interacting with Redis
+
+# Same keys, envelope, codec and L1 cache as models_redis, so the WSGI and
+# the ASGI entry points read and write the same cache entries.
+
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+import functools
+import contextvars
+
+import redis
+import redis.asyncio as aioredis
+
+import cache_codec
+import models_redis
+import rest_client
+from models_redis import l1, make_key_builder, is_hot, lkg_key, DEFAULT_TTL, L1_MAX_TTL, LKG_TTL
+
+logging.basicConfig(level=logging.INFO)
+
+r = aioredis.Redis(host='localhost', port=6379, db=0)
+
+RELEASE_LOCK_SCRIPT = r.register_script("""
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+""")
+
+_refreshing = set()
+_refresh_tasks = set()
+
+# Set by collect_keys() while recording which keys a call would read
+_recording = contextvars.ContextVar("recording", default=None)
+
+
+async def get_entry(key):
+
+    models_redis.start_invalidation_listener()
+
+    entry = l1.get(key)
+    if entry is not None:
+        return entry
+
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            raw, pttl = await pipe.execute()
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None
+
+    if raw is None:
+        return None
+
+    try:
+        entry = cache_codec.decode(raw)
+    except Exception as e:
+        logging.error(f"Cannot decode cache entry {key}: {e}")
+        return None
+
+    if pttl and pttl > 0:
+        l1.set(key, entry, len(raw), min(pttl / 1000, L1_MAX_TTL))
+
+    return entry
+
+
+async def get_from_cache(key):
+
+    entry = await get_entry(key)
+    if entry is None:
+        return None
+
+    return entry["data"]
+
+
+async def set_to_cache(key, data, ttl=DEFAULT_TTL, stale_ttl=0, lkg_ttl=0, validators=None):
+
+    models_redis.start_invalidation_listener()
+
+    entry = {
+        "data": data,
+        "fresh_until": time.time() + ttl
+    }
+
+    if validators:
+        entry["validators"] = validators
+
+    hard_ttl = ttl + stale_ttl
+
+    try:
+        value = cache_codec.default_codec.encode(entry)
+        async with r.pipeline(transaction=False) as pipe:
+            pipe.set(key, value, ex=hard_ttl)
+            if lkg_ttl:
+                pipe.set(lkg_key(key), value, ex=lkg_ttl)
+            await pipe.execute()
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return
+    except (TypeError, ValueError) as e:
+        logging.error(f"Serialization error: {e}")
+        return
+
+    l1.set(key, entry, len(value), min(hard_ttl, L1_MAX_TTL))
+
+    await publish_invalidation([key])
+
+
+async def get_last_known_good(key):
+
+    try:
+        raw = await r.get(lkg_key(key))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None
+
+    if raw is None:
+        return None
+
+    try:
+        return cache_codec.decode(raw)["data"]
+    except Exception as e:
+        logging.error(f"Cannot decode cache entry {key}: {e}")
+        return None
+
+
+async def with_last_known_good(key, status, output):
+    """
+        See models_redis.with_last_known_good.
+    """
+
+    if status:
+        return status, output
+
+    data = await get_last_known_good(key)
+    if data is None:
+        return status, output
+
+    logging.warning(f"Serving last known good {key}: {output}")
+    await count_breaker("cache", "lkg")
+
+    return True, data
+
+
+async def publish_invalidation(keys):
+
+    message = json.dumps({"origin": models_redis.worker_id(), "keys": list(keys)})
+
+    try:
+        await r.publish(models_redis.INVALIDATION_CHANNEL, message)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+async def prefetch(keys):
+    """
+        Warm the L1 cache for many keys with a single pipelined round-trip.
+    """
+
+    keys = [key for key in dict.fromkeys(keys) if l1.get(key) is None]
+    if not keys:
+        return
+
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.get(key)
+                pipe.pttl(key)
+            replies = await pipe.execute()
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return
+
+    for key, raw, pttl in zip(keys, replies[0::2], replies[1::2]):
+
+        if raw is None or not pttl or pttl <= 0:
+            continue
+
+        try:
+            entry = cache_codec.decode(raw)
+        except Exception as e:
+            logging.error(f"Cannot decode cache entry {key}: {e}")
+            continue
+
+        l1.set(key, entry, len(raw), min(pttl / 1000, L1_MAX_TTL))
+
+
+async def collect_keys(fn):
+    """
+        Return the cache keys await fn() would read, without fetching anything.
+    """
+
+    keys = []
+    token = _recording.set(keys)
+
+    try:
+        await fn()
+    finally:
+        _recording.reset(token)
+
+    return keys
+
+
+def cached(ttl=DEFAULT_TTL, namespace=None, stale_ttl=None, lkg_ttl=LKG_TTL):
+    """
+        asyncio counterpart of models_redis.cached, for coroutine methods.
+        Keys, stale-while-revalidate, single-flight and last known good
+        behave the same way.
+    """
+
+    if stale_ttl is None:
+        stale_ttl = ttl
+
+    def decorator(func):
+
+        cache_key = make_key_builder(func, namespace)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+
+            key = cache_key(*args, **kwargs)
+
+            recorded = _recording.get()
+            if recorded is not None:
+                recorded.append(key)
+                return True, []
+
+            loader = lambda: func(*args, **kwargs)
+
+            entry = await get_entry(key)
+            if entry is not None:
+                fresh_for = entry["fresh_until"] - time.time()
+                if fresh_for <= 0 or (fresh_for < ttl * models_redis.REFRESH_AHEAD and is_hot(key)):
+                    schedule_refresh(key, loader, ttl, stale_ttl, lkg_ttl)
+                return True, entry["data"]
+
+            status, output = await load_coalesced(key, loader, ttl, stale_ttl, lkg_ttl)
+            if lkg_ttl:
+                return await with_last_known_good(key, status, output)
+
+            return status, output
+
+        wrapper.cache_key = cache_key
+        wrapper.ttl = ttl
+        wrapper.stale_ttl = stale_ttl
+        wrapper.lkg_ttl = lkg_ttl
+
+        return wrapper
+
+    return decorator
+
+
+##########################################
+####### Single-flight cache loading ######
+##########################################
+
+async def acquire_lease(key):
+
+    token = uuid.uuid4().hex
+
+    if await r.set(f"{key}:lock", token, nx=True, px=models_redis.LOCK_LEASE_MS):
+        return token
+
+    return None
+
+
+async def release_lease(key, token):
+
+    try:
+        await RELEASE_LOCK_SCRIPT(keys=[f"{key}:lock"], args=[token])
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+async def load(loader, validators=None):
+    """
+        See models_redis.load.
+    """
+
+    with rest_client.conditional(validators) as seen:
+        status, output = await loader()
+
+    return status, output, rest_client.single_validators(seen) if status else None
+
+
+async def load_coalesced(key, loader, ttl=DEFAULT_TTL, stale_ttl=0, lkg_ttl=0):
+    """
+        Run await loader() for a missing key in at most one worker at a time.
+        Waiting followers yield to the event loop instead of blocking it.
+    """
+
+    try:
+        token = await acquire_lease(key)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return await loader()
+
+    if token:
+        await count_singleflight("leader")
+        try:
+            status, output, validators = await load(loader)
+            if status:
+                await set_to_cache(key, output, ttl, stale_ttl, lkg_ttl, validators)
+            return status, output
+        finally:
+            await release_lease(key, token)
+
+    deadline = time.monotonic() + models_redis.LOCK_WAIT
+
+    while time.monotonic() < deadline:
+
+        await asyncio.sleep(models_redis.LOCK_POLL)
+
+        cached_value = await get_from_cache(key)
+        if cached_value is not None:
+            await count_singleflight("coalesced")
+            return True, cached_value
+
+        try:
+            if not await r.exists(f"{key}:lock"):
+                break
+        except redis.RedisError:
+            break
+
+    await count_singleflight("fallthrough")
+
+    status, output, validators = await load(loader)
+    if status:
+        await set_to_cache(key, output, ttl, stale_ttl, lkg_ttl, validators)
+
+    return status, output
+
+
+async def count_singleflight(field):
+
+    try:
+        await r.hincrby(models_redis.STATS_KEY, field, 1)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+def schedule_refresh(key, loader, ttl, stale_ttl, lkg_ttl=0):
+    """
+        Refresh key in a background task, at most one per key at a time.
+    """
+
+    if key in _refreshing:
+        return
+
+    _refreshing.add(key)
+
+    # The loop only keeps weak references to tasks
+    task = asyncio.get_running_loop().create_task(_refresh(key, loader, ttl, stale_ttl, lkg_ttl))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+async def _refresh(key, loader, ttl, stale_ttl, lkg_ttl=0):
+
+    try:
+        token = await acquire_lease(key)
+        if not token:
+            return
+
+        try:
+            entry = await get_entry(key)
+            validators = entry.get("validators") if entry else None
+
+            with rest_client.low_priority():
+                status, output, new_validators = await load(loader, validators)
+            if status:
+                await set_to_cache(key, output, ttl, stale_ttl, lkg_ttl, new_validators)
+                await count_singleflight("refreshed")
+            elif output == rest_client.NOT_MODIFIED and entry is not None:
+                await set_to_cache(key, entry["data"], ttl, stale_ttl, lkg_ttl, validators)
+                await count_singleflight("revalidated")
+            else:
+                logging.error(f"Background refresh of {key} failed: {output}")
+        finally:
+            await release_lease(key, token)
+
+    except Exception as e:
+        logging.error(f"Background refresh of {key} failed: {e}")
+
+    finally:
+        models_redis._hit_counts.pop(key, None)
+        _refreshing.discard(key)
+
+
+##########################################
+####### Rate limiting ####################
+##########################################
+
+RATE_LIMIT_SCRIPT = r.register_script(models_redis.RATE_LIMIT_SCRIPT.script)
+COOLDOWN_SCRIPT = r.register_script(models_redis.COOLDOWN_SCRIPT.script)
+
+
+class Async_Token_Bucket(models_redis.Token_Bucket):
+    """
+        Same bucket as models_redis.Token_Bucket (same name, same Redis keys),
+        waiting with asyncio.sleep instead of blocking the event loop.
+    """
+
+    async def try_acquire(self, priority):
+
+        try:
+            return await RATE_LIMIT_SCRIPT(keys=[self.bucket_key, self.cooldown_key],
+                                           args=[self.rate, self.burst, priority, self.reserve])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return 0
+
+
+    async def acquire(self, priority=0):
+
+        deadline = time.monotonic() + self.max_wait
+
+        wait = await self.try_acquire(priority) / 1000
+        if wait <= 0:
+            return True
+
+        await count_rate_limit(self.name, "delayed")
+
+        while True:
+
+            if time.monotonic() + wait > deadline:
+                await count_rate_limit(self.name, "rejected")
+                return False
+
+            await asyncio.sleep(wait * random.uniform(1, 1.2))
+
+            wait = await self.try_acquire(priority) / 1000
+            if wait <= 0:
+                return True
+
+
+    async def cooldown(self, seconds):
+
+        try:
+            await COOLDOWN_SCRIPT(keys=[self.cooldown_key], args=[max(1, int(seconds * 1000))])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+
+        await count_rate_limit(self.name, "throttled")
+
+
+async def count_rate_limit(name, field):
+
+    try:
+        await r.hincrby(models_redis.RATE_LIMIT_STATS_KEY, f"{name}:{field}", 1)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+##########################################
+####### Circuit breaker ##################
+##########################################
+
+BREAKER_ALLOW_SCRIPT = r.register_script(models_redis.BREAKER_ALLOW_SCRIPT.script)
+BREAKER_RECORD_SCRIPT = r.register_script(models_redis.BREAKER_RECORD_SCRIPT.script)
+
+
+class Async_Circuit_Breaker(models_redis.Circuit_Breaker):
+    """
+        Same breaker as models_redis.Circuit_Breaker (same name, same Redis keys),
+        for coroutine clients.
+    """
+
+    async def allow(self):
+
+        try:
+            allowed = await BREAKER_ALLOW_SCRIPT(keys=self.keys, args=[int(self.open_for * 1000)])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return 1
+
+        if not allowed:
+            await count_breaker(self.name, "rejected")
+
+        return allowed
+
+
+    async def record(self, failed, elapsed, probe=False):
+
+        failed = failed or elapsed > self.slow_call
+
+        try:
+            change = await BREAKER_RECORD_SCRIPT(keys=self.keys,
+                                                 args=[int(failed), int(self.window * 1000), self.min_calls,
+                                                       self.failure_ratio, int(self.open_for * 1000), int(probe)])
+        except redis.RedisError as e:
+            logging.error(f"Redis error: {e}")
+            return
+
+        if change == 1:
+            logging.error(f"Circuit breaker {self.name} opened, failing fast for {self.open_for}s")
+            await count_breaker(self.name, "opened")
+        elif change == 2:
+            logging.info(f"Circuit breaker {self.name} closed")
+            await count_breaker(self.name, "closed")
+
+
+async def count_breaker(name, field):
+
+    try:
+        await r.hincrby(models_redis.BREAKER_STATS_KEY, f"{name}:{field}", 1)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+
+
+##########################################
+####### Search ###########################
+##########################################
+
+CLAIM_SEARCH_SCRIPT = r.register_script(models_redis.CLAIM_SEARCH_SCRIPT.script)
+
+
+async def get_first(keys):
+    """
+        See models_redis.get_first.
+    """
+
+    if not keys:
+        return None, None
+
+    try:
+        values = await r.mget(keys)
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return None, None
+
+    for key, raw in zip(keys, values):
+
+        if raw is None:
+            continue
+
+        try:
+            return key, cache_codec.decode(raw)["data"]
+        except Exception as e:
+            logging.error(f"Cannot decode cache entry {key}: {e}")
+
+    return None, None
+
+
+async def claim_search(session, seq):
+
+    key = models_redis.search_session_key(session)
+
+    try:
+        return bool(await CLAIM_SEARCH_SCRIPT(keys=[key], args=[seq, models_redis.SEARCH_SESSION_TTL]))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return True
+
+
+async def search_superseded(session, seq):
+
+    try:
+        current = await r.get(models_redis.search_session_key(session))
+    except redis.RedisError as e:
+        logging.error(f"Redis error: {e}")
+        return False
+
+    return current is not None and int(current) > seq
+
+
+##########################################
+####### Event streams ####################
+##########################################
+
+EVENT_QUEUE_SIZE = 100
+
+
+class Event_Hub():
+    """
+        One Redis subscription to models_redis.EVENTS_CHANNEL per process,
+        fanned out to a queue per open stream. A stream that falls
+        EVENT_QUEUE_SIZE events behind is closed, the browser reconnects.
+    """
+
+    def __init__(self, channel=models_redis.EVENTS_CHANNEL, queue_size=EVENT_QUEUE_SIZE):
+
+        self.channel = channel
+        self.queue_size = queue_size
+        self.queues = set()
+        self.task = None
+
+
+    def subscribe(self):
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.queues.add(queue)
+
+        return queue
+
+
+    def unsubscribe(self, queue):
+        self.queues.discard(queue)
+
+
+    def publish_local(self, message):
+
+        for queue in list(self.queues):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow, drop its backlog and tell the stream to close
+                self.queues.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+
+    async def _run(self):
+
+        while True:
+
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    try:
+                        self.publish_local(json.loads(message["data"]))
+                    except (TypeError, ValueError) as e:
+                        logging.error(f"Bad event message: {e}")
+
+            except asyncio.CancelledError:
+                raise
+
+            except redis.RedisError as e:
+                logging.error(f"Event subscriber error: {e}")
+                await asyncio.sleep(1)
+
+            finally:
+                await pubsub.aclose()
+
+
+    async def close(self):
+
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
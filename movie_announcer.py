@@ -29,7 +29,7 @@ class Movie_Announcer():
 
     def notify_upcoming_movies(self):
 
-        status, output = self.tmdb.get_movies_upcoming()
+        status, output = self.tmdb.get_movies_upcoming(fields=None)
         if not status:
             log.error(output)
             os.exit(2)
@@ -0,0 +1,111 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: JSON encoding and compression of API responses
+
+# Used by the Flask-RESTX Api (app.py) and the ASGI handlers (asgi.py).
+# orjson and brotli are optional, without them responses are encoded with
+# the stdlib json module and compressed with gzip only:
+#
+#   pip install orjson brotli
+
+import os
+import json
+import gzip
+import logging
+
+from werkzeug.http import parse_accept_header
+
+from local_cache import LRU_Cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logging.basicConfig(level=logging.INFO)
+
+# json | orjson, orjson by default when it is installed
+RESPONSE_JSON = os.getenv('RESPONSE_JSON', 'orjson' if orjson else 'json')
+
+# Bodies smaller than this are sent uncompressed
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+
+# Compressed bodies are kept per worker, keyed by the ETag of the plain body
+RESPONSE_CACHE_ENTRIES = int(os.getenv('RESPONSE_CACHE_ENTRIES', '512'))
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', str(16 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = 3600
+
+
+def _json_dumps(data):
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _orjson_dumps(data):
+    # TMDb objects are keyed by strings, votes and counts may not be
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+# name -> (dumps, available)
+ENCODERS = {
+    "json": (_json_dumps, True),
+    "orjson": (_orjson_dumps, orjson is not None),
+}
+
+# Content-Encoding -> (compress, available), in order of preference
+COMPRESSORS = {
+    "br": (lambda b: brotli.compress(b, quality=5), brotli is not None),
+    "gzip": (lambda b: gzip.compress(b, compresslevel=6, mtime=0), True),
+}
+
+compressed_cache = LRU_Cache(max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_BYTES)
+
+
+def get_encoder(name):
+
+    if name not in ENCODERS or not ENCODERS[name][1]:
+        logging.error(f"Response encoder '{name}' is not available, using json")
+        name = "json"
+
+    return ENCODERS[name][0]
+
+
+dumps = get_encoder(RESPONSE_JSON)
+
+
+def negotiate(accept_encoding, size):
+    """
+        The Content-Encoding to send a body of `size` bytes with, None to
+        send it as is.
+    """
+
+    if not accept_encoding or size < RESPONSE_COMPRESS_MIN_BYTES:
+        return None
+
+    accepted = parse_accept_header(accept_encoding)
+
+    for encoding, (_, available) in COMPRESSORS.items():
+        if available and accepted.quality(encoding) > 0:
+            return encoding
+
+    return None
+
+
+def compress(body, encoding, etag):
+    """
+        Compress a body, or copy it from the compressed_cache when a body
+        with the same ETag was compressed before.
+    """
+
+    key = (etag, encoding)
+
+    compressed = compressed_cache.get(key)
+    if compressed is None:
+        compressed = COMPRESSORS[encoding][0](body)
+        compressed_cache.set(key, compressed, len(compressed), RESPONSE_CACHE_TTL)
+
+    return compressed
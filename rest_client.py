@@ -6,8 +6,17 @@
 import os
 import sys
 import json
+import time
+import random
 import logging
+import threading
+import contextlib
+import contextvars
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -15,6 +24,184 @@ log = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Connection pool / retry policy, overridable from .env
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.5'))
+
+# Request priorities for rate limiting, low priority requests (background
+# refreshes, batch scripts) leave a share of the rate to user-facing ones
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+_priority = contextvars.ContextVar("priority", default=PRIORITY_HIGH)
+
+# Returned as output, with status False, when a revalidated request got 304
+NOT_MODIFIED = "Not modified"
+
+# Set by conditional(): {"offer": validators to revalidate, "seen": validators received}
+_conditional = contextvars.ContextVar("conditional", default=None)
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def get_session(pool_size=POOL_SIZE, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """
+        Return the per-process keep-alive session for the given pool/retry policy.
+        Clients with the same policy share one session (and its connection pools).
+        Gunicorn forks workers after import, so sessions are rebuilt when the pid changes.
+    """
+
+    global _sessions_pid
+
+    policy = (pool_size, max_retries, backoff_factor)
+
+    with _sessions_lock:
+
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        session = _sessions.get(policy)
+        if session:
+            return session
+
+        # Only idempotent methods are retried, a Discord POST must not be sent twice.
+        # 429 is handled by REST_API_Client.request, so every process backs off.
+        # urllib3 would retry any 429 carrying Retry-After itself, hence the
+        # header is not honored here.
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      backoff_jitter=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+                      respect_retry_after_header=False,
+                      raise_on_status=False)
+
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        _sessions[policy] = session
+
+        return session
+
+
+@contextlib.contextmanager
+def low_priority():
+    """
+        Send the requests made inside the block with PRIORITY_LOW.
+        Context variables do not follow work into thread pools, so enter
+        it in the thread that makes the requests.
+    """
+
+    token = _priority.set(PRIORITY_LOW)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+@contextlib.contextmanager
+def conditional(validators=None):
+    """
+        Record the validators (ETag, Last-Modified) of the responses received
+        inside the block, and yield the list they are appended to. The request
+        matching `validators` (same method, url and params) is sent with
+        If-None-Match / If-Modified-Since and returns (False, NOT_MODIFIED)
+        on a 304. Like low_priority(), enter it in the thread that makes the
+        requests, pools started with copy_context() append to the same list.
+    """
+
+    state = {"offer": validators, "seen": []}
+
+    token = _conditional.set(state)
+    try:
+        yield state["seen"]
+    finally:
+        _conditional.reset(token)
+
+
+def single_validators(seen):
+    """
+        The validators recorded by conditional(), when the block made exactly
+        one request and the server sent some. A result built from several
+        responses cannot be revalidated with a single request.
+    """
+
+    if len(seen) != 1:
+        return None
+
+    validators = seen[0]
+    if not validators["etag"] and not validators["last_modified"]:
+        return None
+
+    return validators
+
+
+def conditional_headers(method, url, params):
+    """
+        If-None-Match / If-Modified-Since for a request offered for
+        revalidation by conditional(), else {}.
+    """
+
+    state = _conditional.get()
+    if state is None or state["offer"] is None:
+        return {}
+
+    offer = state["offer"]
+    if (offer["method"], offer["url"], offer["params"]) != (method, url, params):
+        return {}
+
+    headers = {}
+    if offer["etag"]:
+        headers["If-None-Match"] = offer["etag"]
+    if offer["last_modified"]:
+        headers["If-Modified-Since"] = offer["last_modified"]
+
+    return headers
+
+
+def record_validators(method, url, params, response_headers):
+
+    state = _conditional.get()
+    if state is None:
+        return
+
+    state["seen"].append({
+        "method": method,
+        "url": url,
+        "params": params,
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified")
+    })
+
+
+def retry_delay(headers, attempt, backoff_factor):
+    """
+        Seconds to wait before retrying a 429 or 5xx response: Retry-After
+        when the server sent one (seconds or HTTP date), otherwise
+        exponential backoff with +-50% jitter, so clients do not retry in step.
+    """
+
+    retry_after = headers.get("Retry-After")
+
+    if retry_after:
+        if retry_after.isdigit():
+            return int(retry_after)
+        try:
+            return max(0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+
+    return backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5)
+
 
 class REST_API_Client():
 
@@ -22,7 +209,13 @@ class REST_API_Client():
                  url,
                  api_ver=None,
                  base=None,
-                 user=None):
+                 user=None,
+                 pool_size=POOL_SIZE,
+                 max_retries=MAX_RETRIES,
+                 backoff_factor=BACKOFF_FACTOR,
+                 rate_limiter=None,
+                 priority=PRIORITY_HIGH,
+                 breaker=None):
 
         if not REST_API_Client.__with_http_prefix(url):
             log.error("Invalid url: %s", url)
@@ -38,6 +231,17 @@ class REST_API_Client():
 
         self.user = user
 
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        # Shared request budget (models_redis.Token_Bucket), None for no limit
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+
+        # Shared upstream health (models_redis.Circuit_Breaker), None to always send
+        self.breaker = breaker
+
         self.headers = {
             'Content-Type': 'application/json',
             'accept': 'application/json',
@@ -60,24 +264,100 @@ class REST_API_Client():
         return False
 
 
+    @property
+    def session(self):
+        return get_session(self.pool_size, self.max_retries, self.backoff_factor)
+
+
+    def get_priority(self):
+        return max(self.priority, _priority.get())
+
+
+    def max_retry_delay(self):
+        """
+            Longest wait slept inside a request before retrying it. Longer
+            Retry-After values fail the request at once, the rate limiter
+            cooldown then holds back every process instead of this worker.
+        """
+
+        if self.rate_limiter is not None:
+            return self.rate_limiter.max_wait
+
+        return self.backoff_factor * (2 ** self.max_retries)
+
+
     def request(self, method, url, timeout=10, verify=True, stream=False, decode=True, **kwargs):
+        """
+            Returns (status, output). While the breaker is open the request
+            fails at once. Each attempt first takes a token from rate_limiter.
+            A 429 pauses the limiter for every process, then idempotent
+            requests are retried after retry_delay(), unless it is longer
+            than max_retry_delay(). Inside conditional(),
+            a revalidated request returns (False, NOT_MODIFIED) on a 304.
+        """
 
-        try:
-            response = requests.request(method,
-                                        url,
-                                        headers=self.headers,
-                                        timeout=timeout,
-                                        verify=verify,
-                                        stream=stream,
-                                        **kwargs)
-        except Exception as E:
-            return False, str(E)
+        headers = {**self.headers, **conditional_headers(method, url, kwargs.get("params"))}
+
+        probe = False
+
+        if self.breaker is not None:
+            allowed = self.breaker.allow()
+            if not allowed:
+                return False, f"Circuit breaker of {self.breaker.name} is open, upstream is failing"
+            probe = allowed == 2
+
+        retries = self.max_retries if method in ("GET", "HEAD", "OPTIONS") else 0
+
+        for attempt in range(retries + 1):
+
+            if self.rate_limiter is not None and not self.rate_limiter.acquire(self.get_priority()):
+                return False, f"Rate limit of {self.rate_limiter.name} exceeded, no request slot within {self.rate_limiter.max_wait}s"
+
+            start = time.monotonic()
+
+            try:
+                response = self.session.request(method,
+                                                url,
+                                                headers=headers,
+                                                timeout=timeout,
+                                                verify=verify,
+                                                stream=stream,
+                                                **kwargs)
+            except Exception as E:
+                if self.breaker is not None:
+                    self.breaker.record(True, time.monotonic() - start, probe)
+                return False, str(E)
+
+            if response.status_code != 429:
+                break
+
+            delay = retry_delay(response.headers, attempt, self.backoff_factor)
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.cooldown(delay)
+
+            if attempt == retries or delay > self.max_retry_delay():
+                break
+
+            response.close()
+            time.sleep(delay)
+
+        if self.breaker is not None:
+            self.breaker.record(response.status_code >= 500, time.monotonic() - start, probe)
+
+        if response.status_code == 429:
+            return False, f"Rate limited by {url}, retry after {delay:.0f}s"
+
+        if response.status_code == 304:
+            return False, NOT_MODIFIED
 
         try:
             response.raise_for_status()
         except Exception as E:
             return False, f'Return code={response.status_code}, {E}\n{response.text}'
 
+        record_validators(method, url, kwargs.get("params"), response.headers)
+
         if stream:
             return True, response
 
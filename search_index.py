@@ -0,0 +1,372 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: local full-text index (SQLite FTS5) of the titles fetched from TMDb
+
+# Every movie and TV show the TMDb clients fetch (trending, discover, details,
+# search results and favorites) is added to a SQLite file. Type-ahead
+# results of TMDb are completed with its prefix matches, and a query it
+# matches well is answered from it while /search/multi is fetched in the
+# background (see tmdb_client.search_multi):
+#
+#   python search_index.py --favorites       # add favorites from media_metadata
+#   python search_index.py --prune 90        # drop titles not seen for 90 days
+#   python search_index.py --stats
+
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import unicodedata
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_index.db"))
+
+# A query is answered locally, until TMDb's results are cached, when it matches at least this many titles
+SEARCH_MIN_LOCAL = int(os.getenv("SEARCH_MIN_LOCAL", "5"))
+
+# Same as 5 pages of /search/multi
+SEARCH_LOCAL_LIMIT = int(os.getenv("SEARCH_LOCAL_LIMIT", "100"))
+
+MEDIA_TYPES = ("movie", "tv")
+
+# Fields the frontend reads to render a card in the list grids. Stored per
+# title and returned by lookup(), the TMDb clients project lists to them.
+CARD_FIELDS = ("first_air_date", "id", "media_type", "name", "popularity", "poster_path",
+               "profile_path", "release_date", "title", "vote_average")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS titles (
+    rowid INTEGER PRIMARY KEY,
+    media_type TEXT NOT NULL,
+    tmdb_id INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    original_title TEXT,
+    popularity REAL NOT NULL DEFAULT 0,
+    card TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (media_type, tmdb_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_titles_updated_at ON titles (updated_at);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS titles_fts USING fts5(
+    title, original_title,
+    content='titles', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='1 2 3'
+);
+
+CREATE TRIGGER IF NOT EXISTS titles_ai AFTER INSERT ON titles BEGIN
+    INSERT INTO titles_fts (rowid, title, original_title)
+    VALUES (new.rowid, new.title, new.original_title);
+END;
+
+CREATE TRIGGER IF NOT EXISTS titles_ad AFTER DELETE ON titles BEGIN
+    INSERT INTO titles_fts (titles_fts, rowid, title, original_title)
+    VALUES ('delete', old.rowid, old.title, old.original_title);
+END;
+
+-- Refreshing popularity or the card does not touch the full-text index
+CREATE TRIGGER IF NOT EXISTS titles_au AFTER UPDATE OF title, original_title ON titles
+WHEN old.title IS NOT new.title OR old.original_title IS NOT new.original_title BEGIN
+    INSERT INTO titles_fts (titles_fts, rowid, title, original_title)
+    VALUES ('delete', old.rowid, old.title, old.original_title);
+    INSERT INTO titles_fts (rowid, title, original_title)
+    VALUES (new.rowid, new.title, new.original_title);
+END;
+"""
+
+UPSERT = """
+INSERT INTO titles (media_type, tmdb_id, title, original_title, popularity, card, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (media_type, tmdb_id) DO UPDATE SET
+    title = excluded.title,
+    original_title = excluded.original_title,
+    popularity = excluded.popularity,
+    card = excluded.card,
+    updated_at = excluded.updated_at
+"""
+
+LOOKUP = """
+SELECT titles.card FROM titles_fts
+JOIN titles ON titles.rowid = titles_fts.rowid
+WHERE titles_fts MATCH ?
+ORDER BY titles.popularity DESC
+LIMIT ?
+"""
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+_local = threading.local()
+_disabled = False
+
+
+def get_connection():
+    """
+        Return the connection of this thread, None if FTS5 is not available.
+        Gunicorn forks workers after import, so connections are opened again
+        when the pid changes.
+    """
+
+    global _disabled
+
+    if _disabled:
+        return None
+
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    try:
+        conn = sqlite3.connect(SEARCH_INDEX_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+    except sqlite3.Error as e:
+        # Most likely SQLite built without FTS5, search then always goes to TMDb
+        logging.error(f"Search index disabled: {e}")
+        _disabled = True
+        return None
+
+    _local.conn = conn
+    _local.pid = os.getpid()
+
+    return conn
+
+
+def to_row(item, media_type=None):
+    """
+        Build a titles row from a TMDb movie or TV object (list entry or detail),
+        None for people, adult titles and items without a title.
+    """
+
+    media_type = item.get("media_type") or media_type
+    if media_type not in MEDIA_TYPES or item.get("adult"):
+        return None
+
+    title = item.get("title") or item.get("name")
+    if not title or "id" not in item:
+        return None
+
+    original_title = item.get("original_title") or item.get("original_name")
+    if original_title == title:
+        original_title = None
+
+    card = {k: item[k] for k in CARD_FIELDS if k in item}
+    card["media_type"] = media_type
+
+    return (media_type,
+            item["id"],
+            title,
+            original_title,
+            item.get("popularity") or 0,
+            json.dumps(card, separators=(",", ":")),
+            time.time())
+
+
+def add_titles(items, media_type=None):
+    """
+        Add or refresh titles in the index. media_type is used for items
+        that do not carry their own (details, discover results).
+    """
+
+    rows = [row for row in (to_row(item, media_type) for item in items) if row]
+    if not rows:
+        return
+
+    conn = get_connection()
+    if conn is None:
+        return
+
+    try:
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(UPSERT, rows)
+    except sqlite3.Error as e:
+        logging.error(f"Search index error: {e}")
+
+
+def normalize_query(query):
+    """
+        "  Amélie:  Le Fabuleux " -> "amelie le fabuleux"
+        Case, accents, punctuation and extra spaces do not change a search.
+    """
+
+    text = unicodedata.normalize("NFKD", query.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+
+    return " ".join(TOKEN_PATTERN.findall(text))
+
+
+def query_prefixes(query, min_length=2):
+    """
+        "star wa" -> ["star wa", "star w", "star", "sta", "st"]
+        Prefixes of a normalized query, longest first.
+    """
+
+    return [query[:n] for n in range(len(query), min_length - 1, -1) if query[n - 1] != " "]
+
+
+def filter_results(results, query):
+    """
+        Keep the TMDb results where every word of the normalized query starts
+        a word of the title or original title, the same rule as lookup().
+    """
+
+    tokens = query.split()
+
+    kept = []
+    for item in results:
+        text = " ".join(filter(None, (item.get("title"), item.get("name"),
+                                      item.get("original_title"), item.get("original_name"))))
+        words = normalize_query(text).split()
+        if all(any(word.startswith(token) for word in words) for token in tokens):
+            kept.append(item)
+
+    return kept
+
+
+def match_expression(query):
+    """
+        "Spider-Man: No" -> '"spider"* "man"* "no"*'
+        Every word of the query must start a word of the title.
+    """
+
+    tokens = TOKEN_PATTERN.findall(query.lower())
+
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def lookup(query, fields=CARD_FIELDS, min_results=SEARCH_MIN_LOCAL, limit=SEARCH_LOCAL_LIMIT):
+    """
+        Titles matching the query, most popular first. None when the index
+        cannot answer it: fewer than min_results matches, or fields that
+        are not stored (fields=None asks for full TMDb objects).
+    """
+
+    if fields is None or not set(fields) <= set(CARD_FIELDS):
+        return None
+
+    expression = match_expression(query)
+    if not expression:
+        return None
+
+    conn = get_connection()
+    if conn is None:
+        return None
+
+    try:
+        rows = conn.execute(LOOKUP, (expression, limit)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Search index error: {e}")
+        return None
+
+    if len(rows) < min_results:
+        return None
+
+    return [{k: card[k] for k in fields if k in card} for card in (json.loads(row[0]) for row in rows)]
+
+
+def prune(max_age_days):
+    """
+        Drop titles that no fetch has refreshed for max_age_days.
+    """
+
+    conn = get_connection()
+    if conn is None:
+        return False, "Search index is not available"
+
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+
+    try:
+        with conn:
+            conn.execute("BEGIN")
+            cursor = conn.execute("DELETE FROM titles WHERE updated_at < ?", (cutoff,))
+    except sqlite3.Error as e:
+        return False, str(e)
+
+    return True, cursor.rowcount
+
+
+def get_stats():
+
+    conn = get_connection()
+    if conn is None:
+        return {"enabled": False}
+
+    stats = {"enabled": True, "path": SEARCH_INDEX_PATH}
+    for media_type, count in conn.execute("SELECT media_type, COUNT(*) FROM titles GROUP BY media_type"):
+        stats[media_type] = count
+
+    return stats
+
+
+def add_favorites():
+    """
+        Add the titles of media_metadata, e.g. after the index file was deleted.
+    """
+
+    import models_sql
+
+    session = models_sql.Session()
+    try:
+        rows = session.query(models_sql.MediaMetadata).all()
+    finally:
+        models_sql.Session.remove()
+
+    items = []
+    for row in rows:
+        date_field = "release_date" if row.media_type == "movie" else "first_air_date"
+        title_field = "title" if row.media_type == "movie" else "name"
+        items.append({
+            "id": row.tmdb_id,
+            "media_type": row.media_type,
+            title_field: row.title,
+            "poster_path": row.poster_path,
+            "vote_average": row.vote_average,
+            date_field: row.release_date,
+            "popularity": row.popularity
+        })
+
+    add_titles(items)
+
+    return len(items)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Maintain the local search index")
+    parser.add_argument("--favorites", action="store_true", help="add the titles of media_metadata")
+    parser.add_argument("--prune", type=float, metavar="DAYS", help="drop titles not refreshed for DAYS days")
+    parser.add_argument("--stats", action="store_true", help="print the number of indexed titles")
+    args = parser.parse_args()
+
+    if get_connection() is None:
+        return 2
+
+    if args.favorites:
+        log.info(f"Added {add_favorites()} favorites.")
+
+    if args.prune is not None:
+        status, output = prune(args.prune)
+        if not status:
+            log.error(output)
+            return 2
+        log.info(f"Pruned {output} titles.")
+
+    if args.stats or not (args.favorites or args.prune is not None):
+        log.info(json.dumps(get_stats()))
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -1,23 +1,61 @@
+// Must match MAX_BATCH_IDS in app.py
+const BATCH_SIZE = 100;
 
-document.addEventListener("DOMContentLoaded", () => {
-    document.querySelectorAll(".movie-card").forEach(card => {
-        const id = card.dataset.id;
-        const type = card.dataset.type;
+function renderFavoriteCard(card, data) {
+    const img = document.createElement("img");
+    img.src = `https://image.tmdb.org/t/p/w500${data.poster_path}`;
+    img.alt = data.title || data.name;
+    card.prepend(img);
+
+    const titleElem = card.querySelector(".media-title");
+    if (titleElem) {
+        titleElem.textContent = data.title || data.name;
+    }
+}
+
+function removeFavoriteCard(card) {
+    // Remove the whole card + anchor from DOM
+    const wrapper = card.closest("a");
+    if (wrapper) {
+        wrapper.remove();
+    } else {
+        card.remove();
+    }
+}
+
+function loadFavoriteDetails(cards) {
+    const byId = new Map();
+    cards.forEach(card => byId.set(`${card.dataset.type}:${card.dataset.id}`, card));
+
+    const ids = [...byId.keys()];
+
+    // One request per BATCH_SIZE cards instead of one per card
+    for (let i = 0; i < ids.length; i += BATCH_SIZE) {
+        const chunk = ids.slice(i, i + BATCH_SIZE);
 
-        fetch(`/api/v1/${type}/${id}`)
+        fetch(`/api/v1/batch/details?ids=${encodeURIComponent(chunk.join(","))}`)
             .then(res => res.json())
             .then(data => {
-                const img = document.createElement("img");
-                img.src = `https://image.tmdb.org/t/p/w500${data.poster_path}`;
-                img.alt = data.title || data.name;
-                card.prepend(img);
-
-                const titleElem = card.querySelector(".media-title");
-                if (titleElem) {
-                    titleElem.textContent = data.title || data.name;
-                }
+                Object.entries(data.results || {}).forEach(([id, item]) => {
+                    const card = byId.get(id);
+                    if (card) {
+                        renderFavoriteCard(card, item);
+                    }
+                });
+                Object.entries(data.errors || {}).forEach(([id, error]) => {
+                    console.error(`Failed to load ${id}:`, error);
+                });
             });
+    }
+}
 
+document.addEventListener("DOMContentLoaded", () => {
+    const cards = document.querySelectorAll(".movie-card");
+
+    // Cards rendered from the local metadata table need no lookup
+    loadFavoriteDetails([...cards].filter(card => !card.dataset.hydrated));
+
+    cards.forEach(card => {
         const heart = card.querySelector(".favorite-heart");
         if (heart) {
             heart.addEventListener("click", (event) => {
@@ -34,13 +72,7 @@ document.addEventListener("DOMContentLoaded", () => {
                 }).then(res => res.json())
                   .then(data => {
                       if (data.success) {
-                          // Remove the whole card + anchor from DOM
-                          const wrapper = card.closest("a");
-                          if (wrapper) {
-                              wrapper.remove();
-                          } else {
-                              card.remove();
-                          }
+                          removeFavoriteCard(card);
                       } else {
                           console.error("Failed to remove favorite:", data.message);
                       }
@@ -48,4 +80,17 @@ document.addEventListener("DOMContentLoaded", () => {
             });
         }
     });
+
+    // Favorites removed in other tabs or devices (ASGI entry point only)
+    if (window.EventSource) {
+        const source = new EventSource("/api/v1/events");
+
+        source.addEventListener("favorites", (e) => {
+            const data = JSON.parse(e.data);
+            (data.removed || []).forEach(f => {
+                const card = document.querySelector(`.movie-card[data-id="${f.tmdb_id}"][data-type="${f.media_type}"]`);
+                if (card) removeFavoriteCard(card);
+            });
+        });
+    }
 });
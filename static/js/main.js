@@ -9,16 +9,198 @@ function debounce(fn, delay) {
 
 const favoriteList = new Set();
 
-function loadFavorites() {
-    fetch('/api/v1/favorites')
+// Cards per request, more are fetched as the row is scrolled
+const PAGE_SIZE = 20;
+
+function createCard(item, cardIdPrefix, mediaType) {
+    const card = document.createElement("div");
+    card.className = "movie-card";
+    card.id = `${cardIdPrefix}-${item.id}`;
+    card.setAttribute("data-id", item.id);
+    card.setAttribute("data-type", mediaType);
+
+    const title = item.title || item.name;
+    const date = item.release_date || item.first_air_date;
+    const heart = favoriteList.has(`${mediaType}:${item.id}`) ? "❤️" : "🤍";
+
+    const poster = item.poster_path
+        ? `<img src="https://image.tmdb.org/t/p/w500${item.poster_path}" alt="${title}">`
+        : `<div>No Image</div>`;
+
+    card.innerHTML = `
+        <span class="favorite-heart" onclick="toggleFavorite(this)">${heart}</span>
+        <a href="/${mediaType}/${item.id}" style="text-decoration: none; color: inherit;">
+            ${poster}
+            <h3>${title}</h3>
+            <p>${date}</p>
+            <p>⭐ ${Math.round(item.vote_average * 10)}%</p>
+        </a>
+    `;
+
+    // Save scroll position before navigating
+    card.addEventListener("click", () => {
+        sessionStorage.setItem("scrollPosition", window.scrollY);
+        sessionStorage.setItem("clickedCardId", `${cardIdPrefix}-${item.id}`);
+    });
+
+    return card;
+}
+
+// Render a list endpoint into a row, one page at a time (infinite scroll).
+// initial = {results, total} is an already fetched first page, e.g. from /api/v1/home
+function fetchAndRenderMovies(endpointUrl, containerId, cardIdPrefix, mediaType = "movie", initial = null) {
+    const container = document.getElementById(containerId);
+    container.innerHTML = "";  // Clear previous results
+
+    // Filters may re-render the row while a page is in flight
+    const generation = String(Number(container.dataset.generation || 0) + 1);
+    container.dataset.generation = generation;
+
+    const separator = endpointUrl.includes("?") ? "&" : "?";
+    let page = 1;
+    let loading = false;
+    let done = false;
+
+    function loadPage() {
+        if (loading || done) return;
+        loading = true;
+
+        fetch(`${endpointUrl}${separator}page=${page}&limit=${PAGE_SIZE}`)
+            .then(response => {
+                // The server only sends a "next" link when more items are left
+                done = !response.headers.get("Link");
+                return response.json();
+            })
+            .then(data => {
+                if (container.dataset.generation !== generation) return;
+
+                data.forEach(item => container.appendChild(createCard(item, cardIdPrefix, mediaType)));
+                page += 1;
+                loading = false;
+
+                // Keep going until the row overflows, otherwise no scroll event fires
+                if (container.scrollWidth <= container.clientWidth) loadPage();
+            })
+            .catch(err => {
+                loading = false;
+                done = true;
+                console.error(`Failed to fetch from ${endpointUrl}`, err);
+            });
+    }
+
+    container.onscroll = () => {
+        if (container.scrollLeft + container.clientWidth >= container.scrollWidth - 400) {
+            loadPage();
+        }
+    };
+
+    if (initial) {
+        initial.results.forEach(item => container.appendChild(createCard(item, cardIdPrefix, mediaType)));
+        page = Math.ceil(initial.results.length / PAGE_SIZE) + 1;
+        done = initial.results.length >= initial.total;
+
+        // A seeded row that does not overflow would never fire a scroll event either
+        if (container.scrollWidth <= container.clientWidth) loadPage();
+        return;
+    }
+
+    loadPage();
+}
+
+// Mark or unmark every card of an item, used for changes pushed by the server
+function setFavorite(f, isFavorite) {
+    const key = `${f.media_type}:${f.tmdb_id}`;
+    if (isFavorite) favoriteList.add(key);
+    else favoriteList.delete(key);
+
+    document.querySelectorAll(`.movie-card[data-id="${f.tmdb_id}"][data-type="${f.media_type}"] .favorite-heart`)
+        .forEach(heart => heart.textContent = isFavorite ? "❤️" : "🤍");
+}
+
+function tonight() {
+    return new Date().toLocaleDateString("en-CA");  // YYYY-MM-DD
+}
+
+function renderLeaderboard(entries) {
+    const list = document.getElementById("votes-leaderboard");
+    if (!list) return;
+
+    if (entries.length === 0) {
+        list.innerHTML = "<li>No votes yet, vote from a movie or TV page.</li>";
+        return;
+    }
+
+    const ids = entries.map(e => `${e.media_type}:${e.tmdb_id}`);
+    fetch(`/api/v1/batch/details?ids=${encodeURIComponent(ids.join(","))}`)
         .then(res => res.json())
-        .then(favs => {
-            favs.forEach(f => {
-                favoriteList.add(`${f.media_type}:${f.tmdb_id}`);
-                const card = document.querySelector(`.movie-card[data-id="${f.tmdb_id}"][data-type="${f.media_type}"]`);
-                if (card) card.querySelector(".favorite-heart").textContent = "❤️";
+        .then(details => {
+            list.innerHTML = "";
+            entries.forEach((e, i) => {
+                const item = (details.results || {})[ids[i]] || {};
+                const li = document.createElement("li");
+                const link = document.createElement("a");
+                link.href = `/${e.media_type}/${e.tmdb_id}`;
+                link.textContent = item.title || item.name || ids[i];
+                li.appendChild(link);
+                li.append(` (${e.votes} vote${e.votes === 1 ? "" : "s"})`);
+                list.appendChild(li);
             });
-        });
+        })
+        .catch(err => console.error("Failed to load votes", err));
+}
+
+function loadLeaderboard() {
+    if (!document.getElementById("votes-leaderboard")) return;
+
+    fetch(`/api/v1/votes/${tonight()}?limit=5`)
+        .then(res => res.json())
+        .then(data => renderLeaderboard(data.leaderboard || []))
+        .catch(err => console.error("Failed to load votes", err));
+}
+
+// Favorite and vote changes pushed by the server (ASGI entry point only)
+function subscribeEvents() {
+    if (!window.EventSource) return;
+
+    const source = new EventSource("/api/v1/events");
+
+    source.addEventListener("favorites", (e) => {
+        const data = JSON.parse(e.data);
+        (data.added || []).forEach(f => setFavorite(f, true));
+        (data.removed || []).forEach(f => setFavorite(f, false));
+    });
+
+    source.addEventListener("votes", (e) => {
+        const data = JSON.parse(e.data);
+        if (data.night === tonight()) renderLeaderboard(data.leaderboard.slice(0, 5));
+    });
+}
+
+function loadUser() {
+    const nameEl = document.getElementById("user-name");
+    const switchEl = document.getElementById("user-switch");
+    if (!nameEl || !switchEl) return;
+
+    fetch('/api/v1/user')
+        .then(res => res.json())
+        .then(user => { if (user.username) nameEl.textContent = user.username; });
+
+    // Each family member keeps their own favorites and history
+    switchEl.addEventListener("click", (event) => {
+        event.preventDefault();
+        const username = prompt("Who is watching?", nameEl.textContent);
+        if (!username) return;
+
+        fetch('/api/v1/user', {
+            method: 'PUT',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ username })
+        }).then(res => res.json())
+          .then(data => {
+              if (data.error) alert(data.error);
+              else window.location.reload();
+          });
+    });
 }
 
 // clicking on the heart
@@ -70,15 +252,40 @@ document.addEventListener("DOMContentLoaded", () => {
 
     //////////////////////////////////////////////////////////////
 
+    // Each request of this page carries a growing seq, so the server can drop
+    // the ones a newer keystroke pause has superseded
+    const searchSession = Math.random().toString(36).slice(2);
+    let searchSeq = 0;
+    let searchController = null;
+
     document.getElementById("search-input").addEventListener("input", debounce(async (e) => {
         const query = e.target.value.trim();
         const resultsContainer = document.getElementById("search-results");
         resultsContainer.innerHTML = ""; // Clear previous
 
+        if (searchController) searchController.abort();
+        searchController = null;
+
         if (query.length < 2) return;
 
-        const response = await fetch(`/api/v1/search?query=${encodeURIComponent(query)}`);
-        const data = await response.json();
+        const seq = ++searchSeq;
+        const controller = new AbortController();
+        searchController = controller;
+
+        let data;
+        try {
+            const response = await fetch(
+                `/api/v1/search?query=${encodeURIComponent(query)}&session=${searchSession}&seq=${seq}`,
+                { signal: controller.signal });
+            if (response.status === 204) return;   // superseded
+            data = await response.json();
+        } catch (err) {
+            if (err.name !== "AbortError") console.error("Search failed", err);
+            return;
+        }
+
+        if (seq !== searchSeq) return;
+        resultsContainer.innerHTML = "";
 
         data
             .filter(item => item.media_type !== "person")
@@ -103,7 +310,7 @@ document.addEventListener("DOMContentLoaded", () => {
             else if (type === "tv") href = `/tv/${item.id}`;
 
             card.innerHTML = `
-                <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
+                <span class="favorite-heart" onclick="toggleFavorite(this)">${favoriteList.has(`${type}:${item.id}`) ? "❤️" : "🤍"}</span>
                 <a href="${href}" style="text-decoration: none; color: inherit;">
                     ${poster}
                     <h3>${title}</h3>
@@ -120,133 +327,28 @@ document.addEventListener("DOMContentLoaded", () => {
             resultsContainer.appendChild(card);
         });
 
-        loadFavorites();
-
     }, 400)); // debounce to avoid API spamming
 
     //////////////////////////////////////////////////////////////
 
-    fetch("/api/v1/trending/movies")
-        .then(response => response.json())
-        .then(data => {
-            const container = document.getElementById("movies-container");
-
-            data.forEach(movie => {
-                const card = document.createElement("div");
-                card.className = "movie-card";
-                card.id = `movie-${movie.id}`;
-                card.setAttribute("data-id", movie.id);
-                card.setAttribute("data-type", "movie");
-
-                const poster = movie.poster_path 
-                    ? `<img src="https://image.tmdb.org/t/p/w500${movie.poster_path}" alt="${movie.title}">`
-                    : `<div>No Image</div>`;
-
-                card.innerHTML = `
-                <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
-                <a href="/movie/${movie.id}" style="text-decoration: none; color: inherit;">
-                    ${poster}
-                    <h3>${movie.title}</h3>
-                    <p>${movie.release_date}</p>
-                    <p>⭐ ${Math.round(movie.vote_average * 10)}%</p>
-                </a>
-                `;
-
-                // Save scroll position before navigating
-                card.addEventListener("click", () => {
-                    sessionStorage.setItem("scrollPosition", window.scrollY);
-                    sessionStorage.setItem("clickedCardId", `movie-${movie.id}`);
-                });
-
-                container.appendChild(card);
-            });
-        })
-        .catch(err => {
-            console.error("Failed to fetch trending movies", err);
-        });
-
-    // Trending TV Shows
-    fetch("/api/v1/trending/tv")
-        .then(response => response.json())
-        .then(data => {
-            const container = document.getElementById("tv-container");
-
-            data.forEach(tv => {
-                const card = document.createElement("div");
-                card.className = "movie-card";
-                card.id = `tv-${tv.id}`;
-                card.setAttribute("data-id", tv.id);
-                card.setAttribute("data-type", "tv");
-
-                const poster = tv.poster_path
-                    ? `<img src="https://image.tmdb.org/t/p/w500${tv.poster_path}" alt="${tv.name}">`
-                    : `<div>No Image</div>`;
-
-                card.innerHTML = `
-                    <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
-                    <a href="/tv/${tv.id}" style="text-decoration: none; color: inherit;">
-                        ${poster}
-                        <h3>${tv.name}</h3>
-                        <p>${tv.first_air_date}</p>
-                        <p>⭐ ${Math.round(tv.vote_average * 10)}%</p>
-                    </a>
-                `;
-
-                card.addEventListener("click", () => {
-                    sessionStorage.setItem("scrollPosition", window.scrollY);
-                    sessionStorage.setItem("clickedCardId", `tv-${tv.id}`);
-                });
-
-                container.appendChild(card);
-            });
-        });
-
-    //////////////////////////////////////////////////////////////
+    loadUser();
+    loadLeaderboard();
+    subscribeEvents();
 
-    fetch("/api/v1/discover/upcoming")
+    // All sections, filter choices and favorites in one request
+    const home = fetch(`/api/v1/home?limit=${PAGE_SIZE}`)
         .then(response => response.json())
-        .then(data => {
-            const container = document.getElementById("movies-upcoming");
-
-            data.forEach(movie => {
-                const card = document.createElement("div");
-                card.className = "movie-card";
-                card.id = `movie-upcoming-${movie.id}`;
-                card.setAttribute("data-id", movie.id);
-                card.setAttribute("data-type", "movie");
-
-                const poster = movie.poster_path 
-                    ? `<img src="https://image.tmdb.org/t/p/w500${movie.poster_path}" alt="${movie.title}">`
-                    : `<div>No Image</div>`;
-
-                card.innerHTML = `
-                <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
-                <a href="/movie/${movie.id}" style="text-decoration: none; color: inherit;">
-                    ${poster}
-                    <h3>${movie.title}</h3>
-                    <p>${movie.release_date}</p>
-                    <p>⭐ ${Math.round(movie.vote_average * 10)}%</p>
-                </a>
-                `;
-
-                // Save scroll position before navigating
-                card.addEventListener("click", () => {
-                    sessionStorage.setItem("scrollPosition", window.scrollY);
-                    sessionStorage.setItem("clickedCardId", `movie-upcoming-${movie.id}`);
-                });
-
-                container.appendChild(card);
-            });
-        })
+        .then(data => data.sections)
         .catch(err => {
-            console.error("Failed to fetch trending movies", err);
+            console.error("Failed to fetch home page", err);
+            return {};
         });
 
     //////////////////////////////////////////////////////////////
 
     const choicesInstances = {};  // Store initialized instances
 
-    async function populateFilters(genreSelectId, languageSelectId, regionSelectId) {
+    async function populateFilters(genreSelectId, languageSelectId, regionSelectId, sectionsPromise) {
 
       const genreSelect = document.getElementById(genreSelectId);
       const languageSelect = document.getElementById(languageSelectId);
@@ -280,8 +382,10 @@ document.addEventListener("DOMContentLoaded", () => {
       choicesInstances[regionSelectId] = regionChoices;
 
       try {
-        const genreRes = await fetch("/api/v1/genres");
-        const genreData = await genreRes.json();
+        const sections = await sectionsPromise;
+        const getSection = async (name, url) => sections[name] || (await fetch(url)).json();
+
+        const genreData = await getSection("genres", "/api/v1/genres");
         genreChoices.setChoices(
           genreData.genres.map(g => ({ value: g.id, label: g.name })),
           'value',
@@ -289,8 +393,7 @@ document.addEventListener("DOMContentLoaded", () => {
           false
         );
 
-        const languageRes = await fetch("/api/v1/languages");
-        const languageData = await languageRes.json();
+        const languageData = await getSection("languages", "/api/v1/languages");
         languageChoices.setChoices(
           languageData.map(g => ({ value: g.iso_639_1, label: g.english_name })),
           'value',
@@ -298,8 +401,7 @@ document.addEventListener("DOMContentLoaded", () => {
           false
         );
 
-        const regionRes = await fetch("/api/v1/regions");
-        const regionData = await regionRes.json();
+        const regionData = await getSection("regions", "/api/v1/regions");
         regionChoices.setChoices(
           regionData.map(r => ({ value: r.iso_3166_1, label: r.english_name })),
           'value',
@@ -375,142 +477,26 @@ document.addEventListener("DOMContentLoaded", () => {
 
     //////////////////////////////////////////////////////////////
 
-    function fetchAndRenderMovies(endpointUrl, containerId, cardIdPrefix) {
-        fetch(endpointUrl)
-          .then(response => response.json())
-          .then(data => {
-            const container = document.getElementById(containerId);
-            container.innerHTML = "";  // Clear previous results
-
-            data.forEach(movie => {
-              const card = document.createElement("div");
-              card.className = "movie-card";
-              card.id = `${cardIdPrefix}-${movie.id}`;
-              card.setAttribute("data-id", movie.id);
-              card.setAttribute("data-type", "movie");
-
-              const poster = movie.poster_path
-                ? `<img src="https://image.tmdb.org/t/p/w500${movie.poster_path}" alt="${movie.title}">`
-                : `<div>No Image</div>`;
-
-              card.innerHTML = `
-                <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
-                <a href="/movie/${movie.id}" style="text-decoration: none; color: inherit;">
-                    ${poster}
-                    <h3>${movie.title}</h3>
-                    <p>${movie.release_date}</p>
-                    <p>⭐ ${Math.round(movie.vote_average * 10)}%</p>
-                </a>
-              `;
-
-              card.addEventListener("click", () => {
-                sessionStorage.setItem("scrollPosition", window.scrollY);
-                sessionStorage.setItem("clickedCardId", `${cardIdPrefix}-${movie.id}`);
-              });
-
-              container.appendChild(card);
-            });
-          })
-          .catch(err => {
-            console.error(`Failed to fetch from ${endpointUrl}`, err);
-          });
-    }
-
-    //////////////////////////////////////////////////////////////
-
-    populateFilters("popular-genre-select", "popular-language-select", "popular-region-select");
-    populateFilters("top-rated-genre-select", "top-rated-language-select", "top-rated-region-select");
+    populateFilters("popular-genre-select", "popular-language-select", "popular-region-select", home);
+    populateFilters("top-rated-genre-select", "top-rated-language-select", "top-rated-region-select", home);
 
     setupPopularFilters();
     setupTopRatedFilters();
 
-    fetchAndRenderMovies("/api/v1/discover/popular", "movies-popular", "movie-popular");
-    fetchAndRenderMovies("/api/v1/discover/top_rated", "movies-top-rated", "movie-top-rated");
-
-    //////////////////////////////////////////////////////////////
-
-    fetch("/api/v1/discover/horror")
-        .then(response => response.json())
-        .then(data => {
-            const container = document.getElementById("movies-horror");
-
-            data.forEach(movie => {
-                const card = document.createElement("div");
-                card.className = "movie-card";
-                card.id = `movie-horror-${movie.id}`;
-                card.setAttribute("data-id", movie.id);
-                card.setAttribute("data-type", "movie");
-
-                const poster = movie.poster_path
-                    ? `<img src="https://image.tmdb.org/t/p/w500${movie.poster_path}" alt="${movie.title}">`
-                    : `<div>No Image</div>`;
-
-                card.innerHTML = `
-                <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
-                <a href="/movie/${movie.id}" style="text-decoration: none; color: inherit;">
-                    ${poster}
-                    <h3>${movie.title}</h3>
-                    <p>${movie.release_date}</p>
-                    <p>⭐ ${Math.round(movie.vote_average * 10)}%</p>
-                </a>
-                `;
-
-                // Save scroll position before navigating
-                card.addEventListener("click", () => {
-                    sessionStorage.setItem("scrollPosition", window.scrollY);
-                    sessionStorage.setItem("clickedCardId", `movie-horror-${movie.id}`);
-                });
-
-                container.appendChild(card);
-            });
-        })
-        .catch(err => {
-            console.error("Failed to fetch trending movies", err);
-        });
-
     //////////////////////////////////////////////////////////////
 
-    fetch("/api/v1/discover/family_animation")
-        .then(response => response.json())
-        .then(data => {
-            const container = document.getElementById("movies-family-animation");
-
-            data.forEach(movie => {
-                const card = document.createElement("div");
-                card.className = "movie-card";
-                card.id = `movie-family-animation-${movie.id}`;
-                card.setAttribute("data-id", movie.id);
-                card.setAttribute("data-type", "movie");
-
-                const poster = movie.poster_path
-                    ? `<img src="https://image.tmdb.org/t/p/w500${movie.poster_path}" alt="${movie.title}">`
-                    : `<div>No Image</div>`;
-
-                card.innerHTML = `
-                <span class="favorite-heart" onclick="toggleFavorite(this)">🤍</span>
-                <a href="/movie/${movie.id}" style="text-decoration: none; color: inherit;">
-                    ${poster}
-                    <h3>${movie.title}</h3>
-                    <p>${movie.release_date}</p>
-                    <p>⭐ ${Math.round(movie.vote_average * 10)}%</p>
-                </a>
-                `;
-
-                // Save scroll position before navigating
-                card.addEventListener("click", () => {
-                    sessionStorage.setItem("scrollPosition", window.scrollY);
-                    sessionStorage.setItem("clickedCardId", `movie-family-animation-${movie.id}`);
-                });
-
-                container.appendChild(card);
-            });
-        })
-        .catch(err => {
-            console.error("Failed to fetch trending movies", err);
-        });
-
-    //////////////////////////////////////////////////////////////
-
-    loadFavorites();
+    home.then(sections => {
+        // Known before any card is built, so hearts render correctly
+        (sections.favorites || []).forEach(f => favoriteList.add(`${f.media_type}:${f.tmdb_id}`));
+
+        // A section missing from the response (upstream error) is fetched on its own
+        fetchAndRenderMovies("/api/v1/trending/movies", "movies-container", "movie", "movie", sections.trending_movies);
+        fetchAndRenderMovies("/api/v1/trending/tv", "tv-container", "tv", "tv", sections.trending_tv);
+        fetchAndRenderMovies("/api/v1/discover/upcoming", "movies-upcoming", "movie-upcoming", "movie", sections.upcoming);
+        fetchAndRenderMovies("/api/v1/discover/popular", "movies-popular", "movie-popular", "movie", sections.popular);
+        fetchAndRenderMovies("/api/v1/discover/top_rated", "movies-top-rated", "movie-top-rated", "movie", sections.top_rated);
+        fetchAndRenderMovies("/api/v1/discover/horror", "movies-horror", "movie-horror", "movie", sections.horror);
+        fetchAndRenderMovies("/api/v1/discover/family_animation", "movies-family-animation", "movie-family-animation", "movie", sections.family_animation);
+    });
 
 });
@@ -112,6 +112,39 @@ document.addEventListener("DOMContentLoaded", () => {
 
     const heartEl = document.getElementById("favorite-heart");
 
+    // Tonight's vote, one per user: voting again moves the vote here
+    const night = new Date().toLocaleDateString("en-CA");  // YYYY-MM-DD
+    const voteEl = document.getElementById("vote-button");
+
+    function updateVoteIcon(myVote) {
+        voteEl.classList.toggle("voted", myVote === favoriteKey);
+    }
+
+    fetch(`/api/v1/votes/${night}?limit=1`)
+        .then(res => res.json())
+        .then(data => updateVoteIcon(data.my_vote));
+
+    voteEl.addEventListener("click", () => {
+        const voted = voteEl.classList.contains("voted");
+
+        fetch(`/api/v1/votes/${night}`, {
+            method: voted ? "DELETE" : "POST",
+            headers: { "Content-Type": "application/json" },
+            body: voted ? null : JSON.stringify({ tmdb_id: movieId, media_type })
+        }).then(res => res.json())
+          .then(data => {
+              if (data.error) console.error("Failed to vote:", data.error);
+              else updateVoteIcon(voted ? null : favoriteKey);
+          });
+    });
+
+    // Opening a detail page counts as a watch-history entry
+    fetch("/api/v1/history", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ tmdb_id: movieId, media_type })
+    }).catch(err => console.error("Failed to record history", err));
+
     // Fetch favorites
     fetch('/api/v1/favorites')
         .then(res => res.json())
@@ -141,4 +174,21 @@ document.addEventListener("DOMContentLoaded", () => {
           });
     });
 
+    // Changes made in other tabs or devices (ASGI entry point only)
+    if (window.EventSource) {
+        const source = new EventSource("/api/v1/events");
+
+        source.addEventListener("favorites", (e) => {
+            const data = JSON.parse(e.data);
+            (data.added || []).forEach(f => favoriteList.add(`${f.media_type}:${f.tmdb_id}`));
+            (data.removed || []).forEach(f => favoriteList.delete(`${f.media_type}:${f.tmdb_id}`));
+            updateHeartIcon();
+        });
+
+        source.addEventListener("votes", (e) => {
+            const data = JSON.parse(e.data);
+            if (data.night === night && "my_vote" in data) updateVoteIcon(data.my_vote);
+        });
+    }
+
 });
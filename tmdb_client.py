@@ -5,313 +5,670 @@
 
 import os
 import getpass
+import contextvars
 import logging
-import inspect
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 from rest_client import REST_API_Client
 import models_redis
+import models_sql
+import search_index
+from search_index import CARD_FIELDS
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 log = logging.getLogger(__name__)
 
+TMDB_URL = os.getenv('TMDB_URL', 'https://api.themoviedb.org')
 
-class TMDB_REST_API_Client(REST_API_Client):
+# Max concurrent page requests per paginated fetch
+PAGE_WORKERS = int(os.getenv('TMDB_PAGE_WORKERS', '4'))
 
-    def __init__(self,
-                 url=None,
-                 api_ver=None,
-                 base=None,
-                 user=getpass.getuser()):
+# Requests per second to TMDb from all workers together, TMDb allows about 50.
+# A quarter of the burst is kept for user-facing requests.
+TMDB_RATE_LIMIT = float(os.getenv('TMDB_RATE_LIMIT', '40'))
+TMDB_RATE_BURST = int(os.getenv('TMDB_RATE_BURST', '40'))
+TMDB_RATE_MAX_WAIT = float(os.getenv('TMDB_RATE_MAX_WAIT', '10'))
 
-        super().__init__(url, api_ver, base, user)
+TMDB_RATE_LIMITER = models_redis.Token_Bucket("tmdb", rate=TMDB_RATE_LIMIT, burst=TMDB_RATE_BURST,
+                                              max_wait=TMDB_RATE_MAX_WAIT)
 
-        access_token = os.getenv('TMDB_API_TOKEN', None)
-        if access_token:
-            self.headers['Authorization'] = f'Bearer {access_token}'
+# Fail fast while TMDb is down or slow, cached lists and details are then
+# served from their last known good copy
+TMDB_BREAKER_FAILURE_RATIO = float(os.getenv('TMDB_BREAKER_FAILURE_RATIO', '0.5'))
+TMDB_BREAKER_MIN_CALLS = int(os.getenv('TMDB_BREAKER_MIN_CALLS', '20'))
+TMDB_BREAKER_OPEN_FOR = float(os.getenv('TMDB_BREAKER_OPEN_FOR', '30'))
+TMDB_BREAKER_SLOW_CALL = float(os.getenv('TMDB_BREAKER_SLOW_CALL', '3'))
 
+TMDB_BREAKER = models_redis.Circuit_Breaker("tmdb", failure_ratio=TMDB_BREAKER_FAILURE_RATIO,
+                                            min_calls=TMDB_BREAKER_MIN_CALLS,
+                                            open_for=TMDB_BREAKER_OPEN_FOR,
+                                            slow_call=TMDB_BREAKER_SLOW_CALL)
 
-    #######################
-    ####### Configs #######
-    #######################
+# Cache TTLs in seconds
+TTL_CONFIG = 24 * 60 * 60    # certifications, countries, languages, genres
+TTL_LIST = 10 * 60           # trending and discover lists
+TTL_DETAIL = 60 * 60         # details, credits and videos
 
-    def get_movie_certification(self):
+# Search results are cached per normalized query, with the original titles
+# needed to filter them for a longer query
+SEARCH_NAMESPACE = "tmdb:search"
+SEARCH_FIELDS = CARD_FIELDS + ("original_name", "original_title")
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+# Results per TMDb page, fewer than max_pages full pages means TMDb returned every match
+TMDB_PAGE_SIZE = 20
 
-        url = f"{self.baseurl}/certification/movie/list"
 
-        status, output = self.request("GET", url)
-        if not status:
-            return False, output
+def project(items, fields):
+    """
+        Keep only the given fields of each item. fields=None keeps everything.
+    """
 
-        models_redis.set_to_cache(frame, output)
+    if fields is None:
+        return items
 
-        return True, output
+    return [{k: item[k] for k in fields if k in item} for item in items]
 
 
-    def get_countries(self):
+def with_fields(fields, *required):
+    """
+        Extend a projection with fields a method needs internally.
+    """
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+    if fields is None:
+        return None
 
-        url = f"{self.baseurl}/configuration/countries"
+    return tuple(sorted(set(fields) | set(required)))
 
-        status, output = self.request("GET", url)
-        if not status:
-            return False, output
 
-        models_redis.set_to_cache(frame, output)
+def search_key(query):
+    return models_redis.make_key(SEARCH_NAMESPACE, {"query": query})
 
-        return True, output
 
+def search_keys(query):
+    """
+        Cache keys of a normalized query and of its shorter prefixes,
+        longest first, as {key: prefix}.
+    """
 
-    def get_languages(self):
+    return {search_key(prefix): prefix for prefix in search_index.query_prefixes(query)}
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
 
-        url = f"{self.baseurl}/configuration/languages"
+def from_search_cache(query, prefix, cached):
+    """
+        Answer query from the cached results of prefix, None if they cannot.
+        A shorter prefix can only when TMDb returned all of its matches,
+        its results are then filtered for the longer query.
+    """
 
-        status, output = self.request("GET", url)
-        if not status:
-            return False, output
+    if prefix == query:
+        return cached["results"]
 
-        models_redis.set_to_cache(frame, output)
+    if not cached["complete"]:
+        return None
 
-        return True, output
+    return search_index.filter_results(cached["results"], query)
 
 
-    def get_movie_genres(self):
+def search_entry(result_list, max_pages):
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+    return {
+        "complete": len(result_list) < max_pages * TMDB_PAGE_SIZE,
+        "results": project(result_list, SEARCH_FIELDS)
+    }
 
-        url = f"{self.baseurl}/genre/movie/list"
 
-        status, output = self.request("GET", url)
-        if not status:
-            return False, output
+###########################################
+####### TMDb calls, shared by clients #####
+###########################################
 
-        models_redis.set_to_cache(frame, output)
+# Each TMDb method is written once, as a generator that yields the I/O it
+# needs and is sent back its result:
+#
+#   ("request", url, params)            -> (status, output) of a GET
+#   ("pages", url, params, max_pages)   -> (status, result_list), see get_pages
+#   ("cache_first", keys)               -> (key, data), see models_redis.get_first
+#   ("cache_set", key, data, ttl)       -> models_redis.set_to_cache(key, data, ttl)
+#   ("refresh", key, steps, ttl)        -> run steps() in the background and cache
+#                                          its output at key, see models_redis.schedule_refresh
+#   ("blocking", fn, *args)             -> fn(*args), SQL and SQLite calls
+#   ("callback", fn)                    -> fn(), a function of the caller
+#
+# The generator returns (status, output). TMDB_REST_API_Client.run performs
+# the steps in the calling thread, Async_TMDB_REST_API_Client.run awaits
+# them and keeps blocking calls off the event loop.
 
-        return True, output
+# Arguments of discover_movies shared by the discover-based lists
+DISCOVER_DEFAULTS = {
+    "include_adult": False,
+    "include_video": False,
+    "language": "en-US",
+    "max_pages": 5,
+    "sort_by": "popularity.desc"
+}
 
+TOP_RATED_FILTERS = {**DISCOVER_DEFAULTS, "sort_by": "vote_average.desc", "vote_count_gte": 200, "without_genres": "99,10755"}
+FAMILY_ANIMATION_FILTERS = {**DISCOVER_DEFAULTS, "with_genres": "16,10751"}
+HORROR_FILTERS = {**DISCOVER_DEFAULTS, "with_genres": "27"}
 
-    ########################
-    ####### Trending #######
-    ########################
 
-    def get_trending_movies(self, language="en-US", time_window="day", max_pages=5):
-        """
-            time_window = day or week
-        """
+def get_json(baseurl, path, params=None):
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+    return (yield ("request", f"{baseurl}/{path}", params))
 
-        url = f"{self.baseurl}/trending/movie/{time_window}"
 
-        page_num = 1
-        result_list = []
+def indexed_list(url, params, max_pages, fields, media_type=None):
+    """
+        A paginated list: its titles are added to the search index, then it
+        is projected to fields.
+    """
 
-        while True:
+    status, result_list = yield ("pages", url, params, max_pages)
+    if not status:
+        return False, result_list
 
-            params = {
-                "page": page_num,
-                "language": language
-            }
+    yield ("blocking", search_index.add_titles, result_list, media_type)
 
-            status, output = self.request("GET", url, params=params)
-            if not status:
-                return False, output
+    return True, project(result_list, fields)
 
-            results = output.get("results", [])
-            result_list.extend(results)
 
-            total_pages = output.get("total_pages", 0)
+def trending_list(baseurl, media_type, language, time_window, max_pages, fields):
 
-            if page_num >= min(max_pages, total_pages):
-                break
+    return (yield from indexed_list(f"{baseurl}/trending/{media_type}/{time_window}",
+                                    {"language": language}, max_pages, fields, media_type))
 
-            page_num += 1
 
-        models_redis.set_to_cache(frame, result_list)
+def from_catalog(media_type, tmdb_id, part, language, url):
+    """
+        Serve a detail, credits or videos lookup from the catalog mirror
+        (see models_sql.CatalogTitle). On a miss the response is fetched
+        from url and mirrored. Other languages are not mirrored.
+    """
 
-        return True, result_list
+    params = {"language": language}
 
+    if language != models_sql.CATALOG_LANGUAGE:
+        return (yield ("request", url, params))
 
-    def get_trending_tvs(self, language="en-US", time_window="day", max_pages=5):
-        """
-            time_window = day or week
-        """
+    data = yield ("blocking", models_sql.get_catalog_part, media_type, tmdb_id, part)
+    if data is not None:
+        return True, data
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+    status, output = yield ("request", url, params)
+    if status:
+        yield ("blocking", models_sql.save_catalog_part, media_type, tmdb_id, part, output)
 
-        url = f"{self.baseurl}/trending/tv/{time_window}"
+    return status, output
 
-        page_num = 1
-        result_list = []
 
-        while True:
+def title_detail(baseurl, media_type, tmdb_id, language):
 
-            params = {
-                "page": page_num,
-                "language": language
-            }
+    status, output = yield from from_catalog(media_type, tmdb_id, "detail", language,
+                                             f"{baseurl}/{media_type}/{tmdb_id}")
+    if not status:
+        return False, output
 
-            status, output = self.request("GET", url, params=params)
-            if not status:
-                return False, output
+    yield ("blocking", search_index.add_titles, [output], media_type)
 
-            results = output.get("results", [])
-            result_list.extend(results)
+    return True, output
 
-            total_pages = output.get("total_pages", 0)
 
-            if page_num >= min(max_pages, total_pages):
-                break
+def title_credits(baseurl, media_type, tmdb_id, language):
 
-            page_num += 1
+    return (yield from from_catalog(media_type, tmdb_id, "credits", language,
+                                    f"{baseurl}/{media_type}/{tmdb_id}/credits"))
 
-        models_redis.set_to_cache(frame, result_list)
 
-        return True, result_list
+def title_videos(baseurl, media_type, tmdb_id, language):
 
+    status, output = yield from from_catalog(media_type, tmdb_id, "videos", language,
+                                             f"{baseurl}/{media_type}/{tmdb_id}/videos")
+    if not status:
+        return False, output
 
-    ############################
-    ####### Movie Detail #######
-    ############################
+    return True, output.get("results", [])
 
-    def get_movie_detail(self, movie_id, language="en-US"):
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+def discover_list(baseurl,
+                  include_adult,
+                  include_video,
+                  language,
+                  with_original_language,
+                  sort_by,
+                  region,
+                  certification,
+                  primary_release_year,
+                  release_date_gte,
+                  release_date_lte,
+                  with_release_type,
+                  with_genres,
+                  without_genres,
+                  vote_count_gte,
+                  vote_count_lte,
+                  max_pages,
+                  fields):
 
-        url = f"{self.baseurl}/movie/{movie_id}"
-        params = {"language": language}
+    params = {
+        "include_adult": include_adult,
+        "include_video": include_video,
+        "language": language,
+        "with_original_language": with_original_language,
+        "sort_by": sort_by,
+        "region": region,
+        "certification": certification,
+        "primary_release_year": primary_release_year,
+        "release_date.gte": release_date_gte,
+        "release_date.lte": release_date_lte,
+        "with_release_type": with_release_type,
+        "with_genres": with_genres,
+        "without_genres": without_genres,
+        "vote_count.gte": vote_count_gte,
+        "vote_count.lte": vote_count_lte
+    }
 
-        status, output = self.request("GET", url, params=params)
+    # requests drops None while httpx sends it empty, and each spells
+    # booleans its own way, so both send TMDb the same query
+    params = {k: str(v).lower() if isinstance(v, bool) else v for k, v in params.items() if v is not None}
+
+    return (yield from indexed_list(f"{baseurl}/discover/movie", params, max_pages, fields, "movie"))
+
+
+def upcoming_filters():
+    """
+        Arguments of discover_movies for the movies released in the next 3 months.
+    """
+
+    today = datetime.today()
+
+    return {
+        **DISCOVER_DEFAULTS,
+        "region": "US",
+        "with_release_type": "2|3",
+        "release_date_gte": today.strftime("%Y-%m-%d"),
+        "release_date_lte": (today + relativedelta(months=3)).strftime("%Y-%m-%d")
+    }
+
+
+def only_upcoming(movies, fields):
+    """
+        Drop the movies released by now, the discover list is cached for TTL_LIST.
+    """
+
+    today = datetime.today().date()
+
+    movies_candidate = []
+    for movie in movies:
+        release_date = datetime.strptime(movie.get("release_date"), "%Y-%m-%d").date()
+        if release_date <= today:
+            continue
+        movies_candidate.append(movie)
+
+    return project(movies_candidate, fields)
+
+
+def fetch_search(baseurl, query, max_pages):
+    """
+        Results of /search/multi for a normalized query, most popular first.
+        Their movies and TV shows are added to the search index.
+    """
+
+    params = {
+        "query": query,
+        "language": "en-US",
+        "include_adult": "false"
+    }
+
+    status, result_list = yield ("pages", f"{baseurl}/search/multi", params, max_pages)
+    if not status:
+        return False, result_list
+
+    yield ("blocking", search_index.add_titles, result_list)
+
+    # Sort by popularity descending
+    result_list.sort(key=lambda x: x.get("popularity", 0), reverse=True)
+
+    return True, result_list
+
+
+def fetch_search_entry(baseurl, query, max_pages):
+    """
+        fetch_search as the value of its search cache entry.
+    """
+
+    status, result_list = yield from fetch_search(baseurl, query, max_pages)
+    if not status:
+        return False, result_list
+
+    return True, search_entry(result_list, max_pages)
+
+
+def merge_local(results, local):
+    """
+        TMDb results completed with the local titles they do not include,
+        e.g. titles past the pages fetched, most popular first.
+    """
+
+    seen = {(item.get("media_type"), item.get("id")) for item in results}
+    merged = results + [item for item in local if (item["media_type"], item["id"]) not in seen]
+
+    merged.sort(key=lambda x: x.get("popularity", 0), reverse=True)
+
+    return merged
+
+
+def search_multi(baseurl, query, max_pages, fields, superseded):
+    """
+        TMDb results come from the search cache (this query, or a shorter
+        prefix with complete results) or /search/multi, and are completed
+        with the matches of the local search index.
+
+        A query the cache cannot answer but the index can (SEARCH_MIN_LOCAL
+        titles) is answered from the index at once, without people and
+        titles we never fetched. The TMDb results are fetched in the
+        background and cached for the next keystroke.
+
+        superseded() is called before going to TMDb, when it returns True
+        the fetch is skipped and the result is None. fields=None (full TMDb
+        objects) always goes to TMDb.
+    """
+
+    query = search_index.normalize_query(query)
+    if not query:
+        return True, []
+
+    local = []
+
+    if fields is not None and set(fields) <= set(CARD_FIELDS):
+
+        keys = search_keys(query)
+        key, cached = yield ("cache_first", list(keys))
+        results = from_search_cache(query, keys[key], cached) if key is not None else None
+
+        local = (yield ("blocking", search_index.lookup, query, CARD_FIELDS, 0)) or []
+
+        if results is not None:
+            return True, project(merge_local(results, local), fields)
+
+        if len(local) >= search_index.SEARCH_MIN_LOCAL:
+            yield ("refresh", search_key(query), lambda: fetch_search_entry(baseurl, query, max_pages), TTL_LIST)
+            return True, project(local, fields)
+
+    if superseded is not None and (yield ("callback", superseded)):
+        return True, None
+
+    status, result_list = yield from fetch_search(baseurl, query, max_pages)
+    if not status:
+        return False, result_list
+
+    yield ("cache_set", search_key(query), search_entry(result_list, max_pages), TTL_LIST)
+
+    return True, project(merge_local(result_list, local), fields)
+
+
+class TMDB_REST_API_Client(REST_API_Client):
+
+    def __init__(self,
+                 url=None,
+                 api_ver=None,
+                 base=None,
+                 user=getpass.getuser(),
+                 page_workers=PAGE_WORKERS,
+                 rate_limiter=TMDB_RATE_LIMITER,
+                 breaker=TMDB_BREAKER,
+                 **kwargs):
+
+        super().__init__(url, api_ver, base, user, rate_limiter=rate_limiter, breaker=breaker, **kwargs)
+
+        self.page_workers = page_workers
+
+        access_token = os.getenv('TMDB_API_TOKEN', None)
+        if access_token:
+            self.headers['Authorization'] = f'Bearer {access_token}'
+
+
+    ##########################
+    ####### Pagination #######
+    ##########################
+
+    def get_pages(self, url, params=None, max_pages=5):
+        """
+            Fetch a paginated TMDb endpoint and return the merged "results" list.
+            Page 1 tells us total_pages, pages 2..max_pages are then fetched
+            concurrently with at most page_workers requests in flight.
+            Results keep page order, and the first failing page aborts the fetch.
+        """
+
+        params = dict(params or {})
+
+        status, output = self.request("GET", url, params={**params, "page": 1})
         if not status:
             return False, output
 
-        models_redis.set_to_cache(frame, output)
+        result_list = list(output.get("results", []))
 
-        return True, output
+        last_page = min(max_pages, output.get("total_pages", 0))
+        if last_page <= 1:
+            return True, result_list
 
+        pages = range(2, last_page + 1)
+        workers = max(1, min(self.page_workers, len(pages)))
 
-    def get_movie_credit(self, movie_id, language="en-US"):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            # Page requests keep the priority of the caller
+            futures = [
+                executor.submit(contextvars.copy_context().run,
+                                self.request, "GET", url, params={**params, "page": page_num})
+                for page_num in pages
+            ]
+
+            for future in futures:
+
+                status, output = future.result()
+                if not status:
+                    for pending in futures:
+                        pending.cancel()
+                    return False, output
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+                result_list.extend(output.get("results", []))
 
-        url = f"{self.baseurl}/movie/{movie_id}/credits"
+        return True, result_list
+
+
+    ##########################
+    ####### Shared calls #####
+    ##########################
+
+    def run(self, steps):
+        """
+            Perform the steps of a shared TMDb call (see search_multi and
+            the others above) and return its (status, output).
+        """
+
+        result = None
+
+        try:
+            while True:
+                result = self.perform(*steps.send(result))
+        except StopIteration as stop:
+            return stop.value
+
+
+    def perform(self, op, *args):
+
+        if op == "request":
+            url, params = args
+            return self.request("GET", url, params=params)
+
+        if op == "pages":
+            url, params, max_pages = args
+            return self.get_pages(url, params=params, max_pages=max_pages)
+
+        if op == "cache_first":
+            return models_redis.get_first(*args)
+
+        if op == "cache_set":
+            key, data, ttl = args
+            return models_redis.set_to_cache(key, data, ttl=ttl)
+
+        if op == "refresh":
+            key, steps, ttl = args
+            return models_redis.schedule_refresh(key, lambda: self.run(steps()), ttl, 0)
+
+        # blocking and callback
+        fn, *fn_args = args
+        return fn(*fn_args)
+
+
+    ##########################
+    ####### Catalog ##########
+    ##########################
+
+    def get_title_bundle(self, media_type, tmdb_id, language=models_sql.CATALOG_LANGUAGE):
+        """
+            Detail, credits and videos of a movie or TV show in one request
+            (append_to_response), as {"detail": ..., "credits": ..., "videos": ...}.
+            Output is None when TMDb deleted the title or marked it adult.
+        """
+
+        url = f"{self.baseurl}/{media_type}/{tmdb_id}"
 
         params = {
-            "language": language
+            "language": language,
+            "append_to_response": "credits,videos"
         }
 
         status, output = self.request("GET", url, params=params)
         if not status:
+            if output.startswith("Return code=404,"):
+                return True, None
             return False, output
 
-        models_redis.set_to_cache(frame, output)
+        if output.get("adult"):
+            return True, None
 
-        return True, output
+        credits = output.pop("credits", None)
+        videos = output.pop("videos", None)
 
+        return True, {"detail": output, "credits": credits, "videos": videos}
 
-    def get_movie_video(self, movie_id, language="en-US"):
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+    def get_changes(self, media_type, start_date, end_date, max_pages=500):
+        """
+            Ids of the movies or TV shows changed between two dates
+            (YYYY-MM-DD, at most 14 days apart), from /movie/changes or /tv/changes.
+        """
 
-        url = f"{self.baseurl}/movie/{movie_id}/videos"
+        url = f"{self.baseurl}/{media_type}/changes"
 
         params = {
-            "language": language
+            "start_date": start_date,
+            "end_date": end_date
         }
 
-        status, output = self.request("GET", url, params=params)
+        status, result_list = self.get_pages(url, params=params, max_pages=max_pages)
         if not status:
-            return False, output
+            return False, result_list
 
-        results = output.get("results", [])
+        return True, {item["id"] for item in result_list if not item.get("adult")}
 
-        models_redis.set_to_cache(frame, results)
 
-        return True, results
+    #######################
+    ####### Configs #######
+    #######################
 
+    @models_redis.cached(ttl=TTL_CONFIG, namespace="tmdb:movie_certification")
+    def get_movie_certification(self):
 
-    #########################
-    ####### TV Detail #######
-    #########################
+        return self.run(get_json(self.baseurl, "certification/movie/list"))
 
-    def get_tv_detail(self, tv_id, language="en-US"):
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+    @models_redis.cached(ttl=TTL_CONFIG, namespace="tmdb:countries")
+    def get_countries(self):
 
-        url = f"{self.baseurl}/tv/{tv_id}"
-        params = {"language": language}
+        return self.run(get_json(self.baseurl, "configuration/countries"))
 
-        status, output = self.request("GET", url, params=params)
-        if not status:
-            return False, output
 
-        models_redis.set_to_cache(frame, output)
+    @models_redis.cached(ttl=TTL_CONFIG, namespace="tmdb:languages")
+    def get_languages(self):
 
-        return True, output
+        return self.run(get_json(self.baseurl, "configuration/languages"))
 
 
-    def get_tv_credit(self, tv_id, language="en-US"):
+    @models_redis.cached(ttl=TTL_CONFIG, namespace="tmdb:movie_genres")
+    def get_movie_genres(self):
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
+        return self.run(get_json(self.baseurl, "genre/movie/list"))
 
-        url = f"{self.baseurl}/tv/{tv_id}/credits"
 
-        params = {
-            "language": language
-        }
+    ########################
+    ####### Trending #######
+    ########################
+
+    @models_redis.cached(ttl=TTL_LIST, namespace="tmdb:trending_movies")
+    def get_trending_movies(self, language="en-US", time_window="day", max_pages=5, fields=CARD_FIELDS):
+        """
+            time_window = day or week
+            fields = projection applied before caching, None for full TMDb objects
+        """
+
+        return self.run(trending_list(self.baseurl, "movie", language, time_window, max_pages, fields))
+
+
+    @models_redis.cached(ttl=TTL_LIST, namespace="tmdb:trending_tvs")
+    def get_trending_tvs(self, language="en-US", time_window="day", max_pages=5, fields=CARD_FIELDS):
+        """
+            time_window = day or week
+            fields = projection applied before caching, None for full TMDb objects
+        """
+
+        return self.run(trending_list(self.baseurl, "tv", language, time_window, max_pages, fields))
 
-        status, output = self.request("GET", url, params=params)
-        if not status:
-            return False, output
 
-        models_redis.set_to_cache(frame, output)
+    ############################
+    ####### Movie Detail #######
+    ############################
+
+    @models_redis.cached(ttl=TTL_DETAIL, namespace="tmdb:movie_detail")
+    def get_movie_detail(self, movie_id, language="en-US"):
+
+        return self.run(title_detail(self.baseurl, "movie", movie_id, language))
+
+
+    @models_redis.cached(ttl=TTL_DETAIL, namespace="tmdb:movie_credit")
+    def get_movie_credit(self, movie_id, language="en-US"):
+
+        return self.run(title_credits(self.baseurl, "movie", movie_id, language))
+
+
+    @models_redis.cached(ttl=TTL_DETAIL, namespace="tmdb:movie_video")
+    def get_movie_video(self, movie_id, language="en-US"):
+
+        return self.run(title_videos(self.baseurl, "movie", movie_id, language))
 
-        return True, output
+
+    #########################
+    ####### TV Detail #######
+    #########################
+
+    @models_redis.cached(ttl=TTL_DETAIL, namespace="tmdb:tv_detail")
+    def get_tv_detail(self, tv_id, language="en-US"):
+
+        return self.run(title_detail(self.baseurl, "tv", tv_id, language))
+
+
+    @models_redis.cached(ttl=TTL_DETAIL, namespace="tmdb:tv_credit")
+    def get_tv_credit(self, tv_id, language="en-US"):
+
+        return self.run(title_credits(self.baseurl, "tv", tv_id, language))
 
 
     ###############################
     ####### Discover Movies #######
     ###############################
 
+    @models_redis.cached(ttl=TTL_LIST, namespace="tmdb:discover_movies")
     def discover_movies(self,
                         include_adult=False,
                         include_video=False,
@@ -328,8 +685,11 @@ class TMDB_REST_API_Client(REST_API_Client):
                         without_genres=None,
                         vote_count_gte=None,
                         vote_count_lte=None,
-                        max_pages=5):
+                        max_pages=5,
+                        fields=CARD_FIELDS):
         """
+            fields = projection applied before caching, None for full TMDb objects
+
             | US Certification | Meaning                                                                                                                                                |
             |------------------|--------------------------------------------------------------------------------------------------------------------------------------------------------|
             | G                | All ages admitted. There is no content that would be objectionable to most parents.                                                                    |
@@ -374,186 +734,88 @@ class TMDB_REST_API_Client(REST_API_Client):
             | 37       | Western           |
         """
 
-        frame = inspect.currentframe()
-        cached = models_redis.get_from_cache(frame)
-        if cached:
-            return True, cached
-
-        url = f"{self.baseurl}/discover/movie"
-
-        page_num = 1
-        result_list = []
-
-        while True:
-
-            params = {
-                "page": page_num,
-                "include_adult": include_adult,
-                "include_video": include_video,
-                "language": language,
-                "with_original_language": with_original_language,
-                "sort_by": sort_by,
-                "region": region,
-                "certification": certification,
-                "primary_release_year": primary_release_year,
-                "release_date.gte": release_date_gte,
-                "release_date.lte": release_date_lte,
-                "with_release_type": with_release_type,
-                "with_genres": with_genres,
-                "without_genres": without_genres,
-                "vote_count.gte": vote_count_gte,
-                "vote_count.lte": vote_count_lte
-            }
-
-            status, output = self.request("GET", url, params=params)
-            if not status:
-                return False, output
-
-            results = output.get("results", [])
-            result_list.extend(results)
-
-            total_pages = output.get("total_pages", 0)
-
-            if page_num >= min(max_pages, total_pages):
-                break
-
-            page_num += 1
-
-        models_redis.set_to_cache(frame, result_list)
-
-        return True, result_list
+        return self.run(discover_list(self.baseurl,
+                                      include_adult,
+                                      include_video,
+                                      language,
+                                      with_original_language,
+                                      sort_by,
+                                      region,
+                                      certification,
+                                      primary_release_year,
+                                      release_date_gte,
+                                      release_date_lte,
+                                      with_release_type,
+                                      with_genres,
+                                      without_genres,
+                                      vote_count_gte,
+                                      vote_count_lte,
+                                      max_pages,
+                                      fields))
 
 
     #####################################
     ####### Discover-based Movies #######
     #####################################
 
-    def get_movies_upcoming(self):
-
-        today = datetime.today()
-        today_str = today.strftime("%Y-%m-%d")
+    def get_movies_upcoming(self, fields=CARD_FIELDS):
 
-        # Add 3 months
-        three_months_later = today + relativedelta(months=3)
-        three_months_str = three_months_later.strftime("%Y-%m-%d")
-
-        status, output = self.discover_movies(include_adult=False,
-                                              include_video=False,
-                                              language="en-US",
-                                              max_pages=5,
-                                              sort_by="popularity.desc",
-                                              region="US",
-                                              with_release_type="2|3",
-                                              release_date_gte=today_str,
-                                              release_date_lte=three_months_str)
+        status, output = self.discover_movies(**upcoming_filters(), fields=with_fields(fields, "release_date"))
         if not status:
             return False, output
 
-        movies_candidate = []
-        for movie in output:
-            release_date = movie.get("release_date")
-            release_date = datetime.strptime(release_date, "%Y-%m-%d").date()
-            today = datetime.today().date()
-            if release_date <= today:
-                continue
-            movies_candidate.append(movie)
-
-        return True, movies_candidate
+        return True, only_upcoming(output, fields)
 
 
     def get_movies_popular(self,
                            with_genres=None,
                            with_original_language=None,
                            region=None,
-                           primary_release_year=None):
+                           primary_release_year=None,
+                           fields=CARD_FIELDS):
 
-        return self.discover_movies(include_adult=False,
-                                    include_video=False,
-                                    language="en-US",
-                                    max_pages=5,
-                                    sort_by="popularity.desc",
+        return self.discover_movies(**DISCOVER_DEFAULTS,
                                     with_genres=with_genres,
                                     with_original_language=with_original_language,
                                     region=region,
-                                    primary_release_year=primary_release_year)
+                                    primary_release_year=primary_release_year,
+                                    fields=fields)
 
 
     def get_movies_top_rated(self,
                              with_genres=None,
                              with_original_language=None,
                              region=None,
-                             primary_release_year=None):
-
-        return self.discover_movies(include_adult=False,
-                                    include_video=False,
-                                    language="en-US",
-                                    max_pages=5,
-                                    sort_by="vote_average.desc",
-                                    vote_count_gte=200,
-                                    without_genres="99,10755",
+                             primary_release_year=None,
+                             fields=CARD_FIELDS):
+
+        return self.discover_movies(**TOP_RATED_FILTERS,
                                     with_genres=with_genres,
                                     with_original_language=with_original_language,
                                     region=region,
-                                    primary_release_year=primary_release_year)
+                                    primary_release_year=primary_release_year,
+                                    fields=fields)
 
 
-    def get_movies_family_animation(self):
+    def get_movies_family_animation(self, fields=CARD_FIELDS):
 
-        return self.discover_movies(include_adult=False,
-                                    include_video=False,
-                                    language="en-US",
-                                    max_pages=5,
-                                    sort_by="popularity.desc",
-                                    with_genres="16,10751")
+        return self.discover_movies(**FAMILY_ANIMATION_FILTERS, fields=fields)
 
 
-    def get_movies_horror(self):
+    def get_movies_horror(self, fields=CARD_FIELDS):
 
-        return self.discover_movies(include_adult=False,
-                                    include_video=False,
-                                    language="en-US",
-                                    max_pages=5,
-                                    sort_by="popularity.desc",
-                                    with_genres="27")
+        return self.discover_movies(**HORROR_FILTERS, fields=fields)
 
     ######################
     ####### Search #######
     ######################
 
-    def search(self, query, max_pages=5):
-
-        url = f"{self.baseurl}/search/multi"
-
-        page_num = 1
-        result_list = []
-
-        while True:
-
-            params = {
-                "query": query,
-                "language": "en-US",
-                "include_adult": False,
-                "page": page_num
-            }
-
-            status, output = self.request("GET", url, params=params)
-            if not status:
-                return False, output
-
-            results = output.get("results", [])
-            result_list.extend(results)
-
-            total_pages = output.get("total_pages", 0)
-
-            if page_num >= min(max_pages, total_pages):
-                break
-
-            page_num += 1
-
-        # Sort by popularity descending
-        result_list.sort(key=lambda x: x.get("popularity", 0), reverse=True)
+    def search(self, query, max_pages=5, fields=CARD_FIELDS, superseded=None):
+        """
+            See search_multi.
+        """
 
-        return True, result_list
+        return self.run(search_multi(self.baseurl, query, max_pages, fields, superseded))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,445 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: asyncio REST client for TMDb
+
+# Mirrors TMDB_REST_API_Client for the ASGI entry point (asgi.py). The TMDb
+# calls themselves (URLs, parameters, catalog mirror, search index) are the
+# shared generators of tmdb_client, this client only awaits their steps.
+# Cache namespaces and TTLs are shared with the sync client, so both read
+# and write the same Redis entries.
+
+import os
+import json
+import time
+import asyncio
+import getpass
+import logging
+
+import httpx
+
+from rest_client import REST_API_Client, POOL_SIZE, MAX_RETRIES, BACKOFF_FACTOR, retry_delay
+from rest_client import NOT_MODIFIED, conditional_headers, record_validators
+from tmdb_client import PAGE_WORKERS, TTL_CONFIG, TTL_LIST, TTL_DETAIL, CARD_FIELDS
+from tmdb_client import TMDB_RATE_LIMIT, TMDB_RATE_BURST, TMDB_RATE_MAX_WAIT
+from tmdb_client import TMDB_BREAKER_FAILURE_RATIO, TMDB_BREAKER_MIN_CALLS, TMDB_BREAKER_OPEN_FOR, TMDB_BREAKER_SLOW_CALL
+from tmdb_client import DISCOVER_DEFAULTS, TOP_RATED_FILTERS, FAMILY_ANIMATION_FILTERS, HORROR_FILTERS
+from tmdb_client import get_json, trending_list, title_detail, title_credits, title_videos, discover_list
+from tmdb_client import upcoming_filters, only_upcoming, search_multi, with_fields
+import models_redis_async
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Same bucket as tmdb_client.TMDB_RATE_LIMITER, shared with the sync workers
+TMDB_RATE_LIMITER = models_redis_async.Async_Token_Bucket("tmdb", rate=TMDB_RATE_LIMIT, burst=TMDB_RATE_BURST,
+                                                          max_wait=TMDB_RATE_MAX_WAIT)
+
+# Same breaker as tmdb_client.TMDB_BREAKER
+TMDB_BREAKER = models_redis_async.Async_Circuit_Breaker("tmdb", failure_ratio=TMDB_BREAKER_FAILURE_RATIO,
+                                                        min_calls=TMDB_BREAKER_MIN_CALLS,
+                                                        open_for=TMDB_BREAKER_OPEN_FOR,
+                                                        slow_call=TMDB_BREAKER_SLOW_CALL)
+
+
+class Async_TMDB_REST_API_Client(REST_API_Client):
+
+    def __init__(self,
+                 url=None,
+                 api_ver=None,
+                 base=None,
+                 user=getpass.getuser(),
+                 page_workers=PAGE_WORKERS,
+                 rate_limiter=TMDB_RATE_LIMITER,
+                 breaker=TMDB_BREAKER,
+                 **kwargs):
+
+        super().__init__(url, api_ver, base, user, rate_limiter=rate_limiter, breaker=breaker, **kwargs)
+
+        self.page_workers = page_workers
+        self.client = None
+
+        access_token = os.getenv('TMDB_API_TOKEN', None)
+        if access_token:
+            self.headers['Authorization'] = f'Bearer {access_token}'
+
+
+    @property
+    def session(self):
+        """
+            Keep-alive connection pool, created on first use inside the event loop.
+        """
+
+        if self.client is None:
+            limits = httpx.Limits(max_connections=self.pool_size,
+                                  max_keepalive_connections=self.pool_size)
+            self.client = httpx.AsyncClient(headers=self.headers, limits=limits)
+
+        return self.client
+
+
+    async def close(self):
+
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+    async def request(self, method, url, timeout=10, decode=True, **kwargs):
+        """
+            Same contract as REST_API_Client.request: returns (status, output).
+            Fails at once while the shared breaker is open. Each attempt takes
+            a token from the shared rate limiter, a 429 pauses it for every
+            process. Idempotent requests are retried on 429/5xx after
+            retry_delay() (Retry-After, or jittered backoff), unless it is
+            longer than max_retry_delay(). Revalidated
+            requests return (False, NOT_MODIFIED) on a 304.
+        """
+
+        headers = conditional_headers(method, url, kwargs.get("params"))
+
+        probe = False
+
+        if self.breaker is not None:
+            allowed = await self.breaker.allow()
+            if not allowed:
+                return False, f"Circuit breaker of {self.breaker.name} is open, upstream is failing"
+            probe = allowed == 2
+
+        retries = self.max_retries if method in ("GET", "HEAD", "OPTIONS") else 0
+
+        for attempt in range(retries + 1):
+
+            if self.rate_limiter is not None and not await self.rate_limiter.acquire(self.get_priority()):
+                return False, f"Rate limit of {self.rate_limiter.name} exceeded, no request slot within {self.rate_limiter.max_wait}s"
+
+            start = time.monotonic()
+
+            try:
+                response = await self.session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+            except Exception as E:
+                if self.breaker is not None:
+                    await self.breaker.record(True, time.monotonic() - start, probe)
+                return False, str(E)
+
+            if response.status_code not in RETRY_STATUS:
+                break
+
+            delay = retry_delay(response.headers, attempt, self.backoff_factor)
+
+            if response.status_code == 429 and self.rate_limiter is not None:
+                await self.rate_limiter.cooldown(delay)
+
+            if attempt == retries or delay > self.max_retry_delay():
+                break
+
+            await asyncio.sleep(delay)
+
+        if self.breaker is not None:
+            await self.breaker.record(response.status_code >= 500, time.monotonic() - start, probe)
+
+        if response.status_code == 429:
+            return False, f"Rate limited by {url}, retry after {delay:.0f}s"
+
+        if response.status_code == 304:
+            return False, NOT_MODIFIED
+
+        try:
+            response.raise_for_status()
+        except Exception as E:
+            return False, f'Return code={response.status_code}, {E}\n{response.text}'
+
+        record_validators(method, url, kwargs.get("params"), response.headers)
+
+        if not decode:
+            return True, response.content
+
+        try:
+            content_decoded = response.content.decode('utf-8')
+            if not content_decoded:
+                return True, {}
+
+            data_dict = json.loads(content_decoded)
+        except Exception as E:
+            return False, f'Error while decoding content: {E}'
+
+        return True, data_dict
+
+
+    ##########################
+    ####### Pagination #######
+    ##########################
+
+    async def get_pages(self, url, params=None, max_pages=5):
+        """
+            Async counterpart of TMDB_REST_API_Client.get_pages: page 1 first,
+            then the remaining pages concurrently, bounded by page_workers.
+        """
+
+        params = dict(params or {})
+
+        status, output = await self.request("GET", url, params={**params, "page": 1})
+        if not status:
+            return False, output
+
+        result_list = list(output.get("results", []))
+
+        last_page = min(max_pages, output.get("total_pages", 0))
+        if last_page <= 1:
+            return True, result_list
+
+        semaphore = asyncio.Semaphore(max(1, self.page_workers))
+
+        async def fetch(page_num):
+            async with semaphore:
+                return await self.request("GET", url, params={**params, "page": page_num})
+
+        tasks = [asyncio.ensure_future(fetch(page_num)) for page_num in range(2, last_page + 1)]
+
+        try:
+            for task in tasks:
+                status, output = await task
+                if not status:
+                    return False, output
+                result_list.extend(output.get("results", []))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return True, result_list
+
+
+    ##########################
+    ####### Shared calls #####
+    ##########################
+
+    async def run(self, steps):
+        """
+            See TMDB_REST_API_Client.run.
+        """
+
+        result = None
+
+        try:
+            while True:
+                result = await self.perform(*steps.send(result))
+        except StopIteration as stop:
+            return stop.value
+
+
+    async def perform(self, op, *args):
+
+        if op == "request":
+            url, params = args
+            return await self.request("GET", url, params=params)
+
+        if op == "pages":
+            url, params, max_pages = args
+            return await self.get_pages(url, params=params, max_pages=max_pages)
+
+        if op == "cache_first":
+            return await models_redis_async.get_first(*args)
+
+        if op == "cache_set":
+            key, data, ttl = args
+            return await models_redis_async.set_to_cache(key, data, ttl=ttl)
+
+        if op == "refresh":
+            key, steps, ttl = args
+            return models_redis_async.schedule_refresh(key, lambda: self.run(steps()), ttl, 0)
+
+        if op == "callback":
+            return await args[0]()
+
+        fn, *fn_args = args
+        return await asyncio.to_thread(fn, *fn_args)
+
+
+    #######################
+    ####### Configs #######
+    #######################
+
+    @models_redis_async.cached(ttl=TTL_CONFIG, namespace="tmdb:movie_certification")
+    async def get_movie_certification(self):
+
+        return await self.run(get_json(self.baseurl, "certification/movie/list"))
+
+
+    @models_redis_async.cached(ttl=TTL_CONFIG, namespace="tmdb:countries")
+    async def get_countries(self):
+
+        return await self.run(get_json(self.baseurl, "configuration/countries"))
+
+
+    @models_redis_async.cached(ttl=TTL_CONFIG, namespace="tmdb:languages")
+    async def get_languages(self):
+
+        return await self.run(get_json(self.baseurl, "configuration/languages"))
+
+
+    @models_redis_async.cached(ttl=TTL_CONFIG, namespace="tmdb:movie_genres")
+    async def get_movie_genres(self):
+
+        return await self.run(get_json(self.baseurl, "genre/movie/list"))
+
+
+    ########################
+    ####### Trending #######
+    ########################
+
+    @models_redis_async.cached(ttl=TTL_LIST, namespace="tmdb:trending_movies")
+    async def get_trending_movies(self, language="en-US", time_window="day", max_pages=5, fields=CARD_FIELDS):
+
+        return await self.run(trending_list(self.baseurl, "movie", language, time_window, max_pages, fields))
+
+
+    @models_redis_async.cached(ttl=TTL_LIST, namespace="tmdb:trending_tvs")
+    async def get_trending_tvs(self, language="en-US", time_window="day", max_pages=5, fields=CARD_FIELDS):
+
+        return await self.run(trending_list(self.baseurl, "tv", language, time_window, max_pages, fields))
+
+
+    ##################################
+    ####### Movie and TV Detail ######
+    ##################################
+
+    @models_redis_async.cached(ttl=TTL_DETAIL, namespace="tmdb:movie_detail")
+    async def get_movie_detail(self, movie_id, language="en-US"):
+
+        return await self.run(title_detail(self.baseurl, "movie", movie_id, language))
+
+
+    @models_redis_async.cached(ttl=TTL_DETAIL, namespace="tmdb:movie_credit")
+    async def get_movie_credit(self, movie_id, language="en-US"):
+
+        return await self.run(title_credits(self.baseurl, "movie", movie_id, language))
+
+
+    @models_redis_async.cached(ttl=TTL_DETAIL, namespace="tmdb:movie_video")
+    async def get_movie_video(self, movie_id, language="en-US"):
+
+        return await self.run(title_videos(self.baseurl, "movie", movie_id, language))
+
+
+    @models_redis_async.cached(ttl=TTL_DETAIL, namespace="tmdb:tv_detail")
+    async def get_tv_detail(self, tv_id, language="en-US"):
+
+        return await self.run(title_detail(self.baseurl, "tv", tv_id, language))
+
+
+    @models_redis_async.cached(ttl=TTL_DETAIL, namespace="tmdb:tv_credit")
+    async def get_tv_credit(self, tv_id, language="en-US"):
+
+        return await self.run(title_credits(self.baseurl, "tv", tv_id, language))
+
+
+    ###############################
+    ####### Discover Movies #######
+    ###############################
+
+    @models_redis_async.cached(ttl=TTL_LIST, namespace="tmdb:discover_movies")
+    async def discover_movies(self,
+                              include_adult=False,
+                              include_video=False,
+                              language="en-US",
+                              with_original_language=None,
+                              sort_by="popularity.desc",
+                              region=None,
+                              certification=None,
+                              primary_release_year=None,
+                              release_date_gte=None,
+                              release_date_lte=None,
+                              with_release_type=None,
+                              with_genres=None,
+                              without_genres=None,
+                              vote_count_gte=None,
+                              vote_count_lte=None,
+                              max_pages=5,
+                              fields=CARD_FIELDS):
+        """
+            See TMDB_REST_API_Client.discover_movies for the parameter tables.
+        """
+
+        return await self.run(discover_list(self.baseurl,
+                                            include_adult,
+                                            include_video,
+                                            language,
+                                            with_original_language,
+                                            sort_by,
+                                            region,
+                                            certification,
+                                            primary_release_year,
+                                            release_date_gte,
+                                            release_date_lte,
+                                            with_release_type,
+                                            with_genres,
+                                            without_genres,
+                                            vote_count_gte,
+                                            vote_count_lte,
+                                            max_pages,
+                                            fields))
+
+
+    #####################################
+    ####### Discover-based Movies #######
+    #####################################
+
+    async def get_movies_upcoming(self, fields=CARD_FIELDS):
+
+        status, output = await self.discover_movies(**upcoming_filters(), fields=with_fields(fields, "release_date"))
+        if not status:
+            return False, output
+
+        return True, only_upcoming(output, fields)
+
+
+    async def get_movies_popular(self,
+                                 with_genres=None,
+                                 with_original_language=None,
+                                 region=None,
+                                 primary_release_year=None,
+                                 fields=CARD_FIELDS):
+
+        return await self.discover_movies(**DISCOVER_DEFAULTS,
+                                          with_genres=with_genres,
+                                          with_original_language=with_original_language,
+                                          region=region,
+                                          primary_release_year=primary_release_year,
+                                          fields=fields)
+
+
+    async def get_movies_top_rated(self,
+                                   with_genres=None,
+                                   with_original_language=None,
+                                   region=None,
+                                   primary_release_year=None,
+                                   fields=CARD_FIELDS):
+
+        return await self.discover_movies(**TOP_RATED_FILTERS,
+                                          with_genres=with_genres,
+                                          with_original_language=with_original_language,
+                                          region=region,
+                                          primary_release_year=primary_release_year,
+                                          fields=fields)
+
+
+    async def get_movies_family_animation(self, fields=CARD_FIELDS):
+
+        return await self.discover_movies(**FAMILY_ANIMATION_FILTERS, fields=fields)
+
+
+    async def get_movies_horror(self, fields=CARD_FIELDS):
+
+        return await self.discover_movies(**HORROR_FILTERS, fields=fields)
+
+    ######################
+    ####### Search #######
+    ######################
+
+    async def search(self, query, max_pages=5, fields=CARD_FIELDS, superseded=None):
+        """
+            See tmdb_client.search_multi, superseded is a coroutine function.
+        """
+
+        return await self.run(search_multi(self.baseurl, query, max_pages, fields, superseded))
@@ -0,0 +1,140 @@
+# Author: Mani Amoozadeh
+# Email: mani.amoozadeh2@gmail.com
+# Description: write-behind of movie-night votes from Redis to Postgres
+
+# Votes are counted in Redis only, so concurrent voters never wait on SQL
+# rows. This process copies the nights that changed to Postgres every few
+# seconds:
+#
+#   python vote_flusher.py                   # loop, every VOTES_FLUSH_INTERVAL seconds
+#   python vote_flusher.py --once            # one pass, e.g. from cron
+#   python vote_flusher.py --restore 2025-06-13
+#                                            # rebuild a night in Redis from Postgres
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+import models_redis
+import models_sql
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.getenv("VOTES_FLUSH_INTERVAL", "5"))
+
+
+def parse_member(member):
+    """
+        "movie:603" -> (603, "movie")
+    """
+
+    media_type, _, tmdb_id = member.partition(":")
+
+    return int(tmdb_id), media_type
+
+
+class Vote_Flusher():
+
+    def flush_night(self, night):
+
+        votes, retracted = models_redis.get_votes(night)
+        if votes is None:
+            return False, f"Cannot read votes of {night}"
+
+        session = models_sql.Session()
+        try:
+            models_sql.save_votes(session, night,
+                                  {user_id: parse_member(member) for user_id, member in votes.items()},
+                                  retracted)
+            session.commit()
+        except Exception as E:
+            session.rollback()
+            return False, str(E)
+        finally:
+            models_sql.Session.remove()
+
+        models_redis.clear_retracted(night, retracted)
+
+        return True, len(votes)
+
+
+    def flush(self):
+        """
+            Write every night with unsaved votes, one transaction per night.
+            Nights that fail are marked dirty again for the next pass.
+        """
+
+        flushed = 0
+        failed = []
+
+        while True:
+
+            nights = models_redis.pop_dirty_nights()
+            if not nights:
+                break
+
+            for night in nights:
+                status, output = self.flush_night(night)
+                if status:
+                    flushed += 1
+                else:
+                    log.error(f"Cannot flush votes of {night}: {output}")
+                    failed.append(night)
+
+        models_redis.mark_dirty(failed)
+
+        if failed:
+            return False, f"{len(failed)} nights left for the next pass"
+
+        return True, flushed
+
+
+    def restore(self, night):
+
+        session = models_sql.Session()
+        try:
+            members = models_sql.load_vote_members(session, night)
+        finally:
+            models_sql.Session.remove()
+
+        return models_redis.restore_votes(night, members)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Write movie-night votes from Redis to Postgres")
+    parser.add_argument("--once", action="store_true", help="flush once and exit")
+    parser.add_argument("--interval", type=float, default=FLUSH_INTERVAL)
+    parser.add_argument("--restore", metavar="NIGHT", help="rebuild the Redis tallies of a night from Postgres")
+    args = parser.parse_args()
+
+    flusher = Vote_Flusher()
+
+    if args.restore:
+        status, output = flusher.restore(args.restore)
+        if not status:
+            log.error(output)
+            return 2
+        log.info(f"Restored {output} votes of {args.restore}.")
+        return 0
+
+    while True:
+
+        status, output = flusher.flush()
+        if not status:
+            log.error(output)
+        elif output:
+            log.info(f"Flushed votes of {output} nights.")
+
+        if args.once:
+            return 0 if status else 2
+
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())